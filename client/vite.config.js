@@ -19,6 +19,7 @@ export default defineConfig({
       '/login': 'http://localhost:8080',
       '/logout': 'http://localhost:8080',
       '/files': 'http://localhost:8080',
+      '/uploads': 'http://localhost:8080',
       '/auth': 'http://localhost:8080',
       '/ws': {
         target: 'ws://localhost:8080',
@@ -45,6 +45,7 @@ setup(
     entry_points={
         'console_scripts': [
             'snapfile=snapfile.__main__:main',
+            'snapfile-migrate=snapfile.migrate:main',
         ],
     },
 )
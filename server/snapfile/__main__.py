@@ -1,6 +1,12 @@
 import os
 import sys
+import signal
+import asyncio
 import logging
+import argparse
+import multiprocessing
+from time import time, sleep
+from multiprocessing.connection import wait
 from . import config
 # This function does nothing if the root logger already has handlers configured.
 logging.basicConfig(
@@ -9,31 +15,54 @@ logging.basicConfig(
     format='%(asctime)s %(levelname)s %(name)s %(filename)s:%(lineno)d {%(message)s}')
 
 from aiohttp import web
-from aiohttp_session import SimpleCookieStorage, session_middleware
+from aiohttp_session import session_middleware
+from aiohttp_session.cookie_storage import EncryptedCookieStorage
 import aiohttp_security
 
 from . import model
+from . import kdf
+from . import cache
+from . import metrics
+from . import deletion
+from . import volumes
+from . import segments
 from .auth import SimpleAuthorizationPolicy
-from .views import signup, login, logout, allow, index, ws, upload, download
+from .views import signup, login, logout, allow, stats, index, ws, upload, download, download_zip
+from .views import create_upload, upload_status, upload_chunk, finish_upload, cancel_upload
 
 
 log = logging.getLogger(__name__)
 dir_path = os.path.dirname(os.path.realpath(__file__))
 log.info('Starting from {}'.format(dir_path))
 
-def init_app():
-    middleware = session_middleware(SimpleCookieStorage())
-    app = web.Application(middlewares=[middleware])
+def init_app(session_secret):
+    # the session is encrypted because it holds the key of the folder
+    middleware = session_middleware(EncryptedCookieStorage(session_secret))
+    app = web.Application(middlewares=[metrics.middleware, middleware])
 
-    # create a global dict of identity -> (folder object, active ws connections)
-    cache = {}
-    app['folders'] = cache
+    # create a global cache of identity -> (folder object, active ws connections)
+    # and the hot files of the folders
+    app['files'] = cache.FileCache(config.FILE_CACHE_SIZE, config.FILE_CACHE_MAX_FILE_SIZE)
+    folders = cache.FolderCache(config.FOLDER_CACHE_SIZE, config.FOLDER_IDLE_TIME, app['files'])
+    app['folders'] = folders
 
     app.on_startup.append(model.startup)
+    app.on_startup.append(kdf.startup)
+    app.on_startup.append(cache.startup)
+    app.on_startup.append(metrics.startup)
+    app.on_startup.append(volumes.startup)
+    app.on_startup.append(deletion.startup)
+    app.on_startup.append(segments.startup)
     app.on_shutdown.append(shutdown)
+    app.on_cleanup.append(kdf.cleanup)
+    app.on_cleanup.append(cache.cleanup)
+    app.on_cleanup.append(metrics.cleanup)
+    app.on_cleanup.append(volumes.cleanup)
+    app.on_cleanup.append(deletion.cleanup)
+    app.on_cleanup.append(model.cleanup)
 
     policy = aiohttp_security.SessionIdentityPolicy()
-    aiohttp_security.setup(app, policy, SimpleAuthorizationPolicy(cache))
+    aiohttp_security.setup(app, policy, SimpleAuthorizationPolicy(folders))
 
     routes = [
         web.get('/ws', ws),
@@ -41,8 +70,17 @@ def init_app():
         web.post('/login', login),
         web.post('/logout', logout),
         web.get('/auth', allow),
+        web.get('/stats', stats),
+        web.get('/metrics', metrics.metrics),
         web.post('/files', upload),
         web.get('/files', download),
+        web.get('/files/zip', download_zip),
+        # resumable uploads
+        web.post('/uploads', create_upload),
+        web.get(r'/uploads/{id:\d+}', upload_status),
+        web.put(r'/uploads/{id:\d+}/{index:\d+}', upload_chunk),
+        web.post(r'/uploads/{id:\d+}', finish_upload),
+        web.delete(r'/uploads/{id:\d+}', cancel_upload),
         web.get('/', index, name='index'), # static does not support redirect / to /index.html
         web.get('/index.html', index), # serve a single static file with auth
     ]
@@ -72,16 +110,69 @@ async def shutdown(app):
     app['folders'].clear()
 
 
-def main():
+def run(session_secret, reuse_port=False):
     try:
-        app = init_app()
+        app = init_app(session_secret)
     except SystemExit as e:
         # e.g. the client hasn't been built yet. Surface the real, actionable
         # error instead of falling through to run_app() with `app` unbound
         # (which would raise an opaque UnboundLocalError).
         log.exception('Failed to start!!')
         raise
-    web.run_app(app, port=config.PORT)
+    web.run_app(app, port=config.PORT, reuse_port=reuse_port)
+
+
+def supervise(workers, session_secret):
+    """Pre-fork workers listening on the same port with SO_REUSEPORT
+    The kernel spreads the connections among them. A worker which dies is restarted
+    until the supervisor is asked to stop.
+    """
+    ctx = multiprocessing.get_context('fork')
+    processes = {}
+    stopping = False
+
+    def start(i):
+        p = ctx.Process(target=run, args=(session_secret, True), name='worker-{}'.format(i))
+        p.start()
+        log.info('Worker {} started with pid {}'.format(i, p.pid))
+        processes[p.sentinel] = (i, p, time())
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for _, p, _ in processes.values():
+            if p.is_alive():
+                p.terminate()
+
+    for i in range(workers):
+        start(i)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while processes:
+        for sentinel in wait(list(processes)):
+            i, p, started_time = processes.pop(sentinel)
+            p.join()
+            if not stopping:
+                log.error('Worker {} exited with {}, restarting'.format(i, p.exitcode))
+                if time() - started_time < 1:
+                    sleep(1) # do not spin if it fails to start
+                start(i)
+    log.info('All workers stopped')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='snapfile')
+    parser.add_argument('--workers', type=int, default=config.WORKERS,
+                        help='number of worker processes (default: %(default)s)')
+    args, _ = parser.parse_known_args() # e.g. a misplaced `python -m snapfile -u`
+    if not config.PROD:
+        asyncio.run(model.reset())
+    # shared by all workers so that a session works no matter which worker gets the request
+    session_secret = config.SESSION_SECRET or os.urandom(32)
+    if args.workers > 1:
+        supervise(args.workers, session_secret)
+    else:
+        run(session_secret)
 
 
 if __name__ == '__main__':
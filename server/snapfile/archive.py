@@ -0,0 +1,207 @@
+"""ZIP archives of the files of a folder, streamed
+An archive is stored (files are compressed before they are encrypted if it's
+worth it, see compression.py) and in ZIP64 so that it has no size limit. Its
+layout follows from the names, sizes and dates of the files, so the
+Content-Length is known up front and any range of it can be produced on its own,
+the data of a file being decrypted from the offset needed like a download.
+An entry is
+    local header     the name, and the sizes in a ZIP64 extra field
+    data             the content of the file
+    data descriptor  the CRC-32 (flag bit 3) and the sizes
+followed by the central directory, the ZIP64 end of central directory record and
+locator, and the end of central directory record.
+The CRC-32 of a file is recorded when it's uploaded. One which is not (e.g. of a
+resumable upload) is computed while the file is sent, or by reading the file on
+its own if the range does not cover all of its data, and recorded afterwards.
+"""
+import re
+import zlib
+import struct
+import hashlib
+from datetime import datetime
+
+import asyncio
+
+from .transfer import io_pools
+
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+LOCAL_EXTRA = struct.Struct('<HHQQ')
+DESCRIPTOR = struct.Struct('<IIQQ')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+CENTRAL_EXTRA = struct.Struct('<HHQQQ')
+ZIP64_END = struct.Struct('<IQHHIIQQQQ')
+ZIP64_LOCATOR = struct.Struct('<IIQI')
+END = struct.Struct('<IHHHHIIH')
+VERSION = 45 # ZIP64
+MADE_BY = 3 << 8 | VERSION # unix, for the permissions of the files extracted
+FLAGS = 0x0808 # data descriptor, utf-8 names
+STORED = 0
+ZIP64_EXTRA_ID = 0x0001
+FILE_ATTRIBUTES = 0o100644 << 16
+MASK32 = 0xFFFFFFFF
+MASK16 = 0xFFFF
+# the parts of an archive
+HEADER = 0
+DATA = 1
+DESCRIPTION = 2
+DIRECTORY = 3
+
+
+def dos_datetime(date):
+    """the time and the date in MS-DOS format of an ISO date
+    """
+    d = datetime.fromisoformat(date)
+    if d.year < 1980:
+        d = datetime(1980, 1, 1)
+    return (d.hour << 11) | (d.minute << 5) | (d.second // 2), ((d.year - 1980) << 9) | (d.month << 5) | d.day
+
+
+class Entry:
+    """A file in an archive
+    """
+    def __init__(self, file_id, name, size, date, crc32=None):
+        self.file_id = file_id
+        self.name = name
+        self.size = size
+        self.date = date
+        self.crc32 = crc32 # None if not recorded
+        self.offset = 0 # of the local header in the archive
+
+    def local_header(self):
+        name = self.name.encode('utf-8')
+        time, date = dos_datetime(self.date)
+        return LOCAL_HEADER.pack(0x04034b50, VERSION, FLAGS, STORED, time, date,
+                                 0, MASK32, MASK32, len(name), LOCAL_EXTRA.size) + \
+            name + LOCAL_EXTRA.pack(ZIP64_EXTRA_ID, LOCAL_EXTRA.size - 4, self.size, self.size)
+
+    def descriptor(self):
+        return DESCRIPTOR.pack(0x08074b50, self.crc32, self.size, self.size)
+
+    def central_header(self):
+        name = self.name.encode('utf-8')
+        time, date = dos_datetime(self.date)
+        return CENTRAL_HEADER.pack(0x02014b50, MADE_BY, VERSION, FLAGS, STORED, time, date,
+                                   self.crc32, MASK32, MASK32, len(name), CENTRAL_EXTRA.size,
+                                   0, 0, 0, FILE_ATTRIBUTES, MASK32) + \
+            name + CENTRAL_EXTRA.pack(ZIP64_EXTRA_ID, CENTRAL_EXTRA.size - 4, self.size, self.size, self.offset)
+
+
+class Archive:
+    """The layout of an archive of entries
+    """
+    def __init__(self, entries):
+        self.entries = entries
+        self.computed = [] # the entries whose CRC-32 is computed, to be recorded
+        names = set()
+        for entry in entries:
+            entry.name = unique_name(safe_name(entry.name), names)
+        self.parts = [] # (start, length, what, entry)
+        offset = 0
+        for entry in entries:
+            entry.offset = offset
+            for what, length in ((HEADER, len(entry.local_header())), (DATA, entry.size), (DESCRIPTION, DESCRIPTOR.size)):
+                self.parts.append((offset, length, what, entry))
+                offset += length
+        self.directory_offset = offset
+        self.directory_size = sum(CENTRAL_HEADER.size + len(e.name.encode('utf-8')) + CENTRAL_EXTRA.size for e in entries)
+        length = self.directory_size + ZIP64_END.size + ZIP64_LOCATOR.size + END.size
+        self.parts.append((offset, length, DIRECTORY, None))
+        self.size = offset + length
+
+    @property
+    def etag(self):
+        """a strong validator, the layout and the content of the files never change
+        """
+        h = hashlib.sha256()
+        for e in self.entries:
+            h.update('{}\0{}\0{}\0{}\0'.format(e.file_id, e.name, e.size, e.date).encode('utf-8'))
+        return '"zip-{}"'.format(h.hexdigest()[:32])
+
+    @property
+    def mtime(self):
+        return max(datetime.fromisoformat(e.date).timestamp() for e in self.entries)
+
+    async def write(self, resp, start, end, send_file):
+        """write the bytes of the archive from start to end to resp
+        send_file(entry, out, start, end) writes the content of a file from start to end to out
+        """
+        for part_start, length, what, entry in self.parts:
+            s, e = max(start, part_start) - part_start, min(end, part_start + length) - part_start
+            if s >= e:
+                continue
+            if what == DATA:
+                if entry.crc32 is None and s == 0 and e == length:
+                    out = Checksum(resp)
+                    await send_file(entry, out, s, e)
+                    self._computed(entry, out.crc32)
+                else:
+                    await send_file(entry, resp, s, e)
+                continue
+            if what == HEADER:
+                data = entry.local_header()
+            elif what == DESCRIPTION:
+                await self._checksum([entry], send_file)
+                data = entry.descriptor()
+            else:
+                await self._checksum(self.entries, send_file)
+                data = self.directory()
+            await resp.write(data[s:e])
+
+    def directory(self):
+        count = len(self.entries)
+        end_offset = self.directory_offset + self.directory_size
+        return b''.join(e.central_header() for e in self.entries) + \
+            ZIP64_END.pack(0x06064b50, ZIP64_END.size - 12, MADE_BY, VERSION, 0, 0,
+                           count, count, self.directory_size, self.directory_offset) + \
+            ZIP64_LOCATOR.pack(0x07064b50, 0, end_offset, 1) + \
+            END.pack(0x06054b50, 0, 0, MASK16, MASK16, MASK32, MASK32, 0)
+
+    async def _checksum(self, entries, send_file):
+        """compute the CRC-32 of the entries which is not known by reading their files
+        """
+        for entry in entries:
+            if entry.crc32 is None:
+                out = Checksum()
+                await send_file(entry, out, 0, entry.size)
+                self._computed(entry, out.crc32)
+
+    def _computed(self, entry, crc32):
+        entry.crc32 = crc32
+        self.computed.append(entry)
+
+
+class Checksum:
+    """Compute the CRC-32 of what is written through it
+    """
+    def __init__(self, resp=None):
+        self.resp = resp
+        self.crc32 = 0
+
+    async def write(self, chunk):
+        self.crc32 = await asyncio.get_running_loop().run_in_executor(io_pools, zlib.crc32, chunk, self.crc32)
+        if self.resp is not None:
+            await self.resp.write(chunk)
+
+
+def safe_name(name):
+    """a name which is extracted in the directory of the archive
+    """
+    name = re.sub(r'[/\\\x00-\x1f]', '_', name).strip()
+    if name in ('', '.', '..'):
+        name = '_' + name
+    return name
+
+
+def unique_name(name, names):
+    """name, or name (n) if it's taken
+    """
+    stem, dot, ext = name.rpartition('.')
+    if not stem:
+        stem, dot, ext = name, '', ''
+    candidate = name
+    n = 1
+    while candidate in names:
+        candidate = '{} ({}){}{}'.format(stem, n, dot, ext)
+        n += 1
+    names.add(candidate)
+    return candidate
@@ -21,37 +21,83 @@ class SimpleAuthorizationPolicy(AbstractAuthorizationPolicy):
 
         Actually, we return the folder directly here
         """
-        if identity in self.cache:
-            folder = self.cache[identity]
-            if folder.expired:
-                log.warning('folder expired')
-            else:
-                return folder
-        else:
+        identity, _, rest = identity.partition(':')
+        salt, _, key = rest.rpartition(':')
+        folder = self.cache.get(identity)
+        if folder is None and key:
+            # logged in through another worker, the key comes with the session
+            folder = await Folder.open(identity)
+            if folder is None:
+                log.warning('folder deleted')
+                return None
+            if (folder.salt or '') != salt:
+                # the key is not of this folder
+                log.warning('folder recreated')
+                return None
+            folder.encryption_key = bytearray.fromhex(key)
+            # do not overwrite the cache because otherwise it will lose previous connections
+            folder = self.cache.setdefault(identity, folder)
+        if folder is None:
             log.warning('not logged in yet')
+        elif (folder.salt or '') != salt:
+            log.warning('folder recreated')
+        elif folder.expired:
+            log.warning('folder expired')
+        else:
+            return folder
         return None
 
     async def permits(self, identity, permission, context=None):
         pass
 
 
-async def login(cache, passcode):
+async def login(cache, passcode, client=None):
     """Check login credentials & Login the user
     this function usually takes username & password and verifies this is a registered user
     then returns an identity string that survives in this session.
     Since there is no user concept in this app, the hash of the folder id (passcode) is
     treated as identity for simplicity.
+    The key of the folder is kept in the (encrypted) session as well, so that any
+    worker can open the folder without the passcode: `<identity>:<salt>:<key in hex>`.
+    The salt binds the session to the folder, which may be deleted and created
+    again with the same passcode but a new salt.
+    The client (ip address) is used to share the key derivation workers fairly.
     """
-    folder = await Folder.login(passcode)
+    identity = Folder._gen_hash(passcode)
+    folder = cache.get(identity)
+    if folder is not None and not folder.expired:
+        # the key was derived when the folder was opened for the first time
+        return session_identity(folder)
+    folder = await Folder.login(passcode, client)
     if folder is None:
         log.warning('wrong identity')
         raise web.HTTPUnauthorized()
     if folder.expired:
         log.warning('folder expired')
         raise web.HTTPUnauthorized()
-    identity = folder.identity
-    if identity not in cache:
+    return session_identity(cache_folder(cache, folder))
+
+
+async def signup(cache, passcode, age=None, client=None):
+    """Create a folder and login
+    its key is derived once, when it's created
+    """
+    folder = await Folder.create(passcode, age, client)
+    return session_identity(cache_folder(cache, folder))
+
+
+def cache_folder(cache, folder):
+    """return the folder in the cache
+    """
+    cached = cache.peek(folder.identity)
+    if cached is None or cached.expired or cached.salt != folder.salt:
+        cache[folder.identity] = folder
+    else:
         # do not overwrite the cache because otherwise it will lose previous connections
-        cache[identity] = folder
-    return identity
+        folder = cached
+    return folder
+
+
+def session_identity(folder):
+    return '{}:{}:{}'.format(folder.identity, folder.salt or '', folder.encryption_key.hex())
 
@@ -0,0 +1,222 @@
+"""The folders opened in this worker and their hot files
+An opened folder holds its key so that messages and files can be encrypted
+without the passcode. A folder not in use is evicted after FOLDER_IDLE_TIME, and
+the least recently used ones when there are more than FOLDER_CACHE_SIZE. An
+evicted folder is opened again on the next request with the key in the session.
+"""
+import logging
+import weakref
+from time import time
+from collections import OrderedDict
+
+import asyncio
+
+from . import config
+
+log = logging.getLogger(__name__)
+
+
+def wipe(key):
+    """overwrite a key in place
+    Only the key held by the folder is wiped, copies made by the libraries are
+    out of our reach.
+    """
+    key[:] = bytes(len(key))
+
+
+class FolderCache:
+    """identity -> Folder, the least recently used first
+    A folder is in use as long as it has websocket connections, such a folder is
+    never evicted. The files of a folder in the FileCache go with it.
+    """
+    def __init__(self, size, idle_time, files=None):
+        self.size = size
+        self.idle_time = idle_time
+        self.files = files
+        self.folders = OrderedDict()
+        self.used_time = {} # identity -> when it's used last time
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.wiped = 0
+
+    def stats(self):
+        return {
+            'size': len(self.folders),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evicted': self.evicted,
+            'wiped': self.wiped,
+        }
+
+    def __len__(self):
+        return len(self.folders)
+
+    def __contains__(self, identity):
+        return identity in self.folders
+
+    def get(self, identity, default=None):
+        """get a folder for a request
+        """
+        folder = self.folders.get(identity)
+        if folder is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._touch(identity)
+        return folder
+
+    def peek(self, identity, default=None):
+        """get a folder without counting it as used
+        """
+        return self.folders.get(identity, default)
+
+    def __setitem__(self, identity, folder):
+        self.folders[identity] = folder
+        self._touch(identity)
+        if folder.encryption_key is not None:
+            # the key is wiped once the folder is dropped from the cache and no request is using it any more
+            weakref.finalize(folder, self._wipe, folder.encryption_key)
+        if len(self.folders) > self.size:
+            self._evict_lru()
+
+    def setdefault(self, identity, folder):
+        if identity in self.folders:
+            return self.get(identity)
+        self[identity] = folder
+        return folder
+
+    def pop(self, identity, default=None):
+        self.used_time.pop(identity, None)
+        if self.files is not None:
+            self.files.discard(identity)
+        return self.folders.pop(identity, default)
+
+    def values(self):
+        return self.folders.values()
+
+    def clear(self):
+        self.folders.clear()
+        self.used_time.clear()
+        if self.files is not None:
+            self.files.clear()
+
+    def evict(self, identity):
+        self.pop(identity)
+        self.evicted += 1
+
+    def evict_idle(self):
+        """evict the folders which are not used for idle_time
+        return the number of folders evicted
+        """
+        evicted = 0
+        deadline = time() - self.idle_time
+        for identity, folder in list(self.folders.items()):
+            if folder.connections:
+                self._touch(identity)
+            elif self.used_time[identity] < deadline:
+                self.evict(identity)
+                evicted += 1
+        return evicted
+
+    def _evict_lru(self):
+        for identity, folder in list(self.folders.items()):
+            if len(self.folders) <= self.size:
+                break
+            if not folder.connections:
+                self.evict(identity)
+
+    def _touch(self, identity):
+        self.folders.move_to_end(identity)
+        self.used_time[identity] = time()
+
+    def _wipe(self, key):
+        wipe(key)
+        self.wiped += 1
+
+
+class FileCache:
+    """(identity, file id) -> the decrypted content of a small file and the stat of its file
+    A file is usually downloaded by a few devices within minutes of the upload,
+    so the files uploaded (and downloaded) through this worker are kept in memory,
+    the least recently used first, up to capacity bytes in total. They are served
+    without reading the disk or decrypting. Files larger than max_file_size are
+    not cached. Plaintext does not outlive the key in the worker: the files of a
+    folder are dropped when the folder is evicted or deleted, see FolderCache.
+    """
+    def __init__(self, capacity, max_file_size):
+        self.capacity = capacity
+        self.max_file_size = max_file_size
+        self.files = OrderedDict()
+        self.folders = {} # identity -> the ids of its files cached
+        self.size = 0 # bytes cached
+        # statistics
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {
+            'files': len(self.files),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def get(self, identity, file_id):
+        """return the content and the stat of a file or None
+        """
+        entry = self.files.get((identity, file_id))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.files.move_to_end((identity, file_id))
+        return entry
+
+    def put(self, identity, file_id, content, stat):
+        if len(content) > self.max_file_size or len(content) > self.capacity:
+            return
+        self._remove((identity, file_id))
+        self.files[(identity, file_id)] = (content, stat)
+        self.folders.setdefault(identity, set()).add(file_id)
+        self.size += len(content)
+        while self.size > self.capacity:
+            self._remove(next(iter(self.files)))
+
+    def discard(self, identity):
+        """drop the files of a folder
+        """
+        for file_id in list(self.folders.get(identity, ())):
+            self._remove((identity, file_id))
+
+    def clear(self):
+        self.files.clear()
+        self.folders.clear()
+        self.size = 0
+
+    def _remove(self, key):
+        entry = self.files.pop(key, None)
+        if entry is None:
+            return
+        self.size -= len(entry[0])
+        identity, file_id = key
+        self.folders[identity].discard(file_id)
+        if not self.folders[identity]:
+            del self.folders[identity]
+
+
+async def evict_idle_folders(app):
+    while True:
+        await asyncio.sleep(config.FOLDER_IDLE_TIME / 2)
+        evicted = app['folders'].evict_idle()
+        if evicted:
+            log.info('{} idle folders evicted'.format(evicted))
+
+
+async def startup(app):
+    app['evict_task'] = asyncio.create_task(evict_idle_folders(app))
+
+
+async def cleanup(app):
+    app['evict_task'].cancel()
@@ -0,0 +1,74 @@
+"""Binary records of messages stored in redis
+A record is a fixed header followed by the raw data:
+    version   u8   RECORD_VERSION
+    type      u8   MsgType
+    flags     u8   ENCRYPTED, HAS_FILE
+    sender    u16  index of the sender in the senders of the folder
+    size      u64
+    date      i64  microseconds since the epoch, UTC
+    file_id   u64  0 if it's not a file
+    data           nonce + ciphertext if encrypted, otherwise utf-8 text
+Compared with json, the ciphertext is not base64 encoded, the field names and
+the sender (the same few devices) are not repeated in every message.
+Messages saved in json before are still readable, see is_legacy.
+"""
+import struct
+from datetime import datetime, timedelta, timezone
+
+RECORD_VERSION = 1
+HEADER = struct.Struct('!BBBHQqQ')
+# flags
+ENCRYPTED = 1
+HAS_FILE = 2
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def is_legacy(record):
+    """a message saved as json
+    """
+    return record[:1] == b'{'
+
+
+def pack(msg, sender, data, encrypted):
+    """msg: the message whose data is replaced by data (bytes)
+    sender: the index of msg.sender
+    """
+    flags = ENCRYPTED if encrypted else 0
+    if msg.file_id is not None:
+        flags |= HAS_FILE
+    return HEADER.pack(
+        RECORD_VERSION,
+        msg.type,
+        flags,
+        sender,
+        msg.size,
+        _to_micros(msg.date),
+        int(msg.file_id) if msg.file_id is not None else 0) + data
+
+
+def unpack(record):
+    """return a dict of the fields and whether the data is encrypted
+    the sender is the index, data is bytes
+    """
+    version, type, flags, sender, size, date, file_id = HEADER.unpack_from(record)
+    if version != RECORD_VERSION:
+        raise ValueError('unknown record version {}'.format(version))
+    fields = {
+        'type': type,
+        'sender': sender,
+        'size': size,
+        'date': _from_micros(date),
+        'file_id': str(file_id) if flags & HAS_FILE else None,
+        'data': record[HEADER.size:],
+    }
+    return fields, bool(flags & ENCRYPTED)
+
+
+def _to_micros(date):
+    delta = datetime.fromisoformat(date) - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10**6 + delta.microseconds
+
+
+def _from_micros(micros):
+    return (EPOCH + timedelta(microseconds=micros)).isoformat()
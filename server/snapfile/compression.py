@@ -0,0 +1,59 @@
+"""Compress-then-encrypt of uploaded files
+Ciphertext does not compress, so a file is compressed before it is encrypted if
+a sample of its first chunk shows it's worth it. A compressed file is stored as:
+    magic     8s   MAGIC
+    size      u64  of the original content, written when the upload is committed
+    nonce     16s
+    frames         encrypted as a single stream, each of them is
+        length  u32  of the compressed data
+        size    u32  of the original data
+        data         a chunk of the upload compressed by zlib on its own
+Frames are independent of each other, so a range of the content is served by
+skipping the frames before it without decompressing them.
+Other files, including those stored before, are the nonce followed by the
+ciphertext. A random nonce starting with MAGIC is not a concern (2**-64).
+"""
+import zlib
+import struct
+
+from . import config
+
+MAGIC = b'SNAPZLIB'
+HEADER = struct.Struct('!8sQ16s')
+FRAME = struct.Struct('!II')
+SAMPLE_SIZE = 64*1024 # bytes of the first chunk compressed to decide
+NONCE_SIZE = 16
+
+
+def worth_compressing(chunk):
+    """whether a file whose first chunk is given shrinks enough by compression
+    """
+    sample = chunk[:SAMPLE_SIZE]
+    if not sample:
+        return False
+    return len(zlib.compress(sample, config.COMPRESSION_LEVEL)) < len(sample) * config.COMPRESSION_RATIO
+
+
+def header(nonce, size=0):
+    return HEADER.pack(MAGIC, size, nonce)
+
+
+def frame(chunk):
+    data = zlib.compress(chunk, config.COMPRESSION_LEVEL)
+    return FRAME.pack(len(data), len(chunk)) + data
+
+
+def decompress(data):
+    """the original data of a frame
+    """
+    return zlib.decompress(data)
+
+
+def parse_header(head, file_size):
+    """parse the first HEADER.size bytes (or fewer) of an encrypted file of file_size bytes
+    return the nonce, the size of the header, the size of the content and whether it's compressed
+    """
+    if len(head) >= HEADER.size and head.startswith(MAGIC):
+        _, size, nonce = HEADER.unpack_from(head)
+        return nonce, HEADER.size, size, True
+    return head[:NONCE_SIZE], NONCE_SIZE, file_size - NONCE_SIZE, False
@@ -3,19 +3,91 @@ import os
 
 PROD = False
 PORT = 8090
+WORKERS = 1 # processes sharing the port, overridden by `snapfile --workers N`
+# the key encrypting session cookies, which carry the keys of the folders
+# a random one is used if it's not set, in which case sessions do not survive a restart
+SESSION_SECRET = os.environ.get('SESSION_SECRET')
 REDIS_ADDRESS = 'redis://localhost'
 REDIS_DB = 0
 LOG_LEVEL = 'DEBUG'
 LOG_FILE = None
 AGE = 24*60*60 # 1 day
 STORAGE_PER_FOLDER = 10**9 # bytes, 1 GB by default
+# bytes kept free on the disk of each volume, uploads and folders which
+# would go below it are refused
+MIN_FREE_SPACE = 10**9
 UPLOAD_ROOT_DIRECTORY = './upload'
-# a Folder will be placed in a random second level directory named from 1 to 1024 under UPLOAD_ROOT_DIRECTORY
+# directories on other disks holding folders too, separated by os.pathsep in SNAPFILE_VOLUMES
+# a new folder is placed on the volume with the most room and the least I/O, see volumes.py
+EXTRA_VOLUMES = [v for v in os.environ.get('SNAPFILE_VOLUMES', '').split(os.pathsep) if v]
+VOLUME_SAMPLE_INTERVAL = 5 # seconds between the samples of the free space and the I/O of the volumes
+# idle folders, with nothing being uploaded and no message for REBALANCE_IDLE_TIME seconds, are
+# moved off a volume whose disk is used above VOLUME_HIGH_WATERMARK, at most REBALANCE_BATCH of
+# them every REBALANCE_INTERVAL seconds
+VOLUME_HIGH_WATERMARK = 0.85
+REBALANCE_INTERVAL = 60
+REBALANCE_BATCH = 10
+REBALANCE_IDLE_TIME = 3600
+MOVE_LOCK_TIME = 3600 # seconds at most to copy a folder, uploads to it are refused meanwhile
+MOVE_GRACE = 60 # seconds the old copy of a moved folder is kept for the downloads opening it
+# a Folder will be placed in a random second level directory named from 1 to 1024 under its volume
 UPLOAD_SECOND_DIRECTORY_RANGE = 2**10
 ENABLE_ENCRYPTION = True
-DELETE_INTERVAL = 24*60*60 # seconds i.e., daily
+# when encryption is off, files are served by NGINX through X-Accel-Redirect if it's set
+# (see deploy/snapfile.conf), otherwise by sendfile from the app itself
+ACCEL_REDIRECT = False
+# compress-then-encrypt the uploaded files which are compressible, see compression.py
+COMPRESS_UPLOADS = True
+COMPRESSION_LEVEL = 1 # of zlib, fast
+COMPRESSION_RATIO = 0.9 # a file is compressed if a sample of its first chunk shrinks below this ratio
+# expired folders are deleted by a background task which wakes up when the next folder is due
+# but at least every REAP_INTERVAL seconds, deleting at most REAP_BATCH folders at a time
+REAP_INTERVAL = 5
+REAP_BATCH = 100
+# the directories of deleted folders are deleted in the background by DELETE_WORKERS threads
+# of a worker, which delete at most DELETE_FILES_PER_SECOND files and DELETE_BYTES_PER_SECOND
+# bytes per second together, 0 is unlimited
+DELETE_WORKERS = 4
+DELETE_FILES_PER_SECOND = 1000
+DELETE_BYTES_PER_SECOND = 10**9
+DELETE_LEASE = 60 # seconds before a deletion held by a worker which is gone is resumed by another
 HEARTBEAT = 30 # seconds
 RECEIVE_TIMEOUT = 3600 # 1 hour
+# folders opened in a worker, each holding its key, are evicted when not in use
+# for FOLDER_IDLE_TIME seconds or when there are more than FOLDER_CACHE_SIZE
+FOLDER_CACHE_SIZE = 10000
+FOLDER_IDLE_TIME = 600
+# decrypted small files kept in memory per worker for the devices downloading them, see cache.FileCache
+FILE_CACHE_SIZE = 256*1024*1024 # bytes in total
+FILE_CACHE_MAX_FILE_SIZE = 8*1024*1024 # bytes, larger files are not cached
+METRICS_INTERVAL = 5 # seconds between the snapshots of the metrics saved by a worker, see metrics.py
+PULL_PAGE_SIZE = 200 # messages sent in a frame at most when the history is pulled
+# broadcasts waiting to be sent to a websocket connection at most, beyond which
+# it's considered too slow and handled by SLOW_CONSUMER_POLICY: 'disconnect' or 'drop'
+FANOUT_QUEUE_SIZE = 64
+SLOW_CONSUMER_POLICY = 'disconnect'
+IO_WORKERS = 32 # threads reading, writing, encrypting and decrypting files
+UPLOAD_INFLIGHT = 2 # chunks buffered in memory per upload while the previous one is being written
+UPLOAD_CHUNK_SIZE = 4*1024*1024 # chunk size of resumable uploads
+DOWNLOAD_READAHEAD = 2 # chunks read and decrypted ahead of the network per download
+# the chunk size of a download adapts to the throughput of the client
+DOWNLOAD_CHUNK_MIN = 64*1024
+DOWNLOAD_CHUNK_MAX = 4*1024*1024
+DOWNLOAD_CHUNK_TIME = 0.1 # seconds to send a chunk
+# a file being uploaded is downloaded by the other devices as it's written, see tailing.py
+TAIL_MIN_SIZE = 4*1024*1024 # bytes, smaller uploads are not announced
+TAIL_TIMEOUT = 60 # seconds a download waits for the upload to make progress
+# small files are packed into the segments of their folder, see segments.py
+SEGMENT_MAX_FILE_SIZE = 256*1024 # bytes, larger files are stored on their own
+SEGMENT_SIZE = 64*1024*1024 # bytes a segment grows to before a new one is started
+# the header holding the address of the client set by a reverse proxy
+# None means the peer address is used directly
+REAL_IP_HEADER = None
+# PBKDF2 key derivation runs in a dedicated thread pool
+KDF_ITERATIONS = 480000
+KDF_WORKERS = os.cpu_count() or 1
+KDF_QUEUE_SIZE = 64 # derivations waiting for a worker before login is refused with 503
+KDF_QUEUE_PER_CLIENT = 4 # derivations queued or running for a client ip before login is refused with 429
 
 # PROD or TEST
 ENV = os.environ.get('ENV')
@@ -25,12 +97,37 @@ if ENV == 'PROD':
     REDIS_DB = 1
     LOG_LEVEL = 'DEBUG'
     LOG_FILE = None # rely on supervisord to manage log rotation
+    REAL_IP_HEADER = 'X-Real-IP' # set by NGINX
+    ACCEL_REDIRECT = True
     UPLOAD_ROOT_DIRECTORY = '/var/www/snapfile/files'
 elif ENV == 'TEST':
     AGE = 8
     LOG_FILE = 'test.log'
     STORAGE_PER_FOLDER = 10**6 # 1 MB
-    DELETE_INTERVAL = 6
+    MIN_FREE_SPACE = 10**6
+    REAP_INTERVAL = 1
+    UPLOAD_CHUNK_SIZE = 256*1024
+    KDF_QUEUE_PER_CLIENT = 2
+    PULL_PAGE_SIZE = 2
+    FANOUT_QUEUE_SIZE = 4
+    FOLDER_CACHE_SIZE = 4
+    FOLDER_IDLE_TIME = 2
+    FILE_CACHE_MAX_FILE_SIZE = 64*1024 # larger files are read from the disk
+    TAIL_MIN_SIZE = 64*1024
+    SEGMENT_MAX_FILE_SIZE = 16*1024
+    SEGMENT_SIZE = 64*1024
+    # the downloads of plain files are tested with SNAPFILE_ENCRYPTION=0
+    ENABLE_ENCRYPTION = os.environ.get('SNAPFILE_ENCRYPTION', '1') == '1'
+    ACCEL_REDIRECT = os.environ.get('SNAPFILE_ACCEL_REDIRECT') == '1'
+elif ENV == 'BENCH':
+    # the benchmark harness (tests/benchmark.py) runs the app on its own port, db and directory
+    PORT = 8092
+    REDIS_DB = 14
+    LOG_FILE = 'bench.log'
+    UPLOAD_ROOT_DIRECTORY = './upload_bench'
+    STORAGE_PER_FOLDER = 10**10 # 10 GB, the quota is not what is measured
+    REAL_IP_HEADER = 'X-Real-IP' # set by the harness, each simulated client has its own address
+    METRICS_INTERVAL = 1
 elif ENV == 'E2E':
     # Dedicated configuration for the Playwright end-to-end suite.
     # The e2e launcher (client/tests/e2e/server.mjs) starts an isolated, in-memory
@@ -50,7 +147,6 @@ elif ENV == 'E2E':
     # Folders must outlive the whole suite, so keep them long-lived and do not
     # let the background reaper delete anything mid-test.
     AGE = 24*60*60
-    DELETE_INTERVAL = 24*60*60
     STORAGE_PER_FOLDER = 10**7 # 10 MB, plenty for the e2e file fixtures
 else: # DEV
-    DELETE_INTERVAL = 60
+    REAP_INTERVAL = 60
@@ -0,0 +1,193 @@
+"""Deletion of the directories of deleted folders in the background
+A directory is first moved to TRASH_DIRECTORY of its volume, so that it's out of
+the way of new folders, and then marked by a tombstone in redis, added with the
+removal of the keys of its folder. Any worker claims tombstones with a lease which it renews
+while deleting, so a deletion interrupted by a crash or a restart is resumed
+once the lease expires.
+Directories are deleted file by file, concurrently, in a dedicated pool of
+DELETE_WORKERS threads. The files and bytes deleted per second by all threads
+of a worker are limited so that deletions do not flood the I/O queue of the disk
+shared with uploads and downloads.
+"""
+import os
+import logging
+import threading
+from time import time, monotonic, sleep
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
+from redis import asyncio as aioredis
+
+from . import config
+from . import model
+from . import metrics
+from . import volumes
+
+log = logging.getLogger(__name__)
+TOMBSTONES_KEY = 'deletions' # sorted set of directories scored by when they may be claimed
+TRASH_DIRECTORY = '.trash' # under each volume
+# claim at most ARGV[2] tombstones which are not claimed or whose lease expires
+# by ARGV[1], for ARGV[3] seconds
+# return the directories
+CLAIM_TOMBSTONES = """
+local paths = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, path in ipairs(paths) do
+    redis.call('ZADD', KEYS[1], tonumber(ARGV[1]) + tonumber(ARGV[3]), path)
+end
+return paths
+"""
+service = None
+
+
+class RateLimiter:
+    """A token bucket shared by threads
+    acquire() sleeps in the calling thread until the amount fits in the rate,
+    a rate of 0 is unlimited.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last_time = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, amount):
+        if not self.rate:
+            return
+        with self.lock:
+            now = monotonic()
+            self.allowance = min(self.rate, self.allowance + (now - self.last_time) * self.rate)
+            self.last_time = now
+            # taken in advance, those coming next wait for the debt too
+            self.allowance -= amount
+            wait = -self.allowance / self.rate
+        if wait > 0:
+            sleep(wait)
+
+
+class DeletionService:
+    def __init__(self, workers, files_per_second, bytes_per_second):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='delete')
+        self.files = RateLimiter(files_per_second)
+        self.bytes = RateLimiter(bytes_per_second)
+        self.running = {} # directory -> task deleting it
+        self.stopping = False # checked by the threads between files
+        self.wakeup = asyncio.Event()
+        self.claim = model.redis.register_script(CLAIM_TOMBSTONES)
+
+    async def run(self):
+        """claim tombstones while there are free threads
+        """
+        while True:
+            try:
+                await self._renew()
+                free = self.workers - len(self.running)
+                if free > 0:
+                    paths = await self.claim(keys=[TOMBSTONES_KEY], args=[time(), free, config.DELETE_LEASE])
+                    for path in paths:
+                        path = path.decode('utf-8')
+                        self.running[path] = asyncio.create_task(self.delete(path))
+                metrics.deletion_backlog.set(await model.redis.zcard(TOMBSTONES_KEY))
+                metrics.deletions_running.set(len(self.running))
+            except aioredis.ConnectionError as e:
+                log.error('failed to claim deletions: {}'.format(e))
+            self.wakeup.clear()
+            wakeup = asyncio.create_task(self.wakeup.wait())
+            await asyncio.wait([wakeup, *self.running.values()], timeout=config.REAP_INTERVAL,
+                               return_when=asyncio.FIRST_COMPLETED)
+            wakeup.cancel()
+
+    async def _renew(self):
+        """extend the leases of the directories being deleted
+        """
+        if self.running:
+            lease = time() + config.DELETE_LEASE
+            await model.redis.zadd(TOMBSTONES_KEY, {path: lease for path in self.running}, xx=True)
+
+    async def delete(self, path):
+        started_time = time()
+        try:
+            files, size = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._delete_tree, path)
+            metrics.files_deleted.inc(files)
+            metrics.bytes_deleted.inc(size)
+            if not self.stopping:
+                await model.redis.zrem(TOMBSTONES_KEY, path)
+                log.info('{} deleted: {} files, {} in {:.3f}s'.format(
+                    path, files, model.format_size(size), time() - started_time))
+        except Exception:
+            # the tombstone is claimed again once the lease expires
+            log.exception('failed to delete {}'.format(path))
+        finally:
+            del self.running[path]
+
+    def _delete_tree(self, path):
+        """delete a directory bottom up at the rate allowed
+        return the number of files and bytes deleted
+        """
+        files = size = 0
+        for root, dirs, names in os.walk(path, topdown=False):
+            for name in names:
+                if self.stopping:
+                    return files, size # resumed after restart
+                file_path = os.path.join(root, name)
+                try:
+                    file_size = os.lstat(file_path).st_size
+                    self.files.acquire(1)
+                    self.bytes.acquire(file_size)
+                    os.unlink(file_path)
+                except FileNotFoundError:
+                    continue
+                files += 1
+                size += file_size
+            try:
+                os.rmdir(root)
+            except FileNotFoundError:
+                pass
+        return files, size
+
+
+async def trash(volume, path, name):
+    """move a directory on a volume to the trash of the volume
+    return the path of the directory in the trash, to be marked by a tombstone
+    """
+    src = os.path.join(volume, path)
+    dst = os.path.join(volume, TRASH_DIRECTORY, name)
+    try:
+        await asyncio.get_running_loop().run_in_executor(service.executor, os.rename, src, dst)
+    except FileNotFoundError:
+        pass # moved before a crash, or never created
+    return dst
+
+
+async def schedule(path, delay=0):
+    """delete a directory in delay seconds
+    """
+    await model.redis.zadd(TOMBSTONES_KEY, {path: time() + delay})
+    if not delay:
+        wakeup()
+
+
+def wakeup():
+    """a tombstone is added
+    """
+    service.wakeup.set()
+
+
+async def startup(app):
+    global service
+    for directory in volumes.directories():
+        os.makedirs(os.path.join(directory, TRASH_DIRECTORY), exist_ok=True)
+    service = DeletionService(
+        config.DELETE_WORKERS,
+        config.DELETE_FILES_PER_SECOND,
+        config.DELETE_BYTES_PER_SECOND)
+    app['deletion_task'] = asyncio.create_task(service.run())
+
+
+async def cleanup(app):
+    service.stopping = True
+    app['deletion_task'].cancel()
+    tasks = [app['deletion_task'], *service.running.values()]
+    await asyncio.wait(tasks)
+    service.executor.shutdown(wait=False, cancel_futures=True)
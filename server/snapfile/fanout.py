@@ -0,0 +1,98 @@
+"""Deliver broadcast messages to websocket connections
+A broadcast is encoded once and queued to every connection, each of which has a
+writer task sending its own queue. A slow connection only delays itself: when its
+queue is full it is handled according to SLOW_CONSUMER_POLICY,
+- disconnect: close it with CLOSE_RESYNC, the client reconnects and pulls what it missed
+- drop: discard the frame, the client notices the gap in the offsets and pulls it
+"""
+import json
+import logging
+from collections import deque
+
+import asyncio
+
+from . import config
+
+log = logging.getLogger(__name__)
+CLOSE_RESYNC = 4001 # the client should reconnect and pull the history from its last offset
+# statistics
+delivered = 0
+dropped = 0
+disconnected = 0
+
+
+def stats():
+    return {
+        'delivered': delivered,
+        'dropped': dropped,
+        'disconnected': disconnected,
+    }
+
+
+def encode(frame):
+    return json.dumps(frame)
+
+
+class Outbox:
+    """The frames waiting to be sent to a websocket connection
+    """
+    def __init__(self, ws, size=None):
+        self.ws = ws
+        self.size = config.FANOUT_QUEUE_SIZE if size is None else size
+        self.frames = deque()
+        self.ready = asyncio.Event()
+        self.closing = False
+        self.writer = asyncio.create_task(self._write_all())
+        self.closer = None # the task closing a slow connection
+
+    def put(self, data):
+        global dropped, disconnected
+        if self.closing:
+            return
+        if len(self.frames) >= self.size:
+            if config.SLOW_CONSUMER_POLICY == 'drop':
+                dropped += 1
+                log.warning('drop a frame to {}'.format(self.ws['name']))
+                return
+            disconnected += 1
+            log.warning('disconnect {} which is too slow'.format(self.ws['name']))
+            self.closing = True
+            self.frames.clear()
+            self.writer.cancel()
+            # kept so that it's not garbage collected before it's done
+            self.closer = asyncio.create_task(self._close_slow())
+            return
+        self.frames.append(data)
+        self.ready.set()
+
+    def close(self):
+        """stop sending, the frames left are discarded
+        """
+        self.closing = True
+        self.frames.clear()
+        self.writer.cancel()
+        if self.closer is not None:
+            self.closer.cancel()
+
+    async def _close_slow(self):
+        try:
+            await self.ws.close(code=CLOSE_RESYNC, message=b'Too slow, please resync')
+        except Exception as e:
+            log.warning('failed to close {}: {!r}'.format(self.ws['name'], e))
+
+    async def _write_all(self):
+        global delivered
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.frames:
+                data = self.frames.popleft()
+                if self.ws.closed:
+                    return
+                try:
+                    await self.ws.send_str(data)
+                except ConnectionResetError:
+                    # the handler of the connection will find out and clean up
+                    log.info('{} is lost while sending'.format(self.ws['name']))
+                    return
+                delivered += 1
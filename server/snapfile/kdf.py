@@ -0,0 +1,150 @@
+import math
+import hashlib
+import logging
+from time import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
+from aiohttp import web
+
+from . import config
+from . import metrics
+
+log = logging.getLogger(__name__)
+service = None
+
+
+def derive_key(passcode, salt):
+    """generate a 32-byte key used for symmethric encryption
+    hashlib releases the GIL while iterating, unlike PBKDF2HMAC from cryptography,
+    so a derivation running in a worker thread does not stall the event loop.
+    Both produce exactly the same key.
+    """
+    return hashlib.pbkdf2_hmac(
+        'sha256',
+        passcode.encode('utf-8'),
+        salt,
+        config.KDF_ITERATIONS,
+        32)
+
+
+class KeyDerivationService:
+    """Run PBKDF2 derivations in a dedicated thread pool.
+    Derivations waiting for a worker are queued per client and the clients are
+    served round robin, so one client hammering /login can only delay its own
+    logins. When the queue is full the login is refused immediately instead of
+    piling up more work.
+    """
+    def __init__(self, workers, queue_size, queue_per_client):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.queue_per_client = queue_per_client
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='kdf')
+        self.queues = OrderedDict() # client -> deque of jobs waiting for a worker
+        self.clients = {} # client -> number of jobs queued or running
+        self.queued = 0
+        self.running = 0
+        # statistics
+        self.completed = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.derive_time = 0.0
+        self.max_derive_time = 0.0
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queued': self.queued,
+            'running': self.running,
+            'clients': len(self.clients),
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'wait_avg': self.wait_time / self.completed if self.completed else 0.0,
+            'derive_avg': self.derive_time / self.completed if self.completed else 0.0,
+            'derive_max': self.max_derive_time,
+        }
+
+    def retry_after(self):
+        """estimate how many seconds it takes to drain the queue
+        """
+        avg = self.derive_time / self.completed if self.completed else 0.5
+        return str(max(1, math.ceil((self.queued + self.running) / self.workers * avg)))
+
+    def admit(self, client=None):
+        """raise an HTTPException if a derivation for the client would be refused
+        """
+        if self.clients.get(client, 0) >= self.queue_per_client:
+            self.rejected += 1
+            log.warning('too many key derivations for {}'.format(client))
+            raise web.HTTPTooManyRequests(headers={'Retry-After': self.retry_after()})
+        if self.queued >= self.queue_size:
+            self.rejected += 1
+            log.warning('key derivation queue is full: {} queued'.format(self.queued))
+            raise web.HTTPServiceUnavailable(headers={'Retry-After': self.retry_after()})
+
+    async def derive(self, passcode, salt, client=None):
+        self.admit(client)
+        job = (passcode, salt, asyncio.get_running_loop().create_future(), time())
+        self.queues.setdefault(client, deque()).append(job)
+        self.clients[client] = self.clients.get(client, 0) + 1
+        self.queued += 1
+        self._dispatch()
+        try:
+            return await job[2]
+        finally:
+            # also reached when the client goes away while its job is still queued,
+            # in which case the cancelled job is skipped by _dispatch
+            self.clients[client] -= 1
+            if self.clients[client] == 0:
+                del self.clients[client]
+
+    def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while self.running < self.workers and self.queues:
+            # take one job from the client at the head and move it to the tail
+            client, jobs = self.queues.popitem(last=False)
+            passcode, salt, fut, queued_time = jobs.popleft()
+            if jobs:
+                self.queues[client] = jobs
+            self.queued -= 1
+            if fut.cancelled():
+                continue
+            self.running += 1
+            self.wait_time += time() - queued_time
+            metrics.kdf_wait_seconds.observe(time() - queued_time)
+            started_time = time()
+            task = loop.run_in_executor(self.executor, derive_key, passcode, salt)
+            task.add_done_callback(
+                lambda task, fut=fut, started_time=started_time: self._done(task, fut, started_time))
+
+    def _done(self, task, fut, started_time):
+        self.running -= 1
+        elapsed = time() - started_time
+        self.completed += 1
+        self.derive_time += elapsed
+        self.max_derive_time = max(self.max_derive_time, elapsed)
+        if not fut.cancelled():
+            if task.cancelled():
+                fut.cancel()
+            elif task.exception() is not None:
+                fut.set_exception(task.exception())
+            else:
+                fut.set_result(task.result())
+        self._dispatch()
+
+
+async def derive(passcode, salt, client=None):
+    return await service.derive(passcode, salt, client)
+
+
+async def startup(app):
+    global service
+    service = KeyDerivationService(
+        config.KDF_WORKERS,
+        config.KDF_QUEUE_SIZE,
+        config.KDF_QUEUE_PER_CLIENT)
+
+
+async def cleanup(app):
+    service.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,260 @@
+"""Metrics in the Prometheus text format, served by /metrics
+Every worker counts in its own process and saves a snapshot in redis every
+METRICS_INTERVAL seconds, so whichever worker gets the scrape reports all of them,
+each sample labeled with its worker. The workers are listed in WORKERS_KEY by
+the time of their last snapshot, so a scrape reads only theirs; a worker which
+is gone drops out of it, and its snapshot expires, after a few intervals.
+NGINX does not proxy this endpoint.
+"""
+import os
+import json
+import socket
+import logging
+import multiprocessing
+from time import time
+from contextlib import contextmanager
+
+import asyncio
+from aiohttp import web
+from redis import asyncio as aioredis
+
+from . import config
+from . import model
+from . import fanout
+
+log = logging.getLogger(__name__)
+SNAPSHOT_KEY = 'metrics:%s' # the metrics of a worker
+WORKERS_KEY = 'metrics:workers' # sorted set of the workers scored by the time of their last snapshot
+LAG_PROBE_INTERVAL = 0.1 # seconds between the timers measuring the lag of the event loop
+# seconds
+BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+registry = []
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {} # label values -> value
+        registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[l]) for l in self.labels)
+
+    def samples(self):
+        """yield the name, labels and value of every sample
+        """
+        for key, value in self.values.items():
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        if not labels:
+            self.values[()] = 0 # reported before anything is counted
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        h = self.values.get(key)
+        if h is None:
+            # the counts of the buckets and +Inf, the sum
+            h = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        counts, _ = h
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-1] += 1
+        h[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started_time = time()
+        try:
+            yield
+        finally:
+            self.observe(time() - started_time, **labels)
+
+    def samples(self):
+        for key, (counts, total) in self.values.items():
+            labels = dict(zip(self.labels, key))
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                yield self.name + '_bucket', dict(labels, le=str(bound)), count
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, counts[-1]
+
+
+upload_bytes = Counter('snapfile_upload_bytes_total', 'Bytes of the files uploaded')
+download_bytes = Counter('snapfile_download_bytes_total', 'Bytes of the files downloaded')
+request_seconds = Histogram('snapfile_request_duration_seconds', 'Time to handle a request, a websocket lasts as long as the connection',
+                            labels=('route', 'method', 'status'))
+connections = Gauge('snapfile_websocket_connections', 'Websocket connections')
+folders = Gauge('snapfile_folders_cached', 'Folders opened and cached')
+file_cache_bytes = Gauge('snapfile_file_cache_bytes', 'Decrypted content of the hot files kept in memory')
+file_cache_lookups = Counter('snapfile_file_cache_lookups_total', 'Downloads looked up in the cache of hot files by the result', labels=('result',))
+broadcast_seconds = Histogram('snapfile_broadcast_duration_seconds', 'Time to save a message and publish it to the workers')
+frames = Counter('snapfile_fanout_frames_total', 'Broadcast frames by what became of them', labels=('result',))
+redis_seconds = Histogram('snapfile_redis_rtt_seconds', 'Round trip time of redis measured by PING')
+kdf_wait_seconds = Histogram('snapfile_kdf_wait_seconds', 'Time a key derivation waits for a thread')
+reaper_seconds = Histogram('snapfile_reaper_duration_seconds', 'Time to delete the folders due in a run of the reaper')
+folders_deleted = Counter('snapfile_folders_deleted_total', 'Expired folders deleted')
+deletion_backlog = Gauge('snapfile_deletion_backlog', 'Directories of deleted folders waiting to be deleted or being deleted')
+deletions_running = Gauge('snapfile_deletions_running', 'Directories being deleted by the worker')
+files_deleted = Counter('snapfile_deleted_files_total', 'Files deleted with the directories of deleted folders')
+bytes_deleted = Counter('snapfile_deleted_bytes_total', 'Bytes of the files deleted with the directories of deleted folders')
+volume_free_bytes = Gauge('snapfile_volume_free_bytes', 'Free space of the disk of a volume', labels=('volume',))
+volume_busy = Gauge('snapfile_volume_busy_ratio', 'Fraction of the time the disk of a volume was doing I/O', labels=('volume',))
+folders_moved = Counter('snapfile_folders_moved_total', 'Idle folders moved off a volume which is filling up')
+loop_lag_seconds = Histogram('snapfile_event_loop_lag_seconds', 'How late the event loop runs a timer',
+                             buckets=(.0005,) + BUCKETS)
+
+
+def collect(app):
+    """update the metrics which are read rather than counted
+    return the snapshot of this worker
+    """
+    connections.set(sum(len(f.connections) for f in app['folders'].values()))
+    folders.set(len(app['folders']))
+    file_cache_bytes.set(app['files'].size)
+    file_cache_lookups.values[('hit',)] = app['files'].hits
+    file_cache_lookups.values[('miss',)] = app['files'].misses
+    for result, count in fanout.stats().items():
+        frames.values[(result,)] = count
+    return [{
+        'name': m.name,
+        'type': m.type,
+        'help': m.help,
+        'samples': list(m.samples()),
+    } for m in registry]
+
+
+def render(snapshots):
+    """snapshots: worker -> the metrics collected by the worker
+    return the text format with a worker label added to every sample
+    """
+    families = {}
+    for worker, snapshot in sorted(snapshots.items()):
+        for m in snapshot:
+            family = families.setdefault(m['name'], (m, []))
+            for name, labels, value in m['samples']:
+                family[1].append((name, dict(labels, worker=worker), value))
+    lines = []
+    for m, samples in families.values():
+        lines.append('# HELP {} {}'.format(m['name'], m['help']))
+        lines.append('# TYPE {} {}'.format(m['name'], m['type']))
+        for name, labels, value in samples:
+            label_str = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for k, v in labels.items())
+            lines.append('{}{{{}}} {}'.format(name, label_str, value))
+    return '\n'.join(lines) + '\n'
+
+
+def worker_name():
+    """unique among the hosts sharing the redis, e.g. worker-0@host:1234
+    """
+    return '{}@{}:{}'.format(multiprocessing.current_process().name, socket.gethostname(), os.getpid())
+
+
+async def save_snapshot(app):
+    worker = worker_name()
+    now = time()
+    async with model.redis.pipeline(transaction=True) as tr:
+        tr.set(SNAPSHOT_KEY % worker, json.dumps(collect(app)), ex=config.METRICS_INTERVAL * 3)
+        tr.zadd(WORKERS_KEY, {worker: now})
+        tr.zremrangebyscore(WORKERS_KEY, '-inf', now - config.METRICS_INTERVAL * 3)
+        await tr.execute()
+
+
+async def save_snapshots(app):
+    while True:
+        try:
+            with redis_seconds.time():
+                await model.redis.ping()
+            await save_snapshot(app)
+        except aioredis.ConnectionError as e:
+            log.error('failed to save the metrics: {}'.format(e))
+        await asyncio.sleep(config.METRICS_INTERVAL)
+
+
+async def measure_lag():
+    """a busy event loop runs a timer late, by as long as the callbacks ahead of it take
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        started_time = loop.time()
+        await asyncio.sleep(LAG_PROBE_INTERVAL)
+        loop_lag_seconds.observe(max(0, loop.time() - started_time - LAG_PROBE_INTERVAL))
+
+
+@web.middleware
+async def middleware(request, handler):
+    started_time = time()
+    status = 500
+    try:
+        resp = await handler(request)
+        status = resp.status
+        return resp
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        route = request.match_info.route.resource
+        request_seconds.observe(
+            time() - started_time,
+            # the pattern rather than the path so that the number of series is bounded
+            route=route.canonical if route is not None else 'unmatched',
+            method=request.method,
+            status=status)
+
+
+async def metrics(request):
+    # this worker is always up to date
+    await save_snapshot(request.app)
+    workers = [w.decode('utf-8') for w in await model.redis.zrange(WORKERS_KEY, 0, -1)]
+    snapshots = {}
+    for worker, snapshot in zip(workers, await model.redis.mget([SNAPSHOT_KEY % w for w in workers])):
+        if snapshot:
+            snapshots[worker] = json.loads(snapshot)
+    return web.Response(text=render(snapshots), headers={
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+        'Cache-Control': 'no-store'})
+
+
+async def startup(app):
+    app['metrics_tasks'] = [
+        asyncio.create_task(save_snapshots(app)),
+        asyncio.create_task(measure_lag()),
+    ]
+
+
+async def cleanup(app):
+    for task in app['metrics_tasks']:
+        task.cancel()
+    async with model.redis.pipeline(transaction=True) as tr:
+        tr.delete(SNAPSHOT_KEY % worker_name())
+        tr.zrem(WORKERS_KEY, worker_name())
+        await tr.execute()
@@ -0,0 +1,93 @@
+"""Convert the messages saved as json to binary records (see codec)
+It's safe to run while the server is running: messages are only ever appended,
+so an index always refers to the same message, and an entry is replaced only if
+it's still the json read before.
+usage: snapfile-migrate [--dry-run]
+"""
+import json
+import base64
+import logging
+import argparse
+
+import asyncio
+
+from . import config
+from . import model
+from . import codec
+from .model import Message, Folder
+
+log = logging.getLogger(__name__)
+BATCH = 100 # messages read at a time
+# replace the entry at the index if it's unchanged
+REPLACE = """
+if redis.call('LINDEX', KEYS[1], ARGV[1]) == ARGV[2] then
+    redis.call('LSET', KEYS[1], ARGV[1], ARGV[3])
+    return 1
+end
+return 0
+"""
+
+
+def convert(record, sender):
+    """return the binary record of a message saved as json
+    """
+    msg = Message(**json.loads(record))
+    if config.ENABLE_ENCRYPTION:
+        data_b = base64.b64decode(msg.data)
+    else:
+        data_b = msg.data.encode('utf-8')
+    return codec.pack(msg, sender, data_b, config.ENABLE_ENCRYPTION)
+
+
+async def migrate_folder(identity, replace, dry_run=False):
+    """return the number of messages converted, bytes before and after
+    """
+    _, msg_key = Folder._keys(identity)
+    senders_key = Folder._senders_key(identity)
+    converted = before = after = 0
+    total = await model.redis.llen(msg_key)
+    for offset in range(0, total, BATCH):
+        records = await model.redis.lrange(msg_key, offset, offset + BATCH - 1)
+        for i, record in enumerate(records, offset):
+            if not codec.is_legacy(record):
+                continue
+            sender = 0
+            if not dry_run:
+                sender = await model.intern_sender(keys=[senders_key], args=[json.loads(record)['sender']])
+            new = convert(record, sender)
+            if dry_run or await replace(keys=[msg_key], args=[i, record, new]):
+                converted += 1
+                before += len(record)
+                after += len(new)
+    return converted, before, after
+
+
+async def migrate(dry_run=False):
+    await model.connect()
+    replace = model.redis.register_script(REPLACE)
+    folders = converted = before = after = 0
+    async for key in model.redis.scan_iter(match=Folder._keys('*')[1], count=BATCH):
+        identity = key.decode('utf-8').split(':', 1)[1]
+        c, b, a = await migrate_folder(identity, replace, dry_run)
+        if c:
+            folders += 1
+            converted += c
+            before += b
+            after += a
+            log.info('{} messages converted in folder {}'.format(c, identity))
+    log.info('{} messages in {} folders converted: {} bytes -> {} bytes'.format(
+        converted, folders, before, after))
+    await model.redis.aclose()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s {%(message)s}')
+    parser = argparse.ArgumentParser(prog='snapfile-migrate', description=__doc__.split('\n')[0])
+    parser.add_argument('--dry-run', action='store_true',
+                        help='report what would be converted without writing')
+    args = parser.parse_args()
+    asyncio.run(migrate(args.dry_run))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import os
 import sys
 import json
+import hmac
 import base64
 import hashlib
 import random
@@ -14,17 +15,118 @@ import asyncio
 import aiohttp
 from aiohttp import web
 from redis import asyncio as aioredis
-from concurrent.futures import ThreadPoolExecutor
 
-from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 
 from . import config
+from . import kdf
+from . import fanout
+from . import codec
+from . import metrics
+from . import deletion
+from . import volumes
+from . import tailing
 
 log = logging.getLogger(__name__)
 redis = None
-thread_pools = ThreadPoolExecutor()
+intern_sender = None # a script
+load_folder = None # a script
+create_folder = None # a script
+save_message = None # a script
+reserve_storage = None # a script
+release_storage = None # a script
+claim_blob = None # a script
+EXPIRY_KEY = 'folders:expiry' # sorted set of folder identities scored by their expiration time
+EXPIRY_INDEXED_KEY = '#folders:expiry' # set once all existing folders are indexed
+# pub/sub channels shared by all workers
+BROADCAST_CHANNEL = 'broadcast:%s' # messages to the connections of a folder
+EXPIRED_CHANNEL = 'expired:%s' # the folder is deleted, close its connections
+MOVED_CHANNEL = 'moved:%s' # the folder is moved to the volume published, see volumes.py
+PROGRESS_CHANNEL = 'progress:%s' # how much of a file being uploaded is written, see tailing.py
+# return the index of a sender in a folder, a new sender is given the next index
+INTERN_SENDER = """
+local i = redis.call('HGET', KEYS[1], ARGV[1])
+if i then
+    return tonumber(i)
+end
+i = redis.call('HLEN', KEYS[1])
+redis.call('HSET', KEYS[1], ARGV[1], i)
+return i
+"""
+# return the fields of a folder, a folder saved in json is converted to a hash first
+LOAD_FOLDER = """
+if redis.call('TYPE', KEYS[1]).ok == 'string' then
+    local folder = cjson.decode(redis.call('GET', KEYS[1]))
+    redis.call('DEL', KEYS[1])
+    for k, v in pairs(folder) do
+        if v ~= cjson.null then
+            redis.call('HSET', KEYS[1], k, type(v) == 'number' and string.format('%d', v) or v)
+        end
+    end
+end
+return redis.call('HGETALL', KEYS[1])
+"""
+# create a folder unless it exists: KEYS: folder, expiry
+# ARGV[1] is the identity, ARGV[2] the expiration time and the rest the fields of the folder
+# return whether it's created
+CREATE_FOLDER = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+return 1
+"""
+# append a message to a folder which still exists, count its size and release
+# the storage reserved for it
+# return the length of the history and the size of the folder
+SAVE_MESSAGE = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local length = redis.call('RPUSH', KEYS[2], ARGV[1])
+if tonumber(ARGV[3]) > 0 then
+    redis.call('HINCRBY', KEYS[1], 'reserved', -tonumber(ARGV[3]))
+end
+return {length, redis.call('HINCRBY', KEYS[1], 'current_size', ARGV[2])}
+"""
+# reserve storage of a folder unless the used and reserved storage would exceed the limit
+# return whether it's reserved (-1 if the folder is being moved by ARGV[2]) and the storage
+# used and reserved including it
+RESERVE_STORAGE = """
+local f = redis.call('HMGET', KEYS[1], 'storage_limit', 'current_size', 'reserved', 'moving', 'volume')
+if not f[1] then
+    return false
+end
+if f[4] and tonumber(f[4]) > tonumber(ARGV[2]) then
+    return {-1, 0, ''}
+end
+local used = tonumber(f[2]) + tonumber(f[3] or 0) + tonumber(ARGV[1])
+if used > tonumber(f[1]) then
+    return {0, used, ''}
+end
+redis.call('HINCRBY', KEYS[1], 'reserved', ARGV[1])
+return {1, used, f[5] or ''}
+"""
+# KEYS: blobs, refs
+# ARGV[3] is the CRC-32 of the content, or empty if unknown
+# return the file id of the blob with the digest, which is the new file unless it's a duplicate
+CLAIM_BLOB = """
+local file_id = redis.call('HGET', KEYS[1], ARGV[1])
+if not file_id then
+    file_id = ARGV[2]
+    redis.call('HSET', KEYS[1], ARGV[1], file_id)
+    if ARGV[3] ~= '' then
+        redis.call('HSET', KEYS[2], file_id .. ':crc32', ARGV[3])
+    end
+end
+return file_id
+"""
+RELEASE_STORAGE = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBY', KEYS[1], 'reserved', -tonumber(ARGV[1]))
+end
+"""
 
 
 def delete(path):
@@ -32,6 +134,13 @@ def delete(path):
     shutil.rmtree(path, ignore_errors=True)
     log.info('finish deleting {}'.format(path))
 
+def disk_full(size=0, volume=None):
+    """whether writing size bytes would leave less than MIN_FREE_SPACE on the disk of the volume
+    as of its last sample, see volumes.py
+    """
+    v = volumes.get(volume or volumes.root())
+    return v is not None and v.room() < size
+
 def format_size(num, suffix='B'):
     for unit in ['', 'K','M','G','T','P','E','Z']:
         if abs(num) < 1000.0:
@@ -39,57 +148,168 @@ def format_size(num, suffix='B'):
         num /= 1000.0
     return '%.1f%s%s' % (num, 'Yi', suffix)
 
+async def index_folders():
+    """Add folders created before the expiry index existed to the index
+    SCAN is used instead of KEYS to avoid blocking redis
+    """
+    if await redis.exists(EXPIRY_INDEXED_KEY):
+        return
+    total = 0
+    batch = []
+    async for k in redis.scan_iter(match='folder:*', count=config.REAP_BATCH):
+        batch.append(k)
+        if len(batch) >= config.REAP_BATCH:
+            total += await _index_folders(batch)
+            batch = []
+    if batch:
+        total += await _index_folders(batch)
+    await redis.set(EXPIRY_INDEXED_KEY, 1)
+    log.info('{} folders added to the expiry index'.format(total))
+
+async def _index_folders(keys):
+    mapping = {}
+    identities = [k.decode('utf-8').split(':', 1)[1] for k in keys]
+    for identity, f in zip(identities, await Folder.open_many(identities)):
+        if f is not None:
+            mapping[identity] = f.expire_at.timestamp()
+    if mapping:
+        # nx: do not touch folders which are already indexed
+        await redis.zadd(EXPIRY_KEY, mapping, nx=True)
+    return len(mapping)
+
+async def remove_folders(app, identities):
+    """Permanently delete the given folders
+    """
+    deleted = 0
+    for identity, saved in zip(identities, await Folder.open_many(identities)):
+        trash_path = None
+        if saved is not None:
+            f = app['folders'].peek(identity) or saved
+            if not f.expired:
+                # the folder is renewed with the same identity, re-index it
+                await redis.zadd(EXPIRY_KEY, {identity: f.expire_at.timestamp()})
+                continue
+            log.info('Folder {} expired'.format(identity))
+            # 1. close all connected clients
+            await f.close_all(code=aiohttp.WSCloseCode.GOING_AWAY, message='Deleted')
+            app['folders'].pop(identity, None) # delete if it exists
+            await redis.publish(EXPIRED_CHANNEL % identity, '') # and those of the other workers
+            # 2. move files out of the way, they are deleted in the background, see deletion.py
+            trash_path = await deletion.trash(f.volume, f.path, '{}-{}'.format(identity, int(f.expire_at.timestamp())))
+            deleted += 1
+        # 3. delete data from redis, leaving a tombstone of the files
+        async with redis.pipeline(transaction=True) as tr:
+            tr.delete(*Folder._all_keys(identity))
+            tr.zrem(EXPIRY_KEY, identity)
+            if trash_path is not None:
+                tr.zadd(deletion.TOMBSTONES_KEY, {trash_path: 0})
+            await tr.execute()
+    if deleted:
+        deletion.wakeup()
+    return deleted
+
 async def remove_expired_folders(app):
+    """Delete folders as soon as they expire
+    Folders are indexed by their expiration time in a sorted set, so only folders
+    that are due are touched, at most REAP_BATCH at a time.
+    """
     try:
+        await index_folders()
         while True:
             started_time = time()
-            log.info('start removing expired folders')
-            total, deleted = 0, 0
-            keys = await redis.keys('folder:*')
-            for k in keys:
-                k = k.decode("utf-8")
-                identity = k[k.find(':')+1:]
-                total += 1
-                f = app['folders'].get(identity, None)
-                if f is None:
-                    f = await Folder.open(identity)
-                if not f.expired:
-                    continue
-                deleted += 1
-                log.info('Folder {} expired'.format(identity))
-                # 1. close all connected clients
-                await f.close_all(code=aiohttp.WSCloseCode.GOING_AWAY, message='Deleted')
-                app['folders'].pop(identity, None) # delete if it exists
-                # 2. delete files from disk
-                # do a time consuming task in in a seprate thread and wait for the thread in asyncio
-                # https://stackoverflow.com/a/28492261/6088837
-                path = os.path.join(config.UPLOAD_ROOT_DIRECTORY, f.path)
-                await asyncio.get_event_loop().run_in_executor(thread_pools, delete, path)
-                # 3. delete data from redis
-                await redis.delete(*Folder._keys(identity))
-            log.info('finish removing expired folders')
-            log.info('{} folders found and {} folders deleted pemanently.'.format(total, deleted))
-
-            interval = time() - started_time
-            if interval < config.DELETE_INTERVAL:
-                await asyncio.sleep(config.DELETE_INTERVAL-interval)
+            due = await redis.zrangebyscore(EXPIRY_KEY, '-inf', started_time, start=0, num=config.REAP_BATCH)
+            if due:
+                deleted = await remove_folders(app, [i.decode('utf-8') for i in due])
+                log.info('{} folders deleted in {:.3f}s'.format(deleted, time()-started_time))
+                metrics.reaper_seconds.observe(time() - started_time)
+                metrics.folders_deleted.inc(deleted)
+                if len(due) == config.REAP_BATCH:
+                    continue # there may be more folders due
+            # sleep until the next folder is due
+            delay = config.REAP_INTERVAL
+            head = await redis.zrange(EXPIRY_KEY, 0, 0, withscores=True)
+            if head:
+                delay = min(delay, max(0, head[0][1] - time()))
+            await asyncio.sleep(delay)
     except asyncio.CancelledError:
         log.info('task canceled')
         # todo
     finally:
         pass
 
-async def startup(app):
-    global redis
+async def receive_broadcasts(app):
+    """Deliver what is published by any worker to the connections of this worker
+    Messages published while the subscription is lost are missed, the clients
+    pull them once they notice the gap in the offsets.
+    """
+    while True:
+        try:
+            async with redis.pubsub() as pubsub:
+                await pubsub.psubscribe(BROADCAST_CHANNEL % '*', EXPIRED_CHANNEL % '*', MOVED_CHANNEL % '*',
+                                        PROGRESS_CHANNEL % '*')
+                async for m in pubsub.listen():
+                    if m['type'] != 'pmessage':
+                        continue
+                    channel, _, identity = m['channel'].decode('utf-8').partition(':')
+                    if channel == 'progress':
+                        # followed by the downloads rather than the connections
+                        tailing.receive(identity, m['data'])
+                        continue
+                    folder = app['folders'].peek(identity)
+                    if folder is None:
+                        continue # no connection to this folder in this worker
+                    if channel == 'broadcast':
+                        folder.deliver(m['data'].decode('utf-8'))
+                    elif channel == 'moved':
+                        folder.volume = m['data'].decode('utf-8')
+                    else:
+                        app['folders'].pop(identity, None)
+                        await folder.close_all(code=aiohttp.WSCloseCode.GOING_AWAY, message='Deleted')
+        except aioredis.ConnectionError as e:
+            log.error('lost the subscription to broadcasts: {}'.format(e))
+            await asyncio.sleep(1)
+
+async def reset():
+    """Start from scratch outside of production
+    It runs once before the workers start, not in each of them.
+    """
+    r = await aioredis.from_url(config.REDIS_ADDRESS, db=config.REDIS_DB)
+    await r.flushdb()
+    await r.aclose()
+    for directory in volumes.directories():
+        delete(directory)
+
+
+async def connect():
+    global redis, intern_sender, load_folder, save_message, reserve_storage, release_storage
+    global claim_blob, create_folder
     redis = await aioredis.from_url(config.REDIS_ADDRESS, db=config.REDIS_DB)
-    if not config.PROD:
-        await redis.flushdb()
-        delete(config.UPLOAD_ROOT_DIRECTORY)
+    intern_sender = redis.register_script(INTERN_SENDER)
+    load_folder = redis.register_script(LOAD_FOLDER)
+    create_folder = redis.register_script(CREATE_FOLDER)
+    save_message = redis.register_script(SAVE_MESSAGE)
+    reserve_storage = redis.register_script(RESERVE_STORAGE)
+    release_storage = redis.register_script(RELEASE_STORAGE)
+    claim_blob = redis.register_script(CLAIM_BLOB)
+
+
+async def startup(app):
+    await connect()
     # makedirs (not mkdir) so an isolated, possibly nested upload root (e.g. the
     # e2e SNAPFILE_UPLOAD) can be created even if its parent doesn't exist yet.
     os.makedirs(config.UPLOAD_ROOT_DIRECTORY, exist_ok=True)
     # add some quick or long running tasks
-    asyncio.create_task(remove_expired_folders(app))
+    app['tasks'] = [
+        asyncio.create_task(remove_expired_folders(app)),
+        asyncio.create_task(receive_broadcasts(app)),
+    ]
+
+
+async def cleanup(app):
+    for task in app['tasks']:
+        task.cancel()
+    await asyncio.wait(app['tasks'])
+    await redis.aclose()
 
 
 class MsgType(IntEnum):
@@ -127,6 +347,8 @@ class Folder:
                  storage_limit=config.STORAGE_PER_FOLDER,
                  current_size=0,
                  path=None,
+                 salt=None,
+                 volume=None,
                  **kwargs):
         self.identity = identity
         self.encryption_key = encryption_key
@@ -135,13 +357,17 @@ class Folder:
         self.storage_limit = storage_limit
         self.current_size = current_size
         self.path = path
+        self.salt = salt # hex of the salt used to derive the key from the passcode
+        # the directory of the disk holding the files, see volumes.py
+        self.volume = volumes.root() if volume is None else os.path.abspath(volume)
         if path is None:
             self.path = os.path.join(
                 str(random.randint(1, config.UPLOAD_SECOND_DIRECTORY_RANGE)),
                 self.identity)
             shutil.rmtree(self.path, ignore_errors=True)
-            os.makedirs(os.path.join(config.UPLOAD_ROOT_DIRECTORY, self.path))
+            os.makedirs(os.path.join(self.volume, self.path))
         self.connections = set() # holds all active websocket connections
+        self.senders = {} # sender -> index, see intern_sender
 
     @property
     def usage_percentage(self):
@@ -167,26 +393,57 @@ class Folder:
         }
 
     def serialize(self):
-        """return a serialized str
+        """return the fields saved in the hash of the folder
         """
         o = dict(self.__dict__)
         del o['connections']
+        del o['senders']
         del o['encryption_key']
-        return json.dumps(o)
+        return {k: v for k, v in o.items() if v is not None}
+
+    @classmethod
+    def deserialize(cls, fields):
+        """fields: the flat list of field names and values returned by HGETALL
+        """
+        o = {k.decode('utf-8'): v.decode('utf-8') for k, v in zip(fields[::2], fields[1::2])}
+        o.pop('reserved', None) # only counted in redis, see reserve
+        for k in ('age', 'storage_limit', 'current_size'):
+            o[k] = int(o[k])
+        return cls(**o)
+
+    async def refresh(self):
+        """read the size which is counted by all workers
+        """
+        size = await redis.hget(self._keys(self.identity)[0], 'current_size')
+        if size is not None:
+            self.current_size = int(size)
+
+    def get_salt(self):
+        if self.salt is None:
+            # folders created before the salt was stored
+            return self.identity.encode('ascii')
+        return bytes.fromhex(self.salt)
 
     def get_file_path(self, file_id=None):
         """rename uploaded file using file id to
         1. avoid overwritting by files with the same name
         2. special character support by browswer
         """
+        if file_id is None:
+            return self.path
         return os.path.join(
             self.path,
             file_id)
 
+    def get_volume_path(self, file_id=None):
+        """the path of a file (or the folder) including its volume
+        """
+        return os.path.join(self.volume, self.get_file_path(file_id))
+
     async def gen_file_id(self):
         """Generate a new file id
         """
-        file_id = await redis.incr('#files:{}'.format(self.identity))
+        file_id = await redis.incr(self._all_keys(self.identity)[2])
         return str(file_id)
 
     def get_cipher(self, nonce=None):
@@ -195,41 +452,147 @@ class Folder:
         algorithm = algorithms.ChaCha20(self.encryption_key, nonce)
         return Cipher(algorithm, mode=None), nonce
 
+    def get_decryptor(self, nonce, offset=0):
+        """return a decryptor positioned at the given offset of the stream
+        ChaCha20 is seekable: OpenSSL treats the first 8 bytes of the 16-byte nonce
+        as a little-endian block counter, so the keystream starting from block n is
+        produced by adding n to the counter, without going through the previous blocks.
+        """
+        counter = (int.from_bytes(nonce[:8], 'little') + offset // 64) % 2**64
+        cipher, _ = self.get_cipher(counter.to_bytes(8, 'little') + nonce[8:])
+        decryptor = cipher.decryptor()
+        decryptor.update(bytes(offset % 64)) # skip to the offset within the block
+        return decryptor
+
+    def get_encryptor(self, nonce, offset=0):
+        """return an encryptor positioned at the given offset of the stream
+        so that chunks of a file can be encrypted independently and in any order
+        """
+        # a stream cipher encrypts and decrypts with exactly the same operation
+        return self.get_decryptor(nonce, offset)
+
+    def get_digest(self):
+        """return a HMAC of the content of a file to find duplicates
+        It's keyed so that the digests in redis tell nothing about the content.
+        """
+        key = hmac.new(bytes(self.encryption_key), b'dedup', hashlib.sha256).digest()
+        return hmac.new(key, digestmod=hashlib.sha256)
+
+    async def dedup(self, digest, file_id, crc32=None):
+        """Refer to the blob with the same content if any
+        return the file id of the blob, which is file_id unless it's a duplicate
+        A blob is shared by all messages of the same content. It's not counted
+        how many since messages are only deleted with their folder, which deletes
+        the blobs and their files at once.
+        The CRC-32 of the content is recorded with a new blob for ZIP archives.
+        """
+        blob_id = await claim_blob(keys=self._blob_keys(self.identity),
+                                   args=[digest, file_id, '' if crc32 is None else crc32])
+        return blob_id.decode('utf-8')
+
+    async def get_crc32(self, file_ids):
+        """return the CRC-32 of the content of the files, None if it's not recorded
+        """
+        if not file_ids:
+            return []
+        values = await redis.hmget(self._blob_keys(self.identity)[1], ['{}:crc32'.format(i) for i in file_ids])
+        return [None if v is None else int(v) for v in values]
+
+    async def set_crc32(self, crcs):
+        """record the CRC-32 of files, file id -> CRC-32
+        """
+        if crcs:
+            await redis.hset(self._blob_keys(self.identity)[1],
+                             mapping={'{}:crc32'.format(i): crc for i, crc in crcs.items()})
+
     def connect(self, ws):
+        ws['outbox'] = fanout.Outbox(ws)
         self.connections.add(ws)
 
     def disconnect(self, ws):
-        self.connections.discard(ws)
+        if ws in self.connections:
+            self.connections.discard(ws)
+            ws['outbox'].close()
 
     async def close_all(self, code=aiohttp.WSCloseCode.GOING_AWAY, message=''):
         log.info('close {} websocket connections'.format(len(self.connections)))
         for ws in list(self.connections):
             await ws.close(code=code, message=message)
 
-    async def save(self, msg):
+    async def reserve(self, size):
+        """Reserve storage for an upload of size bytes before receiving it
+        Reservations are counted in redis with the storage used, so concurrent
+        uploads through any workers can not exceed the storage limit together.
+        A reservation is either turned into used storage by save or given back
+        by release.
+        The volume recorded with the reservation is the one written to: the folder
+        can not be moved while storage is reserved, but MOVED_CHANNEL may not have
+        told this worker about a move which happened before.
+        """
+        if disk_full(size, self.volume):
+            log.warning('Disk is full: {} bytes refused'.format(size))
+            raise web.HTTPInsufficientStorage(text='Disk is full, please contact the admin! Thanks.')
+        r = await reserve_storage(keys=[self._keys(self.identity)[0]], args=[size, time()])
+        if r is None:
+            raise web.HTTPUnauthorized() # deleted
+        ok, used, volume = r
+        if ok == -1:
+            log.warning('Folder {} is being moved: {} bytes refused'.format(self.identity, size))
+            raise web.HTTPServiceUnavailable(headers={'Retry-After': '60'}, text='The folder is being moved, please try again later.')
+        if not ok:
+            log.warning('Storage limit exceeds: {} > {}'.format(used, self.storage_limit))
+            raise web.HTTPRequestHeaderFieldsTooLarge()
+        volume = volume.decode('utf-8')
+        if volume and volume != self.volume:
+            self.volume = volume
+            # moved meanwhile
+            if disk_full(size, self.volume):
+                await self.release(size)
+                log.warning('Disk is full: {} bytes refused'.format(size))
+                raise web.HTTPInsufficientStorage(text='Disk is full, please contact the admin! Thanks.')
+
+    async def release(self, size):
+        """give back the storage reserved for an upload which is aborted
+        """
+        await release_storage(keys=[self._keys(self.identity)[0]], args=[size])
+
+    async def save(self, msg, reserved=0, stored=None):
         """Save the message in this folder
+        reserved: the storage reserved for the message, which is released
+        stored: the bytes stored for the message, msg.size by default
+        return the index of the message in the history or None if failed
         """
+        data_b = msg.data.encode('utf-8')
         if config.ENABLE_ENCRYPTION:
-            msg = Message(**msg)
             cipher, nonce = self.get_cipher()
             encryptor = cipher.encryptor()
-            data_b = nonce + encryptor.update(msg.data.encode('utf-8'))
-            msg.data = base64.b64encode(data_b).decode('ascii') # convert to str to fit in json. https://stackoverflow.com/a/40000564
-        folder_key, msg_key = self._keys(self.identity)
-        async with redis.pipeline(transaction=True) as tr:
-            # enqueue: "If key does not exist, it is created as empty"
-            tr.rpush(msg_key, json.dumps(msg))
-            # update total used size
-            self.current_size += msg.size
-            tr.set(folder_key, self.serialize())
-            ok1, ok2 = await tr.execute()
-            if not (ok1 and ok2):
-                log.error('transaction failed')
-                return False
-        return True
-
-    async def send(self, msg):
-        await self.save(msg)
+            data_b = nonce + encryptor.update(data_b)
+        record = codec.pack(msg, await self.intern_sender(msg.sender), data_b, config.ENABLE_ENCRYPTION)
+        # the size is added up in redis so that concurrent uploads are all counted
+        r = await save_message(keys=self._keys(self.identity), args=[record, msg.size if stored is None else stored, reserved])
+        if r is None:
+            log.error('folder {} is deleted'.format(self.identity))
+            return None
+        length, self.current_size = r
+        return length - 1
+
+    async def send(self, msg, reserved=0, stored=None):
+        """Save the message and broadcast it to the connections of all workers
+        """
+        with metrics.broadcast_seconds.time():
+            # the index lets a client merge the message with the pages it has pulled
+            offset = await self.save(msg, reserved, stored)
+            # encoded once for all connections
+            data = fanout.encode({
+                'action': 'send',
+                'offset': offset,
+                'msgs': [msg.format_for_view()]
+            })
+            await redis.publish(BROADCAST_CHANNEL % self.identity, data)
+
+    def deliver(self, data):
+        """queue a broadcast to the connections of this worker
+        """
         for ws in list(self.connections):
             if ws.closed:
                 self.disconnect(ws)
@@ -252,37 +615,81 @@ class Folder:
                 self.disconnect(ws)
                 log.warning('{} is lost due to {}'.format(ws['name'], ws.close_code))
             else:
-                await ws.send_json({
-                    'action': 'send',
-                    'msgs': [msg.format_for_view()]
-                })
+                # queued without waiting, a slow connection does not hold up the others
+                ws['outbox'].put(data)
 
-    async def retrieve(self, offset):
-        if offset < 0:
+    async def retrieve(self, offset, limit):
+        """return at most limit messages starting from offset and the total number of messages
+        """
+        if offset < 0 or limit < 0:
             raise web.HTTPBadRequest
         _, msg_key = self._keys(self.identity)
         # suppose total is the length of the message queue
         # offset > total occurs when the folder (identified by the id) is renewed (still empty) in the server
         # but the client holds messages belonging to the old folder
         # this should be fine because lrange will return an empty list
-        msgs_json = await redis.lrange(msg_key, offset, -1)
-        results = []
-        for m in msgs_json:
-            msg = Message(**json.loads(m))
+        if limit == 0:
+            return [], await redis.llen(msg_key)
+        # no transaction needed as both the messages and the senders are only appended
+        # besides, redis-py fails to parse HGETALL in a transaction
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.lrange(msg_key, offset, offset + limit - 1)
+            pipe.llen(msg_key)
+            pipe.hgetall(self._senders_key(self.identity))
+            records, total, senders = await pipe.execute()
+        senders = {int(i): name.decode('utf-8') for name, i in senders.items()}
+        results = [self._decode(record, senders) for record in records]
+        return results, total
+
+    async def intern_sender(self, sender):
+        """return the index of a sender in this folder
+        """
+        if sender not in self.senders:
+            self.senders[sender] = await intern_sender(keys=[self._senders_key(self.identity)], args=[sender])
+        return self.senders[sender]
+
+    def _decode(self, record, senders):
+        if codec.is_legacy(record):
+            msg = Message(**json.loads(record))
             if config.ENABLE_ENCRYPTION:
                 data_b = base64.b64decode(msg.data)
                 nonce = data_b[:16]
                 cipher, nonce = self.get_cipher(nonce)
                 decryptor = cipher.decryptor()
                 msg.data = decryptor.update(data_b[16:]).decode('utf-8')
-            # unfortunately, we could not use generator here: TypeError: object async_generator can't be used in 'await' expression
-            results.append(msg)
-        return results
-  
+            return msg
+        fields, encrypted = codec.unpack(record)
+        fields['sender'] = senders.get(fields['sender'], 'Unknown')
+        data_b = fields['data']
+        if encrypted:
+            cipher, nonce = self.get_cipher(data_b[:16])
+            data_b = cipher.decryptor().update(data_b[16:])
+        fields['data'] = data_b.decode('utf-8')
+        return Message(**fields)
+
     @staticmethod
     def _keys(identity):
         return 'folder:%s' % identity, 'messages:%s' % identity
 
+    @classmethod
+    def _all_keys(cls, identity):
+        """all keys of a folder, to be deleted when it expires
+        """
+        return cls._keys(identity) + ('#files:%s' % identity, cls._senders_key(identity)) + cls._blob_keys(identity) + \
+            (cls._segments_key(identity),)
+
+    @staticmethod
+    def _senders_key(identity):
+        return 'senders:%s' % identity
+
+    @staticmethod
+    def _segments_key(identity):
+        return 'segments:%s' % identity
+
+    @staticmethod
+    def _blob_keys(identity):
+        return 'blobs:%s' % identity, 'refs:%s' % identity
+
     @staticmethod
     def _gen_hash(identity):
         '''Given the passcode, generate a hash
@@ -297,54 +704,60 @@ class Folder:
         '''
         return hashlib.sha3_256(identity.encode('utf-8')).hexdigest()[0:-1:4]
 
-    @staticmethod
-    def _gen_encryption_key(passcode):
-        """generate a 32-byte key used for symmethric encryption
-        """
-        salt = os.urandom(16)
-        kdf = PBKDF2HMAC(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=salt,
-            iterations=480000,
-        )
-        return kdf.derive(passcode.encode('utf-8'))
-
     @classmethod
-    async def create(cls, passcode, age=None):
+    async def create(cls, passcode, age=None, client=None):
+        """create a folder and derive its key
+        the key is derived before the folder is saved, so a derivation refused by
+        the key derivation service leaves no folder behind
+        """
         identity = cls._gen_hash(passcode)
         if await cls._exists(identity):
             # Anti brute force must be employed to disable this exploitation
             raise web.HTTPConflict(text='Identity conflicts, please try again!')
-        if False:
+        volume = volumes.place()
+        if volume is None:
             raise web.HTTPInsufficientStorage(text='Disk is full, please contact the admin! Thanks.')
-        folder = Folder(identity, age)
+        # the salt is fixed for the lifetime of the folder so that every worker derives the same key
+        folder = Folder(identity, age, salt=os.urandom(16).hex(), volume=volume)
+        folder.encryption_key = bytearray(await kdf.derive(passcode, folder.get_salt(), client))
         folder_key, msg_key = cls._keys(identity)
-        # we might save a Folder object as a hashmap (i.e., a dict)
-        # but all field values are strings
-        # save as a json object is more convenient
-        await redis.set(folder_key, folder.serialize())
+        # a hash rather than json so that a field is updated on its own
+        fields = [x for item in folder.serialize().items() for x in item]
+        if not await create_folder(keys=[folder_key, EXPIRY_KEY], args=[identity, folder.expire_at.timestamp(), *fields]):
+            # created by someone else while the key was derived
+            raise web.HTTPConflict(text='Identity conflicts, please try again!')
         log.info('Create a new folder {}'.format(identity))
-        return True
+        return folder
 
     @classmethod
-    async def login(cls, passcode):
+    async def login(cls, passcode, client=None):
         identity = cls._gen_hash(passcode) # the raw passcode is never persisted
         folder = await cls.open(identity)
         if folder is not None:
-            folder.encryption_key = cls._gen_encryption_key(passcode)
+            # PBKDF2 is slow by design, so it's derived off the event loop
+            # a bytearray can be wiped when the folder is evicted from the cache
+            folder.encryption_key = bytearray(await kdf.derive(passcode, folder.get_salt(), client))
         return folder
 
     @classmethod
     async def open(cls, identity):
         folder_key, _ = cls._keys(identity)
-        folder_json = await redis.get(folder_key)
-        if folder_json:
-            folder_dict = json.loads(folder_json)
-            return Folder(**folder_dict)
+        fields = await load_folder(keys=[folder_key])
+        if fields:
+            return cls.deserialize(fields)
         else:
             return None
 
+    @classmethod
+    async def open_many(cls, identities):
+        """return the folders in one round trip, None for those not found
+        """
+        async with redis.pipeline(transaction=False) as pipe:
+            for identity in identities:
+                await load_folder(keys=[cls._keys(identity)[0]], client=pipe)
+            results = await pipe.execute()
+        return [cls.deserialize(fields) if fields else None for fields in results]
+
     @classmethod
     async def _exists(cls, identity):
         folder_key, _ = cls._keys(identity)
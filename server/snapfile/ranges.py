@@ -0,0 +1,122 @@
+"""HTTP range requests (RFC 7233) for responses whose body is produced by us
+e.g. decrypted files, which can not be served by FileResponse or NGINX
+"""
+import os
+import logging
+from email.utils import formatdate
+
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+MAX_RANGES = 16 # more ranges than this in a request are served as a whole file
+
+
+def etag_of(stat):
+    """a strong validator of a file on disk
+    """
+    return '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+
+
+def last_modified_of(stat):
+    return formatdate(stat.st_mtime, usegmt=True)
+
+
+def parse_range(request, size, etag=None, mtime=None):
+    """Return the list of (start, end) byte ranges (end is exclusive) to send,
+    or None if the whole representation should be sent with 200.
+    Overlapping ranges are merged. Raise 416 if no range can be satisfied.
+    """
+    header = request.headers.get('Range')
+    if header is None:
+        return None
+    if not if_range_matches(request, etag, mtime):
+        return None
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        start, sep, end = spec.strip().partition('-')
+        if not sep:
+            return None # syntactically invalid, ignore the header
+        try:
+            if start:
+                start = int(start)
+                if end:
+                    end = int(end) + 1
+                    if end <= start:
+                        return None
+                else:
+                    end = size
+            else:
+                # suffix range: the last n bytes
+                suffix = int(end)
+                if suffix == 0:
+                    continue
+                start, end = max(0, size - suffix), size
+        except ValueError:
+            return None
+        if start >= size:
+            continue # unsatisfiable
+        ranges.append((start, min(end, size)))
+    if not ranges:
+        raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': 'bytes */{}'.format(size)})
+    if len(ranges) > MAX_RANGES:
+        log.warning('too many ranges: {}'.format(len(ranges)))
+        return None
+    return merge(ranges)
+
+
+def merge(ranges):
+    """merge overlapping ranges, keep the order of the others as requested
+    """
+    merged = []
+    for start, end in ranges:
+        for i, (s, e) in enumerate(merged):
+            if start <= e and s <= end:
+                merged[i] = (min(s, start), max(e, end))
+                break
+        else:
+            merged.append((start, end))
+    if len(merged) < len(ranges):
+        return merge(merged)
+    return merged
+
+
+def if_range_matches(request, etag, mtime):
+    """A range request with If-Range is only served partially if the
+    representation has not changed since the client got the first part.
+    """
+    if_range = request.headers.get('If-Range')
+    if if_range is None:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # weak validators can not be used with If-Range
+        return etag is not None and if_range == etag
+    if mtime is None or request.if_range is None:
+        return False
+    return int(mtime) <= request.if_range.timestamp()
+
+
+def content_range(start, end, size):
+    return 'bytes {}-{}/{}'.format(start, end - 1, size)
+
+
+class Multipart:
+    """The layout of a multipart/byteranges body
+    All part headers are known up front, so is the Content-Length.
+    """
+    def __init__(self, ranges, size, content_type):
+        self.boundary = os.urandom(16).hex()
+        self.content_type = 'multipart/byteranges; boundary={}'.format(self.boundary)
+        self.parts = []
+        for start, end in ranges:
+            head = '--{}\r\nContent-Type: {}\r\nContent-Range: {}\r\n\r\n'.format(
+                self.boundary, content_type, content_range(start, end, size))
+            self.parts.append((head.encode('ascii'), start, end))
+        self.tail = '--{}--\r\n'.format(self.boundary).encode('ascii')
+
+    @property
+    def content_length(self):
+        return sum(len(head) + end - start + 2 for head, start, end in self.parts) + len(self.tail)
@@ -0,0 +1,105 @@
+"""Packed storage of small files
+Stored on its own, every small file (screenshots, snippets) costs an inode, an
+open and a close, and as many unlinks when its folder is deleted. A file of up to
+SEGMENT_MAX_FILE_SIZE is instead appended to a segment of its folder: a file named
+segment-<n> in the directory of the folder, of up to SEGMENT_SIZE bytes. It's
+stored there as it would be on its own (see compression.py) and read by slicing
+the segment.
+Space is allocated in redis, so the workers append to the same segment without
+overlapping, and the index of the folder maps a file id to its segment, offset,
+length and the time it's written. Segments are never rewritten, they are deleted
+with the directory of the folder.
+"""
+import os
+from time import time_ns
+from collections import namedtuple
+
+import asyncio
+
+from . import config
+from . import model
+from .transfer import io_pools, DownloadSource
+
+SEGMENT_NAME = 'segment-%d'
+# KEYS: the index of a folder
+# allocate ARGV[1] bytes at the end of the last segment, or of a new one if it
+# would grow beyond ARGV[2]
+# return the segment and the offset
+ALLOCATE = """
+local f = redis.call('HMGET', KEYS[1], 'segment', 'tail')
+local segment = tonumber(f[1] or 0)
+local tail = tonumber(f[2] or 0)
+if tail > 0 and tail + tonumber(ARGV[1]) > tonumber(ARGV[2]) then
+    segment = segment + 1
+    tail = 0
+end
+redis.call('HSET', KEYS[1], 'segment', segment, 'tail', tail + tonumber(ARGV[1]))
+return {segment, tail}
+"""
+allocate = None # a script
+# the stat of a file in a segment, which is what its validators need (see ranges.py)
+Stat = namedtuple('Stat', ('st_size', 'st_mtime', 'st_mtime_ns'))
+
+
+def segment_path(folder, segment):
+    return os.path.join(folder.get_volume_path(), SEGMENT_NAME % segment)
+
+
+async def append(folder, file_id, data):
+    """store a file in a segment of a folder
+    """
+    key = model.Folder._segments_key(folder.identity)
+    segment, offset = await allocate(keys=[key], args=[len(data), config.SEGMENT_SIZE])
+    await asyncio.get_running_loop().run_in_executor(
+        io_pools, _write, segment_path(folder, segment), offset, data)
+    # indexed once it's written, so it's never read before
+    await model.redis.hset(key, file_id, '{} {} {} {}'.format(segment, offset, len(data), time_ns()))
+
+
+def _write(path, offset, data):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+    finally:
+        os.close(fd)
+
+
+async def lookup(folder, file_id):
+    """return the segment, the offset and the Stat of a file or None if it's not in a segment
+    """
+    entry = await model.redis.hget(model.Folder._segments_key(folder.identity), file_id)
+    if entry is None:
+        return None
+    segment, offset, length, mtime_ns = map(int, entry.split())
+    return segment, offset, Stat(length, mtime_ns / 1e9, mtime_ns)
+
+
+async def stat(folder, file_id):
+    entry = await lookup(folder, file_id)
+    return entry and entry[2]
+
+
+async def open_file(folder, file_id):
+    """open a file in a segment to be read like a file on its own
+    return a DownloadSource or None if it's not in a segment
+    """
+    entry = await lookup(folder, file_id)
+    if entry is None:
+        return None
+    segment, offset, stat = entry
+    return await DownloadSource.open(segment_path(folder, segment), offset, stat)
+
+
+async def discard(folder, file_id):
+    """forget a file, e.g. a duplicate, its space in the segment is not reused
+    """
+    await model.redis.hdel(model.Folder._segments_key(folder.identity), file_id)
+
+
+async def startup(app):
+    global allocate
+    allocate = model.redis.register_script(ALLOCATE)
@@ -0,0 +1,147 @@
+"""Downloads of the files which are still being uploaded
+An upload of TAIL_MIN_SIZE or more is announced to the connections of its folder
+when it starts, so that the other devices can download the file while it's
+written instead of after it, and again when it's committed or aborted. Such a download reads the temp file of the upload
+and, when it catches up with the writer, waits to be told there is more: by the
+upload itself in the same worker, through PROGRESS_CHANNEL in the others. The
+file on disk is never polled.
+A download ends with the upload. It's cut short if the upload is aborted or makes
+no progress for TAIL_TIMEOUT, so the client can tell it's incomplete.
+"""
+import logging
+
+import asyncio
+
+from . import config
+from . import model
+from . import fanout
+
+log = logging.getLogger(__name__)
+PROGRESS_KEY = 'progress:%s:%s' # bytes written of a file being uploaded, expires if the upload stalls
+# the states of an upload
+WRITING = 'writing'
+COMMITTED = 'committed'
+ABORTED = 'aborted'
+progresses = {} # (identity, file id) -> Progress of the uploads in this worker or followed by it
+
+
+class Progress:
+    """How much of a file being uploaded is on disk
+    """
+    def __init__(self, written=0, local=False):
+        self.written = written # bytes of the file, the header included
+        self.state = WRITING
+        self.local = local # whether the upload is in this worker
+        self.readers = 0 # downloads following it
+        self.changed = asyncio.Event()
+
+    def update(self, written, state=WRITING):
+        self.written = max(self.written, written)
+        self.state = state
+        # wake up the downloads waiting, the next ones wait for the next change
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def wait(self, position):
+        """wait until more than position bytes of the file are written
+        return False if there is nothing more to read: the upload is over, or
+        stalled for TAIL_TIMEOUT
+        """
+        while self.written <= position:
+            if self.state != WRITING:
+                return False
+            try:
+                await asyncio.wait_for(self.changed.wait(), config.TAIL_TIMEOUT)
+            except asyncio.TimeoutError:
+                return False
+        return self.state != ABORTED
+
+
+class Upload:
+    """An upload which can be followed by downloads
+    """
+    def __init__(self, identity, msg):
+        self.identity = identity
+        self.msg = msg # the FILE message sent once it's committed, the size is an estimate until then
+        self.key = (identity, str(msg.file_id))
+        self.progress = Progress(local=True)
+
+    async def start(self, written):
+        """announce the upload once the header of the file is written
+        """
+        progresses[self.key] = self.progress
+        self.progress.update(written)
+        await publish(self.identity, self.key[1], written, WRITING, self.msg)
+
+    async def update(self, written):
+        self.progress.update(written)
+        await publish(self.identity, self.key[1], written, WRITING)
+
+    async def finish(self, committed):
+        """the upload is committed (the FILE message is sent next) or aborted
+        """
+        state = COMMITTED if committed else ABORTED
+        self.progress.update(self.progress.written, state)
+        progresses.pop(self.key, None)
+        await publish(self.identity, self.key[1], self.progress.written, state, self.msg)
+
+
+async def publish(identity, file_id, written, state, msg=None):
+    """tell the downloads in all workers how much of a file is written
+    The upload is announced to the connections of the folder too if msg is given.
+    A resumable upload has no Upload since its chunks may land on any worker, it
+    publishes its progress directly, see views.upload_chunk.
+    """
+    key = PROGRESS_KEY % (identity, file_id)
+    async with model.redis.pipeline(transaction=False) as pipe:
+        if state == WRITING:
+            pipe.set(key, written, ex=config.TAIL_TIMEOUT)
+        else:
+            pipe.delete(key)
+        pipe.publish(model.PROGRESS_CHANNEL % identity, '{} {} {}'.format(file_id, written, state))
+        if msg is not None:
+            pipe.publish(model.BROADCAST_CHANNEL % identity, fanout.encode({
+                'action': 'uploading',
+                'state': state,
+                'msgs': [msg.format_for_view()]
+            }))
+        await pipe.execute()
+
+
+async def follow(identity, file_id):
+    """start following the upload of a file
+    return its Progress or None if the file is not being uploaded
+    """
+    key = (identity, file_id)
+    progress = progresses.get(key)
+    if progress is None:
+        # updated through PROGRESS_CHANNEL from now on, so nothing is missed after the key is read
+        progress = progresses[key] = Progress()
+    progress.readers += 1
+    if not progress.local:
+        written = await model.redis.get(PROGRESS_KEY % key)
+        if written is not None:
+            progress.update(int(written), progress.state)
+        elif progress.written == 0:
+            unfollow(identity, file_id)
+            return None
+    return progress
+
+
+def unfollow(identity, file_id):
+    key = (identity, file_id)
+    progress = progresses.get(key)
+    if progress is None:
+        return
+    progress.readers -= 1
+    if not progress.local and progress.readers == 0:
+        del progresses[key]
+
+
+def receive(identity, data):
+    """the progress of an upload in another worker
+    """
+    file_id, written, state = data.decode('utf-8').split()
+    progress = progresses.get((identity, file_id))
+    if progress is not None and not progress.local:
+        progress.update(int(written), state)
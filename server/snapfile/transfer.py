@@ -0,0 +1,435 @@
+import io
+import os
+import sys
+import zlib
+import errno
+import logging
+from time import time
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
+from aiohttp import web
+
+from . import config
+from . import metrics
+from . import compression
+
+log = logging.getLogger(__name__)
+# blocking file io and the cipher run here instead of on the event loop
+io_pools = ThreadPoolExecutor(max_workers=config.IO_WORKERS, thread_name_prefix='io')
+
+
+class FileWriter:
+    """Write a stream of chunks to a file in worker threads
+    Chunks are encrypted and written to disk by a writer task in io_pools while
+    the next chunk is being received on the event loop (double buffering).
+    At most UPLOAD_INFLIGHT chunks are buffered, write() waits when the buffer is
+    full, which in turn stops reading from the socket (backpressure).
+    Subclasses decide where the data goes by implementing _open, _commit and _abort,
+    which run in io_pools.
+    If compress is set, each chunk is compressed into a frame before it's encrypted,
+    see compression.py.
+    on_written(written) is awaited after each chunk is on disk, e.g. to tell the
+    downloads following the file, see tailing.py.
+    """
+    def __init__(self, encryptor=None, digest=None, compress=False, on_written=None):
+        self.encryptor = encryptor
+        self.digest = digest # updated with the plain content
+        self.compress = compress
+        self.on_written = on_written
+        self.size = 0 # bytes received, excluding any header
+        self.written = 0 # bytes written to the file, including any header
+        self.crc32 = 0 # of the plain content, for ZIP archives
+        self.file = None
+        self.queue = asyncio.Queue(maxsize=config.UPLOAD_INFLIGHT)
+        self.writer = None
+        self.aborted = False
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        self.file = await loop.run_in_executor(io_pools, self._open)
+        self.writer = asyncio.create_task(self._write_all())
+
+    async def write(self, chunk):
+        self.size += len(chunk)
+        metrics.upload_bytes.inc(len(chunk))
+        await self._put(chunk)
+
+    async def commit(self):
+        """Flush all buffered chunks and close the file
+        return the number of bytes written
+        """
+        await self._put(None)
+        await self.writer
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(io_pools, self._commit)
+        return self.size
+
+    async def abort(self):
+        """Discard what has been written
+        Wait for the chunk being written, if any, so the file is never closed
+        while a worker thread is still using it.
+        """
+        self.aborted = True
+        if self.writer is not None:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+            await asyncio.wait([self.writer])
+            if not self.writer.cancelled() and self.writer.exception() is not None:
+                log.warning('failed to write {}: {}'.format(self.file.name, self.writer.exception()))
+        if self.file is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(io_pools, self._abort)
+
+    async def _put(self, chunk):
+        if self.writer.done():
+            self.writer.result() # raise whatever stopped the writer
+        if not self.queue.full():
+            self.queue.put_nowait(chunk)
+            return
+        # wait for a free slot, or the writer dying
+        put = asyncio.ensure_future(self.queue.put(chunk))
+        await asyncio.wait([put, self.writer], return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            self.writer.result()
+
+    async def _write_all(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await self.queue.get()
+            if chunk is None or self.aborted:
+                break
+            self.written += await loop.run_in_executor(io_pools, self._write, chunk)
+            if self.on_written is not None:
+                await self.on_written(self.written)
+
+    def _write(self, chunk):
+        if self.digest is not None:
+            self.digest.update(chunk)
+        self.crc32 = zlib.crc32(chunk, self.crc32)
+        if self.compress:
+            chunk = compression.frame(chunk)
+        if self.encryptor is not None:
+            chunk = self.encryptor.update(chunk)
+        self.file.write(chunk)
+        if self.on_written is not None:
+            self.file.flush() # visible to the readers of the file
+        return len(chunk)
+
+    def _open(self):
+        raise NotImplementedError
+
+    def _commit(self):
+        self.file.close()
+
+    def _abort(self):
+        self.file.close()
+
+
+class UploadSink(FileWriter):
+    """Write an uploaded file
+    The file is written to a temp name and atomically renamed by commit(), so an
+    aborted upload never leaves a partial file behind.
+    """
+    def __init__(self, path, encryptor=None, header=b'', size_hint=None, digest=None, compress=False, on_written=None):
+        super().__init__(encryptor, digest, compress, on_written)
+        self.path = path
+        self.tmp_path = path + '.part'
+        self.header = header
+        self.size_hint = size_hint
+        self.written = len(header)
+
+    def _open(self):
+        f = create_file(self.tmp_path, len(self.header) + self.size_hint if self.size_hint else 0)
+        f.write(self.header)
+        f.flush()
+        return f
+
+    def _commit(self):
+        # release the blocks preallocated beyond what has been written
+        self.file.truncate()
+        if self.compress:
+            # the size of the content is only known now
+            self.file.seek(0)
+            self.file.write(compression.header(self.header[-compression.NONCE_SIZE:], self.size))
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def _abort(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class SegmentSink(FileWriter):
+    """Write a small uploaded file to a segment, see segments.py
+    The file is assembled in memory and handed to append(data) by commit(), so
+    an aborted upload leaves nothing behind.
+    """
+    def __init__(self, append, encryptor=None, header=b'', digest=None, compress=False):
+        super().__init__(encryptor, digest, compress)
+        self.append = append
+        self.header = header
+
+    async def commit(self):
+        await self._put(None)
+        await self.writer
+        if self.compress:
+            # the size of the content is only known now
+            self.file.seek(0)
+            self.file.write(compression.header(self.header[-compression.NONCE_SIZE:], self.size))
+        await self.append(self.file.getvalue())
+        return self.size
+
+    def _open(self):
+        f = io.BytesIO()
+        f.write(self.header)
+        return f
+
+
+class ChunkSink(FileWriter):
+    """Write a chunk at the given offset of an existing file
+    """
+    def __init__(self, path, offset, encryptor=None):
+        super().__init__(encryptor)
+        self.path = path
+        self.offset = offset
+
+    def _open(self):
+        f = open(self.path, 'r+b')
+        f.seek(self.offset)
+        return f
+
+
+def create_file(path, size=0):
+    """Create a file with size bytes preallocated
+    Reserving the blocks up front reduces fragmentation and fails early if the disk is full.
+    return the file opened for writing
+    """
+    f = open(path, 'wb')
+    if size and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                f.close()
+                os.remove(path)
+                raise web.HTTPInsufficientStorage(text='Disk is full, please contact the admin! Thanks.')
+            # e.g. not supported by the file system
+    return f
+
+
+class DownloadSource:
+    """Stream a file to a response, reading ahead in worker threads
+    A reader task reads and decrypts the next chunks in io_pools while the
+    previous one is being sent, keeping at most DOWNLOAD_READAHEAD chunks in
+    memory. The chunk size follows the throughput of the client: a fast client
+    gets large chunks (fewer round trips to the thread pool), a slow one gets
+    small chunks so that little memory is held on its behalf.
+    """
+    def __init__(self, fd, stat, base=0):
+        self.fd = fd
+        self.stat = stat
+        self.base = base # offset of the file in a segment, see segments.py
+        self.size = stat.st_size # size of the file on disk
+        # the layout of an encrypted file, see read_header
+        self.header_size = 0
+        self.compressed = False
+        self.chunk_size = config.DOWNLOAD_CHUNK_MIN
+        self.throughput = None # bytes per second, smoothed
+
+    @classmethod
+    async def open(cls, path, base=0, stat=None):
+        """raise FileNotFoundError if the file does not exist
+        a file stored at base of a segment is given its own stat
+        """
+        loop = asyncio.get_running_loop()
+        fd = await loop.run_in_executor(io_pools, os.open, path, os.O_RDONLY)
+        return cls(fd, stat or os.fstat(fd), base)
+
+    async def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    async def read(self, offset, size):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(io_pools, os.pread, self.fd, size, self.base + offset)
+
+    async def read_header(self):
+        """read the header of an encrypted file, see compression.py
+        return the nonce and the size of the content
+        """
+        head = await self.read(0, compression.HEADER.size)
+        nonce, self.header_size, size, self.compressed = compression.parse_header(head, self.size)
+        return nonce, size
+
+    async def stream_content(self, resp, start, end, get_decryptor, copy=None):
+        """write the content of an encrypted file from start to end to resp
+        get_decryptor(offset) returns a decryptor positioned at offset of the encrypted stream
+        the chunks written are also appended to the list copy if given
+        """
+        if self.compressed:
+            await self._send(resp, lambda queue: self._read_frames(queue, start, end, get_decryptor), copy)
+        else:
+            await self._send(resp, lambda queue: self._read_ahead(
+                queue, self.header_size + start, end - start, get_decryptor(start)), copy)
+
+    async def tail_content(self, resp, progress, get_decryptor=None):
+        """write the content of a file being uploaded to resp as it's written
+        until the upload is over, see tailing.Progress
+        """
+        await self._send(resp, lambda queue: self._tail(queue, progress, get_decryptor))
+
+    async def stream(self, resp, offset, length, decryptor=None):
+        """write length bytes starting from offset to resp
+        decryptor must be positioned at offset
+        """
+        await self._send(resp, lambda queue: self._read_ahead(queue, offset, length, decryptor))
+
+    async def _send(self, resp, read_ahead, copy=None):
+        """write the chunks put into a queue by the reader task read_ahead(queue) to resp
+        """
+        queue = asyncio.Queue(maxsize=config.DOWNLOAD_READAHEAD)
+        reader = asyncio.create_task(read_ahead(queue))
+        try:
+            while True:
+                if reader.done():
+                    reader.result() # raise the error of the reader
+                    chunk = queue.get_nowait() # the reader puts b'' after the last chunk
+                else:
+                    get = asyncio.ensure_future(queue.get())
+                    await asyncio.wait([get, reader], return_when=asyncio.FIRST_COMPLETED)
+                    if not get.done():
+                        get.cancel()
+                        continue
+                    chunk = get.result()
+                if not chunk:
+                    break
+                if copy is not None:
+                    copy.append(chunk)
+                started_time = time()
+                await resp.write(chunk)
+                metrics.download_bytes.inc(len(chunk))
+                self._adapt(len(chunk), time() - started_time)
+        finally:
+            if not reader.done():
+                reader.cancel()
+            # the file may not be closed while a worker thread still reads it
+            await asyncio.wait([reader])
+
+    async def _read_ahead(self, queue, offset, length, decryptor):
+        loop = asyncio.get_running_loop()
+        end = offset + length
+        while offset < end:
+            chunk = await loop.run_in_executor(
+                io_pools, self._read, offset, min(self.chunk_size, end - offset), decryptor)
+            if not chunk:
+                break # truncated by someone else
+            offset += len(chunk)
+            await queue.put(chunk)
+        await queue.put(b'')
+
+    async def _tail(self, queue, progress, get_decryptor):
+        """the reader of a file being uploaded, it waits for the writer when it catches up
+        a compressed file is written a whole frame at a time
+        """
+        loop = asyncio.get_running_loop()
+        offset = self.header_size
+        decryptor = None
+        if get_decryptor is not None and not self.compressed:
+            decryptor = get_decryptor(0)
+        while await progress.wait(offset):
+            if self.compressed:
+                frame = await loop.run_in_executor(
+                    io_pools, self._read_frame, offset, 0, 0, sys.maxsize, get_decryptor)
+                if frame is None:
+                    break
+                offset, _, chunk = frame
+            else:
+                chunk = await loop.run_in_executor(
+                    io_pools, self._read, offset, min(self.chunk_size, progress.written - offset), decryptor)
+                if not chunk:
+                    break
+                offset += len(chunk)
+            await queue.put(chunk)
+        await queue.put(b'')
+
+    def _read(self, offset, size, decryptor):
+        chunk = os.pread(self.fd, size, self.base + offset)
+        if decryptor is not None:
+            chunk = decryptor.update(chunk)
+        return chunk
+
+    async def _read_frames(self, queue, start, end, get_decryptor):
+        """the reader of a compressed file, a chunk is the content of a frame
+        the frames before start are skipped by reading only their header
+        """
+        loop = asyncio.get_running_loop()
+        offset = self.header_size # of the frame in the file
+        position = 0 # of the content of the frame
+        while position < end:
+            frame = await loop.run_in_executor(
+                io_pools, self._read_frame, offset, position, start, end, get_decryptor)
+            if frame is None:
+                break # truncated by someone else
+            offset, size, chunk = frame
+            position += size
+            if chunk:
+                await queue.put(chunk)
+        await queue.put(b'')
+
+    def _read_frame(self, offset, position, start, end, get_decryptor):
+        """read the frame at offset whose content starts from position
+        return the offset of the next frame, the size of its content and the
+        part of the content between start and end
+        """
+        head = os.pread(self.fd, compression.FRAME.size, self.base + offset)
+        if len(head) < compression.FRAME.size:
+            return None
+        stream_offset = offset - self.header_size
+        length, size = compression.FRAME.unpack(get_decryptor(stream_offset).update(head))
+        chunk = b''
+        if position + size > start:
+            data = os.pread(self.fd, length, self.base + offset + compression.FRAME.size)
+            data = get_decryptor(stream_offset + compression.FRAME.size).update(data)
+            chunk = compression.decompress(data)[max(start - position, 0):end - position]
+        return offset + compression.FRAME.size + length, size, chunk
+
+    def _adapt(self, size, elapsed):
+        """pick a chunk size which takes the client about DOWNLOAD_CHUNK_TIME to receive
+        writing to the response only blocks when the socket's buffer is full,
+        so a short elapsed time means the client keeps up with us
+        """
+        throughput = size / max(elapsed, 1e-3)
+        if self.throughput is None:
+            self.throughput = throughput
+        else:
+            self.throughput = 0.8 * self.throughput + 0.2 * throughput
+        chunk_size = int(self.throughput * config.DOWNLOAD_CHUNK_TIME)
+        chunk_size -= chunk_size % config.DOWNLOAD_CHUNK_MIN
+        self.chunk_size = min(max(chunk_size, config.DOWNLOAD_CHUNK_MIN), config.DOWNLOAD_CHUNK_MAX)
+
+
+class CachedSource:
+    """The content of a file in the FileCache, in place of a DownloadSource
+    """
+    def __init__(self, content, stat):
+        self.content = memoryview(content)
+        self.stat = stat
+
+    async def read_header(self):
+        return None, len(self.content)
+
+    async def stream_content(self, resp, start, end, get_decryptor=None, copy=None):
+        for offset in range(start, end, config.DOWNLOAD_CHUNK_MAX):
+            chunk = self.content[offset:min(offset + config.DOWNLOAD_CHUNK_MAX, end)]
+            await resp.write(chunk)
+            metrics.download_bytes.inc(len(chunk))
+
+    async def close(self):
+        pass
@@ -0,0 +1,210 @@
+"""Resumable uploads
+A file is uploaded in chunks of UPLOAD_CHUNK_SIZE bytes which can be sent in any
+order, in parallel and retried. Each chunk is encrypted at its own offset of the
+ChaCha20 stream, so chunks can land out of order directly in the final layout.
+The progress is kept in redis so an upload can resume after the client reconnects.
+"""
+import os
+import zlib
+import logging
+from datetime import datetime, timezone
+
+import asyncio
+from aiohttp import web
+
+from . import config
+from . import model
+from . import segments
+from .transfer import io_pools, create_file
+
+log = logging.getLogger(__name__)
+
+
+class UploadSession:
+    def __init__(self, folder, file_id, size, nonce, chunk_size, tail=False):
+        self.folder = folder
+        self.file_id = file_id
+        self.size = size
+        self.nonce = nonce
+        self.chunk_size = chunk_size
+        self.tail = tail # whether it can be downloaded while it's uploaded, see tailing.py
+
+    @property
+    def chunks(self):
+        """the number of chunks
+        """
+        return (self.size + self.chunk_size - 1) // self.chunk_size
+
+    @property
+    def header_size(self):
+        return len(self.nonce)
+
+    @property
+    def path(self):
+        return self.folder.get_volume_path(self.file_id)
+
+    @property
+    def tmp_path(self):
+        return self.path + '.part'
+
+    def chunk_range(self, index):
+        """return the offset and length of a chunk in the file (excluding the header)
+        """
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.size - offset)
+
+    def get_encryptor(self, offset):
+        if not self.nonce:
+            return None
+        return self.folder.get_encryptor(self.nonce, offset)
+
+    def format_for_view(self, received):
+        return {
+            'id': self.file_id,
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'received': received,
+        }
+
+    async def received(self):
+        """return the indexes of the chunks received so far
+        """
+        _, chunks_key = self._keys(self.folder.identity, self.file_id)
+        return sorted(int(i) for i in await model.redis.smembers(chunks_key))
+
+    async def receive(self, index):
+        """record a chunk received
+        return the bytes of the file written without a gap from the start, the header included
+        """
+        _, chunks_key = self._keys(self.folder.identity, self.file_id)
+        async with model.redis.pipeline(transaction=True) as tr:
+            tr.sadd(chunks_key, index)
+            tr.expire(chunks_key, self._ttl())
+            tr.smembers(chunks_key)
+            _, _, received = await tr.execute()
+        received = {int(i) for i in received}
+        n = 0
+        while n in received:
+            n += 1
+        return self.header_size + min(n * self.chunk_size, self.size)
+
+    async def finish(self):
+        """Move the complete file to its final path
+        Only one of concurrent requests finishing the same upload succeeds.
+        """
+        session_key, chunks_key = self._keys(self.folder.identity, self.file_id)
+        received = await model.redis.scard(chunks_key)
+        if received < self.chunks:
+            raise web.HTTPConflict(text='{} of {} chunks received'.format(received, self.chunks))
+        async with model.redis.pipeline(transaction=True) as tr:
+            tr.delete(session_key)
+            tr.delete(chunks_key)
+            deleted, _ = await tr.execute()
+        if not deleted:
+            raise web.HTTPNotFound() # finished by another request
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(io_pools, os.replace, self.tmp_path, self.path)
+
+    async def scan(self, digest, keep=False):
+        """read the finished file as an upload through POST /files is read on the fly
+        digest is updated with the content
+        return the CRC-32 of the content, and the content itself if keep
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(io_pools, self._scan, digest, keep)
+
+    async def pack(self):
+        """move the finished file into a segment of the folder, see segments.py
+        """
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(io_pools, self._read)
+        await segments.append(self.folder, self.file_id, data)
+        await loop.run_in_executor(io_pools, os.remove, self.path)
+
+    async def remove(self):
+        """delete the finished file, e.g. a duplicate
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(io_pools, os.remove, self.path)
+
+    async def cancel(self):
+        if await model.redis.delete(*self._keys(self.folder.identity, self.file_id)):
+            # only once if canceled by concurrent requests
+            await self.folder.release(self.size)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(io_pools, os.remove, self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def _ttl(self):
+        """an unfinished upload is forgotten when the folder expires
+        """
+        return max(1, int((self.folder.expire_at - datetime.now(timezone.utc)).total_seconds()) + 1)
+
+    @staticmethod
+    def _keys(identity, file_id):
+        return 'upload:%s:%s' % (identity, file_id), 'upload:%s:%s:chunks' % (identity, file_id)
+
+    @classmethod
+    async def create(cls, folder, size, tail=False):
+        """Create an upload session and a file of the final size
+        The name of the file is only sent when the upload finishes so it's never
+        persisted in plain text.
+        """
+        file_id = await folder.gen_file_id()
+        nonce = os.urandom(16) if config.ENABLE_ENCRYPTION else b''
+        session = cls(folder, file_id, size, nonce, config.UPLOAD_CHUNK_SIZE, tail)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(io_pools, session._create_file)
+        session_key, _ = cls._keys(folder.identity, file_id)
+        async with model.redis.pipeline(transaction=True) as tr:
+            tr.hset(session_key, mapping={
+                'size': size,
+                'nonce': nonce.hex(),
+                'chunk_size': session.chunk_size,
+                'tail': int(tail),
+            })
+            tr.expire(session_key, session._ttl())
+            await tr.execute()
+        log.info('Create upload session {} of {} bytes'.format(file_id, size))
+        return session
+
+    @classmethod
+    async def open(cls, folder, file_id):
+        session_key, chunks_key = cls._keys(folder.identity, file_id)
+        d = await model.redis.hgetall(session_key)
+        if not d:
+            return None
+        return cls(folder, file_id, int(d[b'size']), bytes.fromhex(d[b'nonce'].decode('ascii')), int(d[b'chunk_size']),
+                   d.get(b'tail') == b'1')
+
+    def _create_file(self):
+        f = create_file(self.tmp_path, self.header_size + self.size)
+        try:
+            f.write(self.nonce)
+            f.truncate(self.header_size + self.size)
+        finally:
+            f.close()
+
+    def _scan(self, digest, keep):
+        decryptor = self.folder.get_decryptor(self.nonce) if self.nonce else None
+        crc32 = 0
+        content = [] if keep else None
+        with open(self.path, 'rb') as f:
+            f.seek(self.header_size)
+            while True:
+                chunk = f.read(1024*1024)
+                if not chunk:
+                    break
+                if decryptor is not None:
+                    chunk = decryptor.update(chunk)
+                digest.update(chunk)
+                crc32 = zlib.crc32(chunk, crc32)
+                if content is not None:
+                    content.append(chunk)
+        return crc32, None if content is None else b''.join(content)
+
+    def _read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
@@ -6,8 +6,9 @@ import mimetypes
 import struct
 
 from pprint import pprint
-from functools import wraps
+from functools import wraps, partial
 from datetime import datetime
+from email.utils import formatdate
 
 import asyncio
 import aiohttp
@@ -18,7 +19,17 @@ from user_agents import parse
 
 from . import config
 from . import auth
-from .model import Message, MsgType, Folder
+from . import kdf
+from . import fanout
+from . import ranges
+from . import compression
+from . import tailing
+from . import segments
+from . import archive
+from . import volumes
+from .model import Message, MsgType
+from .transfer import io_pools, UploadSink, SegmentSink, ChunkSink, DownloadSource, CachedSource
+from .uploads import UploadSession
 
 log = logging.getLogger(__name__)
 
@@ -32,14 +43,19 @@ def get_client_display_name(request):
         user_agent.browser.family)
 
 
+def get_client_ip(request):
+    if config.REAL_IP_HEADER:
+        return request.headers.get(config.REAL_IP_HEADER, request.remote)
+    return request.remote
+
+
 async def signup(request):
     form_data = await request.post()
     identity = form_data['identity']
     if len(identity) > 32:
         raise web.HTTPBadRequest()
     age = form_data.get('age')
-    await Folder.create(identity, age)
-    identity = await auth.login(request.app['folders'], identity)
+    identity = await auth.signup(request.app['folders'], identity, age, get_client_ip(request))
     resp = web.Response(status=201, text='Folder created!')
     await remember(request, resp, identity)
     return resp
@@ -54,7 +70,7 @@ async def login(request):
     # return 200 because ajax has trouble handling redirecting if 302 is returned
     resp = web.Response()
     # usually this should be user name & password
-    identity = await auth.login(request.app['folders'], identity)
+    identity = await auth.login(request.app['folders'], identity, get_client_ip(request))
     await remember(request, resp, identity)
     return resp
 
@@ -75,6 +91,18 @@ async def allow(request):
     return web.Response()
 
 
+async def stats(request):
+    """internal statistics used to size the server
+    NGINX does not proxy this endpoint
+    """
+    return web.json_response({
+        'kdf': kdf.service.stats(),
+        'fanout': fanout.stats(),
+        'folders': request.app['folders'].stats(),
+        'files': request.app['files'].stats(),
+    })
+
+
 async def index(request):
     try:
         await check_authorized(request)
@@ -107,6 +135,7 @@ async def ws(request):
     name = get_client_display_name(request)
     ws_current['name'] = name
     folder.connect(ws_current)
+    await folder.refresh()
     info = folder.format_for_view()
     info['name'] = name
     await ws_current.send_json({
@@ -134,11 +163,7 @@ async def ws(request):
                     )
                     await folder.send(msg)
                 elif a == 'pull':
-                    msgs = await folder.retrieve(ws_data['offset'])
-                    await ws_current.send_json({
-                        'action': 'send',
-                        'msgs': [m.format_for_view() for m in msgs]
-                    })
+                    await pull(ws_current, folder, ws_data)
                 else:
                     log.warning('unknow action')
             else:
@@ -155,8 +180,9 @@ async def ws(request):
                     log.info('{} disconnected with close code {}.'.format(name, ws_current.close_code))
                 elif ws_msg.type == aiohttp.WSMsgType.CLOSING:
                     # call ws.close() in other coroutines will also lead to here through CLOSING
-                    # in this case we don't have to call close again
-                    pass
+                    # in this case we don't have to call close again, but let it run first,
+                    # otherwise aiohttp closes the connection with 1000 when we return
+                    await asyncio.sleep(0)
                 break
     except asyncio.TimeoutError as e:
         log.error('timeout') # we should not reach here since heartbeat is turned on
@@ -175,11 +201,47 @@ async def ws(request):
     return ws_current
 
 
+async def pull(ws_current, folder, ws_data):
+    """Send a page of the history in its own frame
+    A page holds at most PULL_PAGE_SIZE messages no matter how long the history is.
+    With `offset` the client pages forward: it asks for the next page after
+    receiving one until `offset` + the number of messages reaches `total`.
+    With `before` it pages backward from the given index (or the end of the
+    history if null), which is how older messages are loaded on scrolling back.
+    A malformed request is ignored.
+    """
+    try:
+        limit = int(ws_data.get('limit') or config.PULL_PAGE_SIZE)
+        before = ws_data.get('before')
+        if before is not None:
+            before = int(before)
+        offset = int(ws_data.get('offset') or 0)
+    except (TypeError, ValueError):
+        log.warning('malformed pull {}'.format(ws_data))
+        return
+    limit = min(max(limit, 1), config.PULL_PAGE_SIZE)
+    if 'before' in ws_data:
+        if before is None:
+            _, before = await folder.retrieve(0, 0)
+        offset = max(0, before - limit)
+        limit = max(before, 0) - offset
+    else:
+        offset = max(offset, 0)
+    msgs, total = await folder.retrieve(offset, limit)
+    await ws_current.send_json({
+        'action': 'pull',
+        'offset': offset,
+        'total': total,
+        'msgs': [m.format_for_view() for m in msgs]
+    })
+
+
 async def upload(request):
     folder = await check_authorized(request)
     name = get_client_display_name(request)
     reader = await request.multipart()
     count = 0
+    received = 0 # bytes of the files uploaded in this request so far
     while True:
         # reader.next() will `yield` the fields of your form
         field = await reader.next()
@@ -195,39 +257,90 @@ async def upload(request):
             # We can safely assume Content-Length is always available since chunked transfer encoding is not suitable for uploading a file with fixed size
             raise web.HTTPBadRequest()
         l = int(request.headers['Content-Length'])
-        if l + folder.current_size > folder.storage_limit:
-            # it should be fine to check storage limit using Content-Length which represents the total size of the request
-            log.warning('Storage limit exceeds: {} > {}'.format(l+folder.current_size, folder.storage_limit))
-            raise web.HTTPRequestHeaderFieldsTooLarge()
-        log.info('start uploading %s' % filename)
-        file_id = await folder.gen_file_id()
-        file_path = os.path.join(config.UPLOAD_ROOT_DIRECTORY, folder.get_file_path(file_id))
-        size = 0
+        # it should be fine to reserve storage using Content-Length which represents the total size of the request
+        # the rest of the request is reserved for each file, which bounds what can be written
+        reserved = l - received
+        await folder.reserve(reserved)
         try:
-            with open(file_path, 'wb') as f:
-                if config.ENABLE_ENCRYPTION:
-                    cipher, nonce = folder.get_cipher()
-                    encryptor = cipher.encryptor()
-                    f.write(nonce)
-                while True:
-                    chunk = await field.read_chunk(1024*1024)  # 8192 bytes by default.
-                    if not chunk:
-                        # todo: What else could cause this besides reaching the end of a file?
-                        break
-                    size += len(chunk)
+            log.info('start uploading %s' % filename)
+            file_id = await folder.gen_file_id()
+            file_path = folder.get_volume_path(file_id)
+            upload = None
+            if reserved >= config.TAIL_MIN_SIZE:
+                # the other devices may download it while it's written
+                upload = tailing.Upload(folder.identity, Message(
+                    type=MsgType.FILE,
+                    data=filename,
+                    size=reserved,
+                    sender=name,
+                    file_id=file_id,
+                ))
+            on_written = upload.update if upload else None
+            chunk = await field.read_chunk(1024*1024)  # 8192 bytes by default.
+            if config.ENABLE_ENCRYPTION:
+                compress = False
+                if config.COMPRESS_UPLOADS:
+                    # ciphertext does not compress, so decide from the first chunk before encrypting
+                    compress = await asyncio.get_running_loop().run_in_executor(
+                        io_pools, compression.worth_compressing, chunk)
+                cipher, nonce = folder.get_cipher()
+                header = compression.header(nonce) if compress else nonce
+                if upload is None and reserved <= config.SEGMENT_MAX_FILE_SIZE:
+                    # packed with the other small files of the folder
+                    sink = SegmentSink(partial(segments.append, folder, file_id), cipher.encryptor(), header,
+                                       digest=folder.get_digest(), compress=compress)
+                else:
+                    sink = UploadSink(file_path, cipher.encryptor(), header, size_hint=reserved,
+                                      digest=folder.get_digest(), compress=compress, on_written=on_written)
+            else:
+                sink = UploadSink(file_path, size_hint=reserved, digest=folder.get_digest(), on_written=on_written)
+            await sink.open()
+            # the plaintext of a small file is kept for the devices downloading it next
+            content = [] if config.ENABLE_ENCRYPTION else None
+            try:
+                if upload:
+                    await upload.start(sink.written)
+                # todo: What else could cause an empty chunk besides reaching the end of a file?
+                while chunk:
                     log.debug('writing {} for {} ...'.format(len(chunk), filename[:30]))
-                    if config.ENABLE_ENCRYPTION:
-                        chunk = encryptor.update(chunk)
-                    f.write(chunk) # block op
-                assert l >= size, 'Content-Length is usually larger than the file size'
+                    # compressed, encrypted and written in a worker thread
+                    await sink.write(chunk)
+                    if content is not None:
+                        content.append(chunk)
+                        if sink.size > request.app['files'].max_file_size:
+                            content = None
+                    chunk = await field.read_chunk(1024*1024)
+                assert reserved >= sink.size, 'Content-Length is usually larger than the file size'
+                size = await sink.commit()
+            except:
+                # if client abort uploading
+                # asyncio.exceptions.CancelledError will be captured here
+                await sink.abort()
+                if upload:
+                    await upload.finish(committed=False)
+                log.warning('interrupt uploading {} due to {}'.format(filename, sys.exc_info()[0]))
+                raise
         except:
-            # if client abort uploading
-            # asyncio.exceptions.CancelledError will be captured here
-            os.remove(f.name)
-            log.warning('interrupt uploading {} due to {}'.format(filename, sys.exc_info()[0]))
+            await folder.release(reserved)
             raise
+        if upload:
+            await upload.finish(committed=True)
+        received += size
         log.info('finish uploading {}'.format(filename))
         count += 1
+        stored = size
+        blob_id = await folder.dedup(sink.digest.hexdigest(), file_id, sink.crc32)
+        if blob_id != file_id:
+            # the same content is uploaded before, keep a single copy
+            log.info('{} is a duplicate of file {}'.format(filename, blob_id))
+            if isinstance(sink, SegmentSink):
+                await segments.discard(folder, file_id)
+            else:
+                await asyncio.get_running_loop().run_in_executor(io_pools, os.remove, file_path)
+            file_id = blob_id
+            stored = 0
+        if content is not None:
+            await cache_file(request, folder, file_id, b''.join(content))
         msg = Message(
             type=MsgType.FILE,
             data=filename,
@@ -235,60 +348,399 @@ async def upload(request):
             sender=name,
             file_id=file_id,
         )
-        await folder.send(msg)
+        await folder.send(msg, reserved, stored)
     return web.Response(text='{} file(s) uploaded'.format(count))
 
 
+async def create_upload(request):
+    """start a resumable upload of a file of the given size
+    The name, if given, is only used to announce a large file to the other
+    devices, which may download it while it's uploaded.
+    """
+    folder = await check_authorized(request)
+    form_data = await request.post()
+    try:
+        size = int(form_data['size'])
+    except (KeyError, ValueError):
+        raise web.HTTPBadRequest()
+    if size < 0:
+        raise web.HTTPBadRequest()
+    filename = form_data.get('name')
+    # reserved until the upload is finished or canceled
+    await folder.reserve(size)
+    try:
+        session = await UploadSession.create(folder, size, tail=bool(filename) and size >= config.TAIL_MIN_SIZE)
+    except:
+        await folder.release(size)
+        raise
+    if session.tail:
+        await tailing.publish(folder.identity, session.file_id, session.header_size, tailing.WRITING, Message(
+            type=MsgType.FILE,
+            data=filename,
+            size=size,
+            sender=get_client_display_name(request),
+            file_id=session.file_id,
+        ))
+    return web.json_response(session.format_for_view([]), status=201)
+
+
+async def open_upload(request):
+    folder = await check_authorized(request)
+    session = await UploadSession.open(folder, request.match_info['id'])
+    if session is None:
+        raise web.HTTPNotFound()
+    return session
+
+
+async def upload_status(request):
+    """the chunks received so far, for the client to resume
+    """
+    session = await open_upload(request)
+    return web.json_response(session.format_for_view(await session.received()))
+
+
+async def upload_chunk(request):
+    session = await open_upload(request)
+    index = int(request.match_info['index'])
+    if index >= session.chunks:
+        raise web.HTTPBadRequest()
+    offset, length = session.chunk_range(index)
+    if request.content_length != length:
+        raise web.HTTPBadRequest(text='chunk {} must be {} bytes'.format(index, length))
+    # the chunk is encrypted at its own offset of the stream and written in place
+    sink = ChunkSink(session.tmp_path, session.header_size + offset, session.get_encryptor(offset))
+    await sink.open()
+    try:
+        while True:
+            chunk = await request.content.read(1024*1024)
+            if not chunk:
+                break
+            await sink.write(chunk)
+        if sink.size != length:
+            raise web.HTTPBadRequest()
+        await sink.commit()
+    except:
+        await sink.abort()
+        log.warning('interrupt uploading chunk {} of {} due to {}'.format(index, session.file_id, sys.exc_info()[0]))
+        raise
+    written = await session.receive(index)
+    if session.tail:
+        await tailing.publish(session.folder.identity, session.file_id, written, tailing.WRITING)
+    return web.Response(status=204)
+
+
+async def finish_upload(request):
+    session = await open_upload(request)
+    form_data = await request.post()
+    filename = form_data.get('name')
+    if not filename:
+        raise web.HTTPBadRequest()
+    await session.finish()
+    log.info('finish uploading {}'.format(filename))
+    folder = session.folder
+    file_id = session.file_id
+    msg = Message(
+        type=MsgType.FILE,
+        data=filename,
+        size=session.size,
+        sender=get_client_display_name(request),
+        file_id=file_id,
+    )
+    if session.tail:
+        await tailing.publish(folder.identity, file_id, session.header_size + session.size, tailing.COMMITTED, msg)
+    # the file is read once it's complete for what an upload through POST /files does on the fly,
+    # except compression which does not apply to chunks encrypted in place
+    keep = config.ENABLE_ENCRYPTION and session.size <= request.app['files'].max_file_size
+    digest = folder.get_digest()
+    crc32, content = await session.scan(digest, keep)
+    stored = session.size
+    blob_id = await folder.dedup(digest.hexdigest(), file_id, crc32)
+    if blob_id != file_id:
+        # the same content is uploaded before, keep a single copy
+        log.info('{} is a duplicate of file {}'.format(filename, blob_id))
+        await session.remove()
+        file_id = msg.file_id = blob_id
+        stored = 0
+    elif config.ENABLE_ENCRYPTION and session.size <= config.SEGMENT_MAX_FILE_SIZE:
+        # packed with the other small files of the folder
+        await session.pack()
+    if content is not None:
+        await cache_file(request, folder, file_id, content)
+    await folder.send(msg, session.size, stored)
+    return web.Response(text='1 file(s) uploaded')
+
+
+async def cancel_upload(request):
+    session = await open_upload(request)
+    await session.cancel()
+    if session.tail:
+        await tailing.publish(session.folder.identity, session.file_id, session.header_size, tailing.ABORTED, Message(
+            type=MsgType.FILE,
+            data='',
+            size=session.size,
+            sender=get_client_display_name(request),
+            file_id=session.file_id,
+        ))
+    log.info('cancel uploading {}'.format(session.file_id))
+    return web.Response(status=204)
+
+
+async def cache_file(request, folder, file_id, content, stat=None):
+    """keep the content of a file in the FileCache along with the stat of its file
+    """
+    if stat is None:
+        try:
+            stat = await asyncio.get_running_loop().run_in_executor(
+                io_pools, os.stat, folder.get_volume_path(file_id))
+        except FileNotFoundError:
+            stat = await segments.stat(folder, file_id)
+            if stat is None:
+                return
+    # the files of a folder go with it, see cache.FolderCache
+    if folder.identity in request.app['folders']:
+        request.app['files'].put(folder.identity, file_id, content, stat)
+
+
+async def open_file(folder, file_id):
+    """open a file stored on its own or in a segment
+    return a DownloadSource or None if it does not exist
+    """
+    try:
+        return await DownloadSource.open(folder.get_volume_path(file_id))
+    except FileNotFoundError:
+        return await segments.open_file(folder, file_id)
+
+
 async def download(request):
     folder = await check_authorized(request)
     file_id = request.query['id']
     file_name = request.query['name'] # we can not query the filename by file id in server side
     file_path = folder.get_file_path(file_id)
-    if not config.ENABLE_ENCRYPTION:
+    ct, encoding = mimetypes.guess_type(file_name)
+    if not ct:
+        ct = "application/octet-stream"
+    # NGINX only serves the files on UPLOAD_ROOT_DIRECTORY
+    if not config.ENABLE_ENCRYPTION and config.ACCEL_REDIRECT and folder.volume == volumes.root():
         resp = web.Response(headers={
             'Content-Disposition': 'attachment; filename="{0}"'.format(file_name),
             'X-Accel-Redirect': '/download/{}'.format(file_path)
             })
         log.info('redirect to NGINX')
         return resp
+    elif not config.ENABLE_ENCRYPTION:
+        file_path = folder.get_volume_path(file_id)
+        if not await asyncio.get_running_loop().run_in_executor(io_pools, os.path.isfile, file_path):
+            return await tail(request, folder, file_id, file_name, ct)
+        log.info('start downloading file: %s', file_name)
+        # zero copy by sendfile, Range, ETag and conditional requests are handled by FileResponse
+        return web.FileResponse(file_path, headers={
+            'Content-Type': ct,
+            'Content-Disposition': 'attachment; filename="{0}"'.format(file_name),
+            })
     else:
-        ct, encoding = mimetypes.guess_type(file_name)
-        if not ct:
-            ct = "application/octet-stream"
-        resp = web.StreamResponse(
-            headers={
-                'Content-Type': ct,
-                'Content-Disposition': 'attachment; filename="{0}"'.format(file_name),
-            },
-        )
-        chunk_size = 1024*1024
-        file_path = os.path.join(config.UPLOAD_ROOT_DIRECTORY, file_path)
-        # Without setting Content-Length, chunked transfer encoding will be used.
-        # The downside is that the client has no way to estimate the ETA
-        # So, let's infer the Content-Length from the file size
+        cached = request.app['files'].get(folder.identity, file_id)
+        if cached is not None:
+            # served from memory, neither the disk nor the cipher is touched
+            source = CachedSource(*cached)
+        else:
+            source = await open_file(folder, file_id)
+            if source is None:
+                # still being uploaded, or a bad request with an arbitrary file id
+                return await tail(request, folder, file_id, file_name, ct)
         try:
-            file_size = os.path.getsize(file_path) - 16
-        except FileNotFoundError:
-            # this is probably a bad request with an arbitrary file id
-            raise web.HTTPNotFound()
-        resp.content_length = file_size
-        await resp.prepare(request)
-        log.info('start downloading file: %s', file_name)
-        with open(file_path, 'rb') as file:
-            if config.ENABLE_ENCRYPTION:
-                nonce = file.read(16)
-                cipher, _ = folder.get_cipher(nonce)
-                decryptor = cipher.decryptor()
-            while True:
-                chunk = file.read(chunk_size)
-                if not chunk:
-                    break
-                log.debug('send %d bytes for %s', len(chunk), file_name)
-                if config.ENABLE_ENCRYPTION:
-                    chunk = decryptor.update(chunk)
-                await resp.write(chunk)
+            nonce, size = await source.read_header()
+            get_decryptor = partial(folder.get_decryptor, nonce)
+            etag = ranges.etag_of(source.stat)
+            resp = web.StreamResponse(
+                headers={
+                    'Content-Type': ct,
+                    'Content-Disposition': 'attachment; filename="{0}"'.format(file_name),
+                    'Accept-Ranges': 'bytes',
+                    'ETag': etag,
+                    'Last-Modified': ranges.last_modified_of(source.stat),
+                },
+            )
+            # a stream can be decrypted from any offset, so a range costs only its own bytes
+            # (and the headers of the frames before it if the file is compressed)
+            byte_ranges = ranges.parse_range(request, size, etag, source.stat.st_mtime)
+            if byte_ranges is None:
+                # Without setting Content-Length, chunked transfer encoding will be used.
+                # The downside is that the client has no way to estimate the ETA
+                # So, let's infer the Content-Length from the file size
+                resp.content_length = size
+                await resp.prepare(request)
+                log.info('start downloading file: %s', file_name)
+                # a small file is kept for the other devices (uploaded through another worker)
+                content = [] if cached is None and size <= request.app['files'].max_file_size else None
+                # disk reads and decryption overlap with sending
+                await source.stream_content(resp, 0, size, get_decryptor, content)
+                if content is not None:
+                    await cache_file(request, folder, file_id, b''.join(content), source.stat)
+            elif len(byte_ranges) == 1:
+                start, end = byte_ranges[0]
+                resp.set_status(206)
+                resp.headers['Content-Range'] = ranges.content_range(start, end, size)
+                resp.content_length = end - start
+                await resp.prepare(request)
+                log.info('start downloading file: %s from %d to %d', file_name, start, end)
+                await source.stream_content(resp, start, end, get_decryptor)
+            else:
+                multipart = ranges.Multipart(byte_ranges, size, ct)
+                resp.set_status(206)
+                resp.headers['Content-Type'] = multipart.content_type
+                resp.content_length = multipart.content_length
+                await resp.prepare(request)
+                log.info('start downloading file: %s in %d ranges', file_name, len(byte_ranges))
+                for head, start, end in multipart.parts:
+                    await resp.write(head)
+                    await source.stream_content(resp, start, end, get_decryptor)
+                    await resp.write(b'\r\n')
+                await resp.write(multipart.tail)
+        finally:
+            await source.close()
         await resp.write_eof()
         log.info('finish downloading file %s', file_name)
         return resp
 
 
+async def tail(request, folder, file_id, file_name, ct):
+    """download a file while it's being uploaded, see tailing.py
+    """
+    progress = await tailing.follow(folder.identity, file_id)
+    if progress is None:
+        # this is probably a bad request with an arbitrary file id
+        raise web.HTTPNotFound()
+    try:
+        file_path = folder.get_volume_path(file_id)
+        try:
+            # the temp file of UploadSink, or the file if it's committed meanwhile
+            source = await DownloadSource.open(file_path + '.part')
+        except FileNotFoundError:
+            try:
+                source = await DownloadSource.open(file_path)
+            except FileNotFoundError:
+                raise web.HTTPNotFound()
+        try:
+            get_decryptor = None
+            if config.ENABLE_ENCRYPTION:
+                nonce, _ = await source.read_header()
+                get_decryptor = partial(folder.get_decryptor, nonce)
+            # the size is unknown until the upload is committed, so the response is chunked and has no ranges
+            resp = web.StreamResponse(
+                headers={
+                    'Content-Type': ct,
+                    'Content-Disposition': 'attachment; filename="{0}"'.format(file_name),
+                },
+            )
+            await resp.prepare(request)
+            log.info('start downloading file being uploaded: %s', file_name)
+            await source.tail_content(resp, progress, get_decryptor)
+        finally:
+            await source.close()
+    finally:
+        tailing.unfollow(folder.identity, file_id)
+    if progress.state != tailing.COMMITTED:
+        # cut short without the last chunk, so the client knows the file is incomplete
+        log.warning('stop downloading file {} which is {}'.format(
+            file_name, 'aborted' if progress.state == tailing.ABORTED else 'stalled'))
+        request.transport.close()
+        return resp
+    await resp.write_eof()
+    log.info('finish downloading file %s', file_name)
+    return resp
+
+
+async def download_zip(request):
+    """download the files of a folder in a ZIP archive, all of them or those whose ids are given
+    """
+    folder = await check_authorized(request)
+    file_name = request.query.get('name', 'snapfile.zip')
+    ids = request.query.get('ids')
+    ids = set(ids.split(',')) if ids else None
+    # the layout, hence the Content-Length, needs all the entries, which are far smaller than the history
+    entries = [entry async for entry in archived_files(folder, ids)]
+    if not entries:
+        raise web.HTTPNotFound()
+    zip_file = archive.Archive(entries)
+    send_file = partial(send_archived_file, request, folder)
+    resp = web.StreamResponse(
+        headers={
+            'Content-Type': 'application/zip',
+            'Content-Disposition': 'attachment; filename="{0}"'.format(file_name),
+            'Accept-Ranges': 'bytes',
+            'ETag': zip_file.etag,
+            'Last-Modified': formatdate(zip_file.mtime, usegmt=True),
+        },
+    )
+    # the layout is known up front, so any range is produced on its own
+    byte_ranges = ranges.parse_range(request, zip_file.size, zip_file.etag, zip_file.mtime)
+    try:
+        if byte_ranges is None:
+            resp.content_length = zip_file.size
+            await resp.prepare(request)
+            log.info('start downloading archive: %s of %d files', file_name, len(entries))
+            await zip_file.write(resp, 0, zip_file.size, send_file)
+        elif len(byte_ranges) == 1:
+            start, end = byte_ranges[0]
+            resp.set_status(206)
+            resp.headers['Content-Range'] = ranges.content_range(start, end, zip_file.size)
+            resp.content_length = end - start
+            await resp.prepare(request)
+            log.info('start downloading archive: %s from %d to %d', file_name, start, end)
+            await zip_file.write(resp, start, end, send_file)
+        else:
+            multipart = ranges.Multipart(byte_ranges, zip_file.size, 'application/zip')
+            resp.set_status(206)
+            resp.headers['Content-Type'] = multipart.content_type
+            resp.content_length = multipart.content_length
+            await resp.prepare(request)
+            log.info('start downloading archive: %s in %d ranges', file_name, len(byte_ranges))
+            for head, start, end in multipart.parts:
+                await resp.write(head)
+                await zip_file.write(resp, start, end, send_file)
+                await resp.write(b'\r\n')
+            await resp.write(multipart.tail)
+    except FileNotFoundError as e:
+        # cut short without the rest, so the client knows the archive is incomplete
+        log.warning('stop downloading archive {} without file {}'.format(file_name, e))
+        request.transport.close()
+        return resp
+    finally:
+        await folder.set_crc32({e.file_id: e.crc32 for e in zip_file.computed})
+    await resp.write_eof()
+    log.info('finish downloading archive %s', file_name)
+    return resp
+
+
+async def archived_files(folder, ids=None):
+    """yield the entries of the files of a folder, all of them or those whose ids are given
+    the history is read a page at a time, of which only the files are kept
+    """
+    offset = 0
+    found = set()
+    while ids is None or len(found) < len(ids):
+        msgs, total = await folder.retrieve(offset, config.PULL_PAGE_SIZE)
+        files = [m for m in msgs if m.type == MsgType.FILE and (ids is None or str(m.file_id) in ids)]
+        for m, crc in zip(files, await folder.get_crc32([m.file_id for m in files])):
+            found.add(str(m.file_id))
+            yield archive.Entry(str(m.file_id), m.data, m.size, m.date, crc)
+        offset += len(msgs)
+        if not msgs or offset >= total:
+            break
+
+
+async def send_archived_file(request, folder, entry, out, start, end):
+    """write the content of a file in an archive from start to end to out
+    """
+    cached = request.app['files'].get(folder.identity, entry.file_id)
+    source = CachedSource(*cached) if cached is not None else await open_file(folder, entry.file_id)
+    if source is None:
+        raise FileNotFoundError(entry.file_id)
+    try:
+        get_decryptor = lambda offset: None # stored in plaintext
+        if config.ENABLE_ENCRYPTION:
+            nonce, _ = await source.read_header()
+            get_decryptor = partial(folder.get_decryptor, nonce)
+        await source.stream_content(out, start, end, get_decryptor)
+    finally:
+        await source.close()
@@ -0,0 +1,291 @@
+"""Placement of folders on several volumes
+A volume is a directory on its own disk: UPLOAD_ROOT_DIRECTORY and EXTRA_VOLUMES.
+A new folder is placed on a volume picked at random, weighted by its free space
+and how idle its disk is, so folders spread over the disks in proportion to what
+they can take. The volume is recorded in the folder as an absolute path, so it's
+the same directory for a worker started anywhere, folders created before are on
+UPLOAD_ROOT_DIRECTORY. The free space and the I/O of a disk are sampled every
+VOLUME_SAMPLE_INTERVAL, off the event loop, and the placement and the
+reservations of uploads go by the last sample.
+The rebalancer runs in one worker at a time. It moves idle folders (nothing is
+being uploaded and no message for REBALANCE_IDLE_TIME) off a volume used above
+VOLUME_HIGH_WATERMARK to the volume with the most room. Uploads to a folder are
+refused while it's copied, then the workers are told to use the new volume and
+the old copy is deleted after MOVE_GRACE, which is left to the downloads opening it.
+"""
+import os
+import json
+import random
+import shutil
+import logging
+from time import time, monotonic
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
+from redis import asyncio as aioredis
+
+from . import config
+from . import model
+from . import codec
+from . import metrics
+from . import deletion
+
+log = logging.getLogger(__name__)
+REBALANCE_LOCK_KEY = 'lock:rebalance' # held by the worker running the rebalancer
+# lock a folder still on volume ARGV[1] (empty if not recorded) which has no
+# upload in progress until ARGV[3], a lock which expires by ARGV[2] is taken over
+# return 1 if it's locked
+LOCK_FOLDER = """
+local f = redis.call('HMGET', KEYS[1], 'storage_limit', 'volume', 'reserved', 'moving')
+if not f[1] or (f[2] or '') ~= ARGV[1] or tonumber(f[3] or 0) ~= 0 then
+    return 0
+end
+if f[4] and tonumber(f[4]) > tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'moving', ARGV[3])
+return 1
+"""
+# switch a locked folder to volume ARGV[1]
+# return 1 unless the folder is deleted or the lock is lost meanwhile
+FINISH_MOVE = """
+if redis.call('HEXISTS', KEYS[1], 'moving') == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'volume', ARGV[1])
+redis.call('HDEL', KEYS[1], 'moving')
+return 1
+"""
+volumes = [] # UPLOAD_ROOT_DIRECTORY first
+lock_folder = None # a script
+finish_move = None # a script
+# folders are copied one at a time
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='move')
+
+
+class Volume:
+    def __init__(self, directory):
+        self.directory = directory
+        self.disk_usage = None # total, used and free bytes of the disk as of the last sample
+        self.busy = 0.0 # fraction of the time the disk was doing I/O since the previous sample
+        self.io_ticks = None
+        self.sampled_time = None
+
+    def usage(self):
+        return self.disk_usage
+
+    def room(self):
+        """bytes which can be written before the disk is considered full
+        """
+        return self.usage().free - config.MIN_FREE_SPACE
+
+    def used_ratio(self):
+        usage = self.usage()
+        return usage.used / usage.total
+
+    def weight(self):
+        """the share of new folders placed on the volume
+        """
+        return max(self.room(), 0) * (1 - 0.9 * self.busy)
+
+    def sample(self):
+        """measure the free space of the disk and how busy it was since the previous
+        sample, by the milliseconds spent doing I/O counted by the kernel for the block device
+        blocking, it's run in a thread
+        """
+        self.disk_usage = shutil.disk_usage(self.directory)
+        try:
+            dev = os.stat(self.directory).st_dev
+            with open('/sys/dev/block/{}:{}/stat'.format(os.major(dev), os.minor(dev))) as f:
+                io_ticks = int(f.read().split()[9])
+        except (OSError, IndexError, ValueError):
+            return # not a block device, e.g. tmpfs, or not linux
+        now = monotonic()
+        if self.io_ticks is not None:
+            self.busy = min(1.0, (io_ticks - self.io_ticks) / 1000 / max(now - self.sampled_time, 1e-3))
+        self.io_ticks = io_ticks
+        self.sampled_time = now
+
+
+def root():
+    return os.path.abspath(config.UPLOAD_ROOT_DIRECTORY)
+
+
+def directories():
+    return [root()] + [os.path.abspath(v) for v in config.EXTRA_VOLUMES]
+
+
+def get(directory):
+    """return the Volume of a directory or None if it's not one of the volumes
+    """
+    for volume in volumes:
+        if volume.directory == directory:
+            return volume
+    return None
+
+
+def place(size=0):
+    """pick the volume of a new folder
+    return its directory or None if all disks are full
+    """
+    candidates = [v for v in volumes if v.room() > size]
+    if not candidates:
+        return None
+    weights = [v.weight() for v in candidates]
+    if sum(weights) == 0:
+        return candidates[0].directory
+    return random.choices(candidates, weights)[0].directory
+
+
+async def sample_volumes():
+    loop = asyncio.get_running_loop()
+    while True:
+        for volume in volumes:
+            await loop.run_in_executor(None, volume.sample)
+            metrics.volume_free_bytes.set(volume.usage().free, volume=volume.directory)
+            metrics.volume_busy.set(round(volume.busy, 3), volume=volume.directory)
+        await asyncio.sleep(config.VOLUME_SAMPLE_INTERVAL)
+
+
+async def rebalance():
+    """move idle folders off the volumes which are filling up
+    """
+    while True:
+        await asyncio.sleep(config.REBALANCE_INTERVAL)
+        try:
+            if not await model.redis.set(REBALANCE_LOCK_KEY, metrics.worker_name(), nx=True, ex=config.REBALANCE_INTERVAL):
+                continue # run by another worker
+            for source in volumes:
+                if source.used_ratio() > config.VOLUME_HIGH_WATERMARK:
+                    await drain(source)
+        except aioredis.ConnectionError as e:
+            log.error('failed to rebalance: {}'.format(e))
+
+
+async def drain(source):
+    """move at most REBALANCE_BATCH idle folders off a volume
+    """
+    moved = 0
+    async for identity, path, size, recorded in idle_folders(source):
+        targets = [v for v in volumes if v is not source
+                   and v.used_ratio() < config.VOLUME_HIGH_WATERMARK and v.room() > size]
+        if not targets:
+            log.warning('volume {} is filling up but no volume can take its folders'.format(source.directory))
+            break
+        target = max(targets, key=Volume.room)
+        if await move(identity, path, recorded, source, target):
+            moved += 1
+            if moved >= config.REBALANCE_BATCH:
+                break
+    if moved:
+        log.info('{} folders moved off {}'.format(moved, source.directory))
+
+
+async def idle_folders(volume):
+    """yield the identity, path, size and the volume as recorded of the idle folders on a volume
+    """
+    batch = []
+    async for k in model.redis.scan_iter(match='folder:*', count=config.REAP_BATCH):
+        batch.append(k.decode('utf-8').split(':', 1)[1])
+        if len(batch) >= config.REAP_BATCH:
+            for folder in await _idle_folders(volume, batch):
+                yield folder
+            batch = []
+    if batch:
+        for folder in await _idle_folders(volume, batch):
+            yield folder
+
+
+async def _idle_folders(volume, identities):
+    async with model.redis.pipeline(transaction=False) as pipe:
+        for identity in identities:
+            folder_key, msg_key = model.Folder._keys(identity)
+            pipe.hmget(folder_key, 'volume', 'path', 'reserved', 'current_size', 'created_time')
+            pipe.lindex(msg_key, -1)
+        # a folder still saved in json is not a hash
+        results = await pipe.execute(raise_on_error=False)
+    idle = []
+    for identity, fields, last in zip(identities, results[::2], results[1::2]):
+        if isinstance(fields, Exception):
+            continue
+        directory, path, reserved, size, created_time = [f and f.decode('utf-8') for f in fields]
+        if path is None or os.path.abspath(directory or config.UPLOAD_ROOT_DIRECTORY) != volume.directory \
+                or int(reserved or 0):
+            continue
+        if last_active(created_time, last) > time() - config.REBALANCE_IDLE_TIME:
+            continue
+        idle.append((identity, path, int(size or 0), directory or ''))
+    return idle
+
+
+def last_active(created_time, last_message):
+    """return the time of the last message of a folder, or when it's created
+    """
+    date = created_time
+    if last_message is not None:
+        if codec.is_legacy(last_message):
+            date = json.loads(last_message)['date']
+        else:
+            date = codec.unpack(last_message)[0]['date']
+    return datetime.fromisoformat(date).timestamp()
+
+
+async def move(identity, path, recorded, source, target):
+    """copy a folder to the target volume and switch to it
+    recorded is the volume of the folder as it's recorded, empty if it's not
+    return whether it's moved
+    """
+    folder_key = model.Folder._keys(identity)[0]
+    now = time()
+    if not await lock_folder(keys=[folder_key], args=[recorded, now, now + config.MOVE_LOCK_TIME]):
+        return False # busy or deleted
+    src = os.path.join(source.directory, path)
+    dst = os.path.join(target.directory, path)
+    started_time = time()
+    moved = False
+    try:
+        await asyncio.get_running_loop().run_in_executor(executor, _copy_tree, src, dst)
+        moved = await finish_move(keys=[folder_key], args=[target.directory])
+    except Exception:
+        log.exception('failed to move folder {}'.format(identity))
+    finally:
+        if not moved:
+            # unlocked, the copy is deleted like a deleted folder
+            await model.redis.hdel(folder_key, 'moving')
+            await deletion.schedule(dst)
+    if not moved:
+        return False
+    await model.redis.publish(model.MOVED_CHANNEL % identity, target.directory)
+    await deletion.schedule(src, config.MOVE_GRACE)
+    metrics.folders_moved.inc()
+    log.info('Folder {} moved from {} to {} in {:.3f}s'.format(identity, source.directory, target.directory, time() - started_time))
+    return True
+
+
+def _copy_tree(src, dst):
+    # a copy left by a move which is interrupted is overwritten
+    shutil.copytree(src, dst, dirs_exist_ok=True)
+
+
+async def startup(app):
+    global lock_folder, finish_move
+    volumes.clear()
+    loop = asyncio.get_running_loop()
+    for directory in directories():
+        os.makedirs(directory, exist_ok=True)
+        volume = Volume(directory)
+        await loop.run_in_executor(None, volume.sample)
+        volumes.append(volume)
+    lock_folder = model.redis.register_script(LOCK_FOLDER)
+    finish_move = model.redis.register_script(FINISH_MOVE)
+    app['volume_tasks'] = [asyncio.create_task(sample_volumes())]
+    if len(volumes) > 1:
+        app['volume_tasks'].append(asyncio.create_task(rebalance()))
+
+
+async def cleanup(app):
+    for task in app['volume_tasks']:
+        task.cancel()
+    await asyncio.wait(app['volume_tasks'])
+    executor.shutdown(wait=False, cancel_futures=True)
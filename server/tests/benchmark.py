@@ -1,55 +1,469 @@
-from aiohttp import web
-import aiohttp_jinja2
-import jinja2
-
-routes = web.RouteTableDef()
-
-
-# benchmark using wrk on the same server
-# ./wrk -t12 -c400 -d30s http://127.0.0.1:8080/test1
-
-# NGINX
-# ./wrk -t12 -c400 -d30s http://23.100.90.119
-# Running 30s test @ http://23.100.90.119
-#   12 threads and 400 connections
-#   Thread Stats   Avg      Stdev     Max   +/- Stdev
-#     Latency    17.73ms    5.29ms  67.22ms   80.34%
-#     Req/Sec     1.86k   393.68     4.35k    90.78%
-#   666356 requests in 30.05s, 242.09MB read
-# Requests/sec:  22173.39
-# Transfer/sec:      8.06MB
-
-
-@routes.get('/test1')
-async def hello(request):
-    return web.Response(text="Hello, world\n")
-# ./wrk -t12 -c400 -d30s http://127.0.0.1:8080/test1
-# Running 30s test @ http://127.0.0.1:8080/test1
-#   12 threads and 400 connections
-#   Thread Stats   Avg      Stdev     Max   +/- Stdev
-#     Latency    70.33ms    5.33ms 302.50ms   74.24%
-#     Req/Sec   469.95    136.22   666.00     39.04%
-#   168169 requests in 30.05s, 26.30MB read
-# Requests/sec:   5595.98
-# Transfer/sec:      0.88MB
-
-
-@routes.get('/test2')
-@aiohttp_jinja2.template('test2.html')
-async def hello(request):
-    return {'name': 'Jack'}
-# Running 30s test @ http://127.0.0.1:8080/test2
-#   12 threads and 400 connections
-#   Thread Stats   Avg      Stdev     Max   +/- Stdev
-#     Latency    91.50ms    5.96ms 330.73ms   75.93%
-#     Req/Sec   360.88     86.97   666.00     87.81%
-#   129438 requests in 30.05s, 35.55MB read
-# Requests/sec:   4306.99
-# Transfer/sec:      1.18MB
-
-
-app = web.Application()
-aiohttp_jinja2.setup(app,
-    loader=jinja2.FileSystemLoader('./'))
-app.add_routes(routes)
-web.run_app(app)
+#!/usr/bin/env python
+# coding=utf-8
+"""Benchmark the real app against a local Redis
+The app is started with ENV=BENCH (see config.py), which has its own port, redis
+db and upload directory, and driven through the same APIs as the client:
+- login: signup and login storms, each client from its own address
+- broadcast: websocket clients per folder receiving every message sent to the folder
+- transfer: concurrent large encrypted uploads, then downloads of the same files
+- pull: paging through the history of large folders
+For each scenario the throughput, the latency (p50/p99), the lag of the event loop
+(from /metrics) and the peak RSS of the server are reported in json, so the
+reports of two releases can be compared:
+    python benchmark.py --workers 2 -o new.json --baseline old.json
+RSS is read from /proc, so it runs on Linux only.
+"""
+import os
+import sys
+import json
+import math
+import argparse
+import platform
+import subprocess
+from time import time
+from datetime import datetime, timezone
+from contextlib import contextmanager
+
+import asyncio
+import aiohttp
+
+HOST = '127.0.0.1:8092'
+URL = 'http://' + HOST
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+METRICS_INTERVAL = 1 # of the app in BENCH
+PAGE_SIZE = 200 # PULL_PAGE_SIZE of the app
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[max(0, math.ceil(p * len(samples)) - 1)]
+
+
+class Recorder:
+    """latencies of the operations of a kind
+    """
+    def __init__(self):
+        self.samples = []
+        self.errors = 0
+        self.bytes = 0
+
+    @contextmanager
+    def time(self):
+        started_time = time()
+        try:
+            yield
+        except (aiohttp.ClientError, asyncio.TimeoutError, AssertionError):
+            self.errors += 1
+        else:
+            self.samples.append(time() - started_time)
+
+    def summary(self, duration):
+        r = {
+            'count': len(self.samples),
+            'errors': self.errors,
+            'duration': duration,
+            'throughput': len(self.samples) / duration if duration else None, # per second
+            'p50': percentile(self.samples, 0.5),
+            'p99': percentile(self.samples, 0.99),
+            'max': max(self.samples, default=None),
+        }
+        if self.bytes:
+            r['bytes_per_second'] = self.bytes / duration
+        return r
+
+
+class Client:
+    """a user with its own cookies and address
+    """
+    count = 0
+
+    def __init__(self):
+        Client.count += 1
+        ip = '10.{}.{}.{}'.format(Client.count >> 16 & 255, Client.count >> 8 & 255, Client.count & 255)
+        self.session = aiohttp.ClientSession(
+            URL,
+            cookie_jar=aiohttp.CookieJar(unsafe=True), # cookies of an ip address
+            headers={'X-Real-IP': ip}, # REAL_IP_HEADER in BENCH
+            timeout=aiohttp.ClientTimeout(total=300))
+
+    async def signup(self, passcode):
+        async with self.session.post('/signup', data={'identity': passcode}) as r:
+            assert r.status == 201, r.status
+
+    async def login(self, passcode):
+        async with self.session.post('/login', data={'identity': passcode}) as r:
+            assert r.status == 200, r.status
+
+    async def ws(self):
+        ws = await self.session.ws_connect('/ws', max_msg_size=0)
+        assert (await ws.receive_json())['action'] == 'connect'
+        return ws
+
+    async def close(self):
+        await self.session.close()
+
+
+class Server:
+    """the app under test and the probes of its lag and memory
+    """
+    def __init__(self, workers):
+        self.workers = workers
+        self.p = None
+
+    async def start(self):
+        env = dict(os.environ, ENV='BENCH')
+        self.p = subprocess.Popen(
+            [sys.executable, '-m', 'snapfile', '--workers', str(self.workers)],
+            cwd=SERVER_DIR, env=env, stdout=subprocess.DEVNULL)
+        async with aiohttp.ClientSession(URL) as session:
+            for i in range(100):
+                if self.p.poll() is not None:
+                    raise RuntimeError('the server exited with {}'.format(self.p.returncode))
+                try:
+                    async with session.get('/stats') as r:
+                        if r.status == 200:
+                            break
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.1)
+            else:
+                raise RuntimeError('the server is not ready')
+        await asyncio.sleep(METRICS_INTERVAL) # every worker has saved its metrics
+
+    def stop(self):
+        self.p.terminate()
+        self.p.wait()
+
+    def rss(self):
+        """bytes of the server and its workers in memory
+        """
+        total = 0
+        pids = [self.p.pid]
+        try:
+            with open('/proc/{0}/task/{0}/children'.format(self.p.pid)) as f:
+                pids += [int(pid) for pid in f.read().split()]
+        except FileNotFoundError:
+            pass
+        for pid in pids:
+            try:
+                with open('/proc/{}/status'.format(pid)) as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1]) * 1024
+            except FileNotFoundError:
+                pass # a worker being restarted
+        return total
+
+    async def lag(self):
+        """the buckets (upper bound -> count) of the lag of all workers
+        """
+        async with aiohttp.ClientSession(URL) as session:
+            async with session.get('/metrics') as r:
+                text = await r.text()
+        buckets = {}
+        for line in text.splitlines():
+            if line.startswith('snapfile_event_loop_lag_seconds_bucket{'):
+                labels, value = line[line.index('{')+1:].split('} ')
+                le = dict(l.split('=', 1) for l in labels.split(','))['le'].strip('"')
+                buckets[float(le)] = buckets.get(float(le), 0) + float(value)
+        return buckets
+
+    @contextmanager
+    def sample_rss(self):
+        peak = [self.rss()]
+        async def sample():
+            while True:
+                await asyncio.sleep(0.2)
+                peak[0] = max(peak[0], self.rss())
+        task = asyncio.ensure_future(sample())
+        try:
+            yield peak
+        finally:
+            task.cancel()
+            peak[0] = max(peak[0], self.rss())
+
+
+def quantile(q, before, after):
+    """estimate a quantile from the cumulative buckets observed between before and after
+    like histogram_quantile of Prometheus
+    """
+    bounds = sorted(after)
+    counts = [after[b] - before.get(b, 0) for b in bounds]
+    total = counts[-1]
+    if not total:
+        return None
+    rank = q * total
+    lower, below = 0.0, 0
+    for bound, count in zip(bounds, counts):
+        if count >= rank:
+            if math.isinf(bound):
+                return lower
+            return lower + (bound - lower) * (rank - below) / max(count - below, 1)
+        lower, below = bound, count
+    return lower
+
+
+async def run_scenario(server, scenario, args):
+    lag_before = await server.lag()
+    with server.sample_rss() as rss:
+        result = await scenario(args)
+    await asyncio.sleep(METRICS_INTERVAL * 1.5) # the other workers save their latest metrics
+    lag_after = await server.lag()
+    result['loop_lag'] = {
+        'p50': quantile(0.5, lag_before, lag_after),
+        'p99': quantile(0.99, lag_before, lag_after),
+    }
+    result['rss_peak'] = rss[0]
+    return result
+
+
+async def bench_login(args):
+    """every client signs up its own folder at the same time, then logs in again and again
+    """
+    clients = [Client() for i in range(args.clients)]
+    signups, logins = Recorder(), Recorder()
+
+    async def signup(i, c):
+        with signups.time():
+            await c.signup('bench-login-{}'.format(i))
+
+    async def login(i, c):
+        for j in range(args.logins):
+            with logins.time():
+                await c.login('bench-login-{}'.format(i))
+
+    try:
+        started_time = time()
+        await asyncio.gather(*(signup(i, c) for i, c in enumerate(clients)))
+        signup_time = time() - started_time
+        started_time = time()
+        await asyncio.gather(*(login(i, c) for i, c in enumerate(clients)))
+        login_time = time() - started_time
+    finally:
+        await asyncio.gather(*(c.close() for c in clients))
+    return {'signup': signups.summary(signup_time), 'login': logins.summary(login_time)}
+
+
+async def bench_broadcast(args):
+    """messages sent by one connection of a folder are delivered to all its connections
+    the latency is from sending a message to receiving it on a connection
+    """
+    deliveries = Recorder()
+    clients = []
+    folders = []
+    for i in range(args.folders):
+        c = Client()
+        clients.append(c)
+        await c.signup('bench-broadcast-{}'.format(i))
+        folders.append([await c.ws() for j in range(args.ws)])
+
+    async def receive(ws):
+        received = 0
+        while received < args.messages:
+            m = await ws.receive()
+            if m.type != aiohttp.WSMsgType.TEXT:
+                deliveries.errors += args.messages - received # e.g. disconnected as a slow consumer
+                return
+            frame = json.loads(m.data)
+            if frame['action'] == 'send':
+                for msg in frame['msgs']:
+                    deliveries.samples.append(time() - float(msg['data']))
+                    received += 1
+
+    async def send(ws):
+        for i in range(args.messages):
+            await ws.send_json({'action': 'send', 'data': repr(time())})
+            await asyncio.sleep(0) # let the receivers of this process run
+
+    try:
+        started_time = time()
+        await asyncio.gather(
+            *(receive(ws) for connections in folders for ws in connections),
+            *(send(connections[0]) for connections in folders))
+        duration = time() - started_time
+    finally:
+        for connections in folders:
+            await asyncio.gather(*(ws.close() for ws in connections))
+        await asyncio.gather(*(c.close() for c in clients))
+    return {'delivery': deliveries.summary(duration)}
+
+
+async def history(ws, offset=0):
+    """pull the history from offset, return the messages
+    """
+    msgs = []
+    while True:
+        await ws.send_json({'action': 'pull', 'offset': offset + len(msgs), 'limit': PAGE_SIZE})
+        while True:
+            frame = await ws.receive_json()
+            if frame['action'] == 'pull':
+                break
+        msgs += frame['msgs']
+        if not frame['msgs'] or frame['offset'] + len(frame['msgs']) >= frame['total']:
+            return msgs
+
+
+async def bench_transfer(args):
+    """every client uploads a large file at the same time, then downloads it
+    """
+    uploads, downloads = Recorder(), Recorder()
+    content = os.urandom(args.file_size * 1024 * 1024)
+    clients = [Client() for i in range(args.uploads)]
+    for i, c in enumerate(clients):
+        await c.signup('bench-transfer-{}'.format(i))
+
+    async def upload(c):
+        data = aiohttp.FormData()
+        data.add_field('myfile[]', content, filename='large.bin', content_type='application/octet-stream')
+        with uploads.time():
+            async with c.session.post('/files', data=data) as r:
+                assert r.status == 200, r.status
+            uploads.bytes += len(content)
+
+    async def download(c):
+        ws = await c.ws()
+        msg = (await history(ws))[0]
+        await ws.close()
+        with downloads.time():
+            async with c.session.get('/files', params={'id': msg['file_id'], 'name': msg['data']}) as r:
+                assert r.status == 200, r.status
+                size = 0
+                async for chunk in r.content.iter_chunked(1024*1024):
+                    size += len(chunk)
+                assert size == len(content), size
+            downloads.bytes += size
+
+    try:
+        started_time = time()
+        await asyncio.gather(*(upload(c) for c in clients))
+        upload_time = time() - started_time
+        started_time = time()
+        await asyncio.gather(*(download(c) for c in clients))
+        download_time = time() - started_time
+    finally:
+        await asyncio.gather(*(c.close() for c in clients))
+    return {'upload': uploads.summary(upload_time), 'download': downloads.summary(download_time)}
+
+
+async def bench_pull(args):
+    """readers page through the whole history of a large folder at the same time
+    the latency is per page of PULL_PAGE_SIZE messages
+    """
+    pages = Recorder()
+    owner = Client()
+    await owner.signup('bench-pull')
+    ws = await owner.ws()
+    for i in range(args.history):
+        await ws.send_json({'action': 'send', 'data': 'message {} of the history'.format(i)})
+    received = 0
+    while received < args.history:
+        frame = await ws.receive_json()
+        if frame['action'] == 'send':
+            received += len(frame['msgs'])
+    connections = [await owner.ws() for i in range(args.readers)]
+
+    async def read(ws):
+        offset = 0
+        while offset < args.history:
+            with pages.time():
+                await ws.send_json({'action': 'pull', 'offset': offset, 'limit': PAGE_SIZE})
+                while True:
+                    frame = await ws.receive_json()
+                    if frame['action'] == 'pull':
+                        break
+                assert frame['msgs'], offset
+            offset += len(frame['msgs'])
+
+    try:
+        started_time = time()
+        await asyncio.gather(*(read(ws) for ws in connections))
+        duration = time() - started_time
+    finally:
+        await asyncio.gather(ws.close(), *(ws.close() for ws in connections))
+        await owner.close()
+    r = {'page': pages.summary(duration)}
+    r['page']['messages_per_second'] = args.history * args.readers / duration
+    return r
+
+
+SCENARIOS = {
+    'login': bench_login,
+    'broadcast': bench_broadcast,
+    'transfer': bench_transfer,
+    'pull': bench_pull,
+}
+
+
+def compare(baseline, report):
+    """print how each figure changed since the baseline
+    """
+    for name, scenario in report['scenarios'].items():
+        for op, figures in scenario.items():
+            old = baseline['scenarios'].get(name, {}).get(op)
+            if not isinstance(figures, dict) or not isinstance(old, dict):
+                continue
+            for k, v in figures.items():
+                if isinstance(v, (int, float)) and isinstance(old.get(k), (int, float)) and old[k]:
+                    print('{}.{}.{}: {:.4g} -> {:.4g} ({:+.1%})'.format(
+                        name, op, k, old[k], v, v / old[k] - 1), file=sys.stderr)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=SERVER_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main(args):
+    server = Server(args.workers)
+    await server.start()
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'date': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+            'args': vars(args),
+        },
+        'scenarios': {},
+    }
+    try:
+        for name in args.scenarios.split(','):
+            print('running {} ...'.format(name), file=sys.stderr)
+            report['scenarios'][name] = await run_scenario(server, SCENARIOS[name], args)
+    finally:
+        server.stop()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma separated, default: %(default)s')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes of the app')
+    parser.add_argument('--clients', type=int, default=16, help='login: clients signing up at the same time')
+    parser.add_argument('--logins', type=int, default=2, help='login: logins per client')
+    parser.add_argument('--folders', type=int, default=4, help='broadcast: folders')
+    parser.add_argument('--ws', type=int, default=16, help='broadcast: websocket connections per folder')
+    parser.add_argument('--messages', type=int, default=100, help='broadcast: messages sent to each folder')
+    parser.add_argument('--uploads', type=int, default=4, help='transfer: concurrent uploads and downloads')
+    parser.add_argument('--file-size', type=int, default=16, help='transfer: MB per file')
+    parser.add_argument('--history', type=int, default=2000, help='pull: messages in the folder')
+    parser.add_argument('--readers', type=int, default=4, help='pull: connections pulling the history')
+    parser.add_argument('-o', '--output', help='write the report to a file instead of stdout')
+    parser.add_argument('--baseline', help='a previous report to compare with')
+    args = parser.parse_args()
+    report = asyncio.run(main(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(json.load(f), report)
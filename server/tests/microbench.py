@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""Microbenchmarks of the per-message and per-chunk hot paths
+Each path is timed in isolation (the best of a few runs) and compared with the
+baseline in microbench.json. A path slower than its baseline by more than the
+threshold is a regression, which makes the exit status 1:
+    python microbench.py                 # compare with the baseline
+    python microbench.py --save          # record a new baseline
+The paths going through redis use db 14 of the local Redis (the db of ENV=BENCH)
+and are skipped with --no-redis. Timings depend on the machine, so record the
+baseline on the machine that runs the comparison.
+"""
+import os
+import sys
+import json
+import timeit
+import argparse
+import platform
+import tempfile
+from time import perf_counter
+
+import asyncio
+
+os.environ['ENV'] = 'BENCH'
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from snapfile import config
+from snapfile import model
+from snapfile import codec
+from snapfile import compression
+from snapfile.model import Message, MsgType, Folder, format_size
+from snapfile.transfer import UploadSink, DownloadSource
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'microbench.json')
+REPEAT = 7 # runs of which the best is taken
+RUN_TIME = 0.1 # seconds of a run at least
+CONFIRM = 3 # times a path which looks slower is measured again, a slowdown by noise rarely lasts
+CHUNK = 1024*1024 # bytes of a chunk uploaded or downloaded
+benchmarks = [] # (name, function, whether it's a coroutine function, whether it needs redis)
+
+
+def benchmark(name, redis=False):
+    def decorator(f):
+        benchmarks.append((name, f, asyncio.iscoroutinefunction(f), redis))
+        return f
+    return decorator
+
+
+def new_folder(identity='microbench'):
+    folder = Folder(identity, path='microbench', salt=os.urandom(16).hex())
+    folder.encryption_key = bytearray(os.urandom(32))
+    return folder
+
+
+def new_message(i=0):
+    return Message(type=MsgType.TEXT, data='a message of ordinary length {}'.format(i) * 4,
+                   size=120, sender='Mac OS X/Chrome')
+
+
+folder = new_folder()
+msg = new_message()
+record = None # an encrypted message, see run_all
+
+
+@benchmark('format_size')
+def bench_format_size():
+    format_size(123456789)
+
+
+@benchmark('Message.format_for_view')
+def bench_format_for_view():
+    msg.format_for_view()
+
+
+@benchmark('Folder.serialize')
+def bench_serialize():
+    folder.serialize()
+
+
+@benchmark('codec.pack')
+def bench_pack():
+    codec.pack(msg, 0, msg.data.encode('utf-8'), True)
+
+
+@benchmark('Folder._decode') # decrypt and unpack a record of the history
+def bench_decode():
+    folder._decode(record, {0: 'Mac OS X/Chrome'})
+
+
+@benchmark('Folder.save', redis=True) # encrypt, pack and append
+async def bench_save():
+    await folder.save(msg)
+
+
+@benchmark('Folder.retrieve', redis=True) # a page of PULL_PAGE_SIZE messages
+async def bench_retrieve():
+    await folder.retrieve(0, config.PULL_PAGE_SIZE)
+
+
+class Chunks:
+    """the crypto loops of uploads and downloads, CHUNK bytes a time
+    a compressed file is a text of logs, otherwise random bytes
+    """
+    def __init__(self, directory, compress=False):
+        self.path = os.path.join(directory, 'compressed' if compress else 'file')
+        if compress:
+            self.data = b''.join(b'line %d of a log\n' % i for i in range(CHUNK))[:CHUNK]
+        else:
+            self.data = os.urandom(CHUNK)
+        self.nonce = nonce = os.urandom(16)
+        header = compression.header(nonce) if compress else nonce
+        self.sink = UploadSink(self.path, folder.get_encryptor(nonce), header, compress=compress)
+        self.sink.file = self.sink._open()
+        self.sink._write(self.data)
+        self.sink.file.flush()
+        self.source = DownloadSource(os.open(self.sink.tmp_path, os.O_RDONLY), os.stat(self.sink.tmp_path))
+        self.source.header_size = len(header)
+        self.get_decryptor = lambda offset: folder.get_decryptor(nonce, offset)
+        self.decryptor = folder.get_decryptor(nonce)
+
+    def upload(self):
+        # the same chunk is written again, so the file stays readable by download
+        self.sink.encryptor = folder.get_encryptor(self.nonce)
+        self.sink.file.seek(self.source.header_size)
+        self.sink._write(self.data)
+
+    def download(self):
+        if self.sink.compress:
+            self.source._read_frame(self.source.header_size, 0, 0, CHUNK, self.get_decryptor)
+        else:
+            self.source._read(self.source.header_size, CHUNK, self.decryptor)
+
+    def close(self):
+        os.close(self.source.fd)
+        self.sink._abort()
+
+
+def measure(f, is_async, loop):
+    """return the best time of a call in seconds
+    """
+    if is_async:
+        def run(number):
+            started_time = perf_counter()
+            loop.run_until_complete(_run_async(f, number))
+            return perf_counter() - started_time
+    else:
+        timer = timeit.Timer(f)
+        run = timer.timeit
+    number = 1
+    while run(number) < RUN_TIME: # calibrated like timeit.autorange
+        number *= 10
+    return min(run(number) for i in range(REPEAT)) / number
+
+
+async def _run_async(f, number):
+    for i in range(number):
+        await f()
+
+
+def run_all(args, loop, baseline):
+    global record
+    results = {}
+    if not args.no_redis:
+        loop.run_until_complete(model.connect())
+        loop.run_until_complete(model.redis.hset(Folder._keys(folder.identity)[0], mapping=folder.serialize()))
+        # a history to be retrieved
+        for i in range(config.PULL_PAGE_SIZE):
+            loop.run_until_complete(folder.save(new_message(i)))
+    cipher, nonce = folder.get_cipher()
+    record = codec.pack(msg, 0, nonce + cipher.encryptor().update(msg.data.encode('utf-8')), True)
+    with tempfile.TemporaryDirectory() as directory:
+        chunks = Chunks(directory)
+        compressed = Chunks(directory, compress=True)
+        extra = [
+            ('upload chunk (encrypt and write)', chunks.upload, False, False),
+            ('download chunk (read and decrypt)', chunks.download, False, False),
+            ('upload chunk (compress, encrypt and write)', compressed.upload, False, False),
+            ('download chunk (read, decrypt and decompress)', compressed.download, False, False),
+        ]
+        try:
+            for name, f, is_async, redis in benchmarks + extra:
+                if (args.filter and args.filter not in name) or (redis and args.no_redis):
+                    continue
+                t = measure(f, is_async, loop)
+                for i in range(CONFIRM):
+                    if name not in baseline or t <= baseline[name] * (1 + args.threshold):
+                        break
+                    t = min(t, measure(f, is_async, loop))
+                results[name] = t
+        finally:
+            chunks.close()
+            compressed.close()
+            if not args.no_redis:
+                loop.run_until_complete(model.redis.delete(*Folder._all_keys(folder.identity)))
+                loop.run_until_complete(model.redis.aclose())
+    return results
+
+
+def machine():
+    return '{} {} python {}'.format(platform.machine(), platform.processor() or platform.system(),
+                                    platform.python_version())
+
+
+def report(results, baseline, threshold):
+    """print the results against the baseline
+    return the names of the paths which regress
+    """
+    regressions = []
+    print('{:40} {:>12} {:>12} {:>8}'.format('path', 'time', 'baseline', 'change'))
+    for name, t in results.items():
+        old = baseline.get(name)
+        change = ''
+        if old:
+            change = '{:+.1%}'.format(t / old - 1)
+            if t > old * (1 + threshold):
+                regressions.append(name)
+                change += ' !'
+        print('{:40} {:>10.2f}us {:>10}   {:>8}'.format(
+            name, t * 1e6, '{:.2f}us'.format(old * 1e6) if old else '-', change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--baseline', default=BASELINE, help='default: %(default)s')
+    parser.add_argument('--save', action='store_true', help='record the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown beyond which a path regresses, default: %(default)s')
+    parser.add_argument('--filter', help='only the paths whose name contains it')
+    parser.add_argument('--no-redis', action='store_true', help='skip the paths going through redis')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        baseline = saved['results']
+        if saved['machine'] != machine():
+            print('the baseline is recorded on {}'.format(saved['machine']), file=sys.stderr)
+    loop = asyncio.new_event_loop()
+    try:
+        results = run_all(args, loop, {} if args.save else baseline)
+    finally:
+        loop.close()
+    regressions = report(results, baseline, args.threshold)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': machine(), 'results': dict(baseline, **results)}, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('baseline saved to {}'.format(args.baseline))
+    elif regressions:
+        print('{} regressed by more than {:.0%}'.format(', '.join(regressions), args.threshold))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,24 @@
 #!/usr/bin/env
 # coding=utf-8
 
+import io
 import os
 import json
+import base64
+import socket
+import shutil
+import struct
+import zlib
+import hashlib
+import zipfile
 import unittest
 import subprocess
-from time import sleep
+from glob import glob
+from time import sleep, time
+from concurrent.futures import ThreadPoolExecutor
 from collections.abc import Iterable
 
+import redis
 import requests
 import websocket # websocket_client
 
@@ -43,6 +54,8 @@ def err(p):
 class BaseTestCase(unittest.TestCase):
     identity = 0
     log = None
+    args = '' # of the server
+    env = '' # variables of the server, e.g. 'SNAPFILE_VOLUMES=./upload2'
 
     @classmethod
     def count(cls):
@@ -53,7 +66,7 @@ class BaseTestCase(unittest.TestCase):
     def setUpClass(cls):
         if os.path.isfile(LOG):
             os.remove(LOG)
-        cmd = 'cd .. && ENV=TEST exec python -m snapfile -u'
+        cmd = 'cd .. && ENV=TEST {} exec python -m snapfile -u '.format(cls.env) + cls.args
         p = subprocess.Popen(
             cmd,
             # stdin=open(os.devnull),
@@ -124,10 +137,25 @@ class BaseTestCase(unittest.TestCase):
         self.s.raw_cookie = self.cookie
         self.s.cookies.clear()
 
-    def ws(self):
+    def worker(self):
+        """the label of the metrics of the server running a single worker
+        """
+        return 'MainProcess@{}:{}'.format(socket.gethostname(), self.p.pid)
+
+    def identity_hash(self):
+        return hashlib.sha3_256(self.i.encode('utf-8')).hexdigest()[0:-1:4]
+
+    def remove_files(self):
+        """delete the directory of the folder, e.g. its segments, once the test is over
+        """
+        for path in glob('../upload/*/{}'.format(self.identity_hash())):
+            shutil.rmtree(path)
+
+    def ws(self, **kwargs):
         c = websocket.create_connection("ws://" + HOST + '/ws',
             timeout=1,
-            header={'Cookie': self.cookie})
+            header={'Cookie': self.cookie},
+            **kwargs)
         r = c.recv()
         r = json.loads(r)
         self.assertEqual(r['action'], 'connect')
@@ -145,6 +173,9 @@ class BaseTestCase(unittest.TestCase):
     def recv(self, c, file=False):
         r = c.recv()
         r = json.loads(r)
+        while r['action'] == 'uploading':
+            # a large file is announced before it's uploaded
+            r = json.loads(c.recv())
         self.assertEqual(r['action'], 'send')
         msgs = r['msgs']
         self.assertEqual(len(msgs), 1)
@@ -153,6 +184,22 @@ class BaseTestCase(unittest.TestCase):
         else:
             return msgs[0]['data']
 
+    def start_upload(self, name, content):
+        """send the first half of a file, return the socket and the rest of the request
+        """
+        boundary = 'snapfile-boundary'
+        head = ('--{}\r\nContent-Disposition: form-data; name="myfile[]"; filename="{}"\r\n'
+                'Content-Type: application/octet-stream\r\n\r\n').format(boundary, name).encode()
+        body = head + content + '\r\n--{}--\r\n'.format(boundary).encode()
+        host, port = HOST.split(':')
+        sock = socket.create_connection((host, int(port)))
+        sock.sendall(('POST /files HTTP/1.1\r\nHost: {}\r\nCookie: {}\r\n'
+                      'Content-Type: multipart/form-data; boundary={}\r\nContent-Length: {}\r\n\r\n').format(
+                          HOST, self.cookie, boundary, len(body)).encode())
+        half = len(head) + len(content) // 2
+        sock.sendall(body[:half])
+        return sock, body[half:]
+
     def pull(self, c, o=0):
         data = json.dumps({
             'action': 'pull',
@@ -180,6 +227,44 @@ class TestLogin(BaseTestCase):
         r = self.r('post', '/login', data={'identity': self.i})
         self.assertEqual(r.status_code, 200)
 
+    def test_folder_recreated(self):
+        """the session of a deleted folder is refused by a folder created again with the same passcode
+        """
+        old = self.cookie
+        db = redis.Redis()
+        # deleted as it expires
+        db.delete('folder:' + self.identity_hash(), 'messages:' + self.identity_hash())
+        db.publish('expired:' + self.identity_hash(), '')
+        db.close()
+        r = self.r('post', '/signup', data={'identity': self.i})
+        self.assertEqual(r.status_code, 201)
+        self.cookie = r.headers['Set-Cookie']
+        for i in range(4):
+            r = self.r('post', '/files', files=[('myfile[]', ('a.txt', 'old key'))], headers={'Cookie': old})
+            self.assertEqual(r.status_code, 401)
+        c = self.ws()
+        self.send(c, 'new key')
+        self.assertEqual([m['data'] for m in self.pull(c)], ['new key'])
+
+    def test_login_storm(self):
+        """key derivations from one client beyond KDF_QUEUE_PER_CLIENT are refused
+        """
+        def signup(i):
+            return self.r('post', '/signup', data={'identity': 'storm{}-{}'.format(self.i, i)})
+        with ThreadPoolExecutor(8) as executor:
+            codes = [r.status_code for r in executor.map(signup, range(8))]
+        self.assertIn(201, codes)
+        self.assertIn(429, codes)
+        self.assertEqual(set(codes), {201, 429})
+        r = self.r('get', '/stats')
+        self.assertEqual(r.status_code, 200)
+        # a signup is admitted once
+        self.assertEqual(r.json()['kdf']['rejected'], codes.count(429))
+        # and a refused one leaves no folder behind
+        i = codes.index(429)
+        r = self.r('post', '/login', data={'identity': 'storm{}-{}'.format(self.i, i)})
+        self.assertEqual(r.status_code, 401)
+
     def test_logout(self):
         r = self.r('post', '/logout')
         self.assertEqual(r.status_code, 401)
@@ -189,6 +274,56 @@ class TestLogin(BaseTestCase):
         self.assertIn('login.html', r.headers['Location'])
 
 
+    def folder_stats(self):
+        return self.r('get', '/stats').json()['folders']
+
+    def test_folder_evicted(self):
+        """an idle folder is evicted with its key wiped and opened again with the key in the session
+        """
+        before = self.folder_stats()
+        sleep(3)
+        after = self.folder_stats()
+        self.assertGreater(after['evicted'], before['evicted'])
+        self.assertGreater(after['wiped'], before['wiped'])
+        r = self.s.get('/auth')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.folder_stats()['misses'], after['misses'] + 1)
+
+    def test_folder_in_use(self):
+        """a folder with websocket connections is never evicted
+        """
+        c = self.ws()
+        sleep(3)
+        for i in range(5):
+            r = self.r('post', '/signup', data={'identity': 'lru%d' % i})
+            self.assertEqual(r.status_code, 201)
+        before = self.folder_stats()
+        self.assertLessEqual(before['size'], 4)
+        self.ws()
+        self.assertEqual(self.folder_stats()['hits'], before['hits'] + 1)
+
+    def test_legacy_folder(self):
+        """a folder saved in json is converted to a hash when it's opened
+        """
+        r = redis.Redis() # db 0 in test
+        key = 'folder:' + self.identity_hash()
+        folder = {k.decode('utf-8'): v.decode('utf-8') for k, v in r.hgetall(key).items()}
+        folder['age'] = int(folder['age'])
+        folder['storage_limit'] = int(folder['storage_limit'])
+        folder['current_size'] = 5
+        r.set(key, json.dumps(folder))
+        sleep(3) # evicted from the cache
+        resp = self.r('post', '/login', data={'identity': self.i})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(r.type(key), b'hash')
+        self.assertEqual(r.hget(key, 'current_size'), b'5')
+        self.assertEqual(r.hget(key, 'salt').decode('utf-8'), folder['salt'])
+        r.close()
+        c = websocket.create_connection("ws://" + HOST + '/ws', timeout=1, header={'Cookie': resp.headers['Set-Cookie']})
+        self.connections.append(c)
+        self.assertEqual(json.loads(c.recv())['info']['current_size'], '5.0B')
+
+
 class TestMessaging(BaseTestCase):
     def test_send(self):
         c = self.ws()
@@ -204,6 +339,101 @@ class TestMessaging(BaseTestCase):
         self.assertEqual(msgs[0]['data'], '222')
         self.assertEqual(msgs[1]['data'], '333')
 
+    def test_pull_pages(self):
+        c = self.ws()
+        for text in ['111', '222', '333', '444', '555']:
+            self.send(c, text)
+        def pull(**kwargs):
+            c.send(json.dumps(dict(action='pull', **kwargs)))
+            r = json.loads(c.recv())
+            self.assertEqual(r['action'], 'pull')
+            self.assertEqual(r['total'], 5)
+            return r['offset'], [m['data'] for m in r['msgs']]
+        # page forward, at most 2 messages per page in test
+        self.assertEqual(pull(offset=0), (0, ['111', '222']))
+        self.assertEqual(pull(offset=2), (2, ['333', '444']))
+        self.assertEqual(pull(offset=4), (4, ['555']))
+        self.assertEqual(pull(offset=5), (5, []))
+        self.assertEqual(pull(offset=0, limit=1), (0, ['111']))
+        # page backward from the latest message
+        self.assertEqual(pull(before=None), (3, ['444', '555']))
+        self.assertEqual(pull(before=3), (1, ['222', '333']))
+        self.assertEqual(pull(before=1), (0, ['111']))
+        self.assertEqual(pull(before=0), (0, []))
+        # out of range
+        self.assertEqual(pull(offset=0, limit=-1), (0, ['111']))
+        self.assertEqual(pull(offset=-2), (0, ['111', '222']))
+        self.assertEqual(pull(before=-1), (0, []))
+        self.assertEqual(pull(), (0, ['111', '222']))
+        # malformed, ignored without closing the connection
+        c.send(json.dumps(dict(action='pull', before='abc')))
+        c.send(json.dumps(dict(action='pull', offset=[1])))
+        self.assertEqual(pull(offset='1', limit='1'), (1, ['222']))
+        self.checkLog('malformed pull')
+
+    def test_legacy_message(self):
+        """messages saved as json are readable and converted by snapfile-migrate
+        """
+        c = self.ws()
+        self.send(c, 'hello world')
+        r = redis.Redis() # db 0 in test
+        key = 'messages:' + self.identity_hash()
+        record = r.lindex(key, 0)
+        # the binary record as it was saved in json before
+        _, type, _, _, size, _, _ = struct.unpack_from('!BBBHQqQ', record)
+        r.lset(key, 0, json.dumps({
+            'type': type,
+            'date': '2024-01-01T00:00:00+00:00',
+            'data': base64.b64encode(record[29:]).decode('ascii'),
+            'size': size,
+            'sender': 'legacy',
+            'file_id': None}))
+        msgs = self.pull(c)
+        self.assertEqual(msgs[0]['data'], 'hello world')
+        self.assertEqual(msgs[0]['sender'], 'legacy')
+        p = subprocess.run('cd .. && ENV=TEST python -m snapfile.migrate', shell=True, capture_output=True)
+        self.assertEqual(p.returncode, 0, p.stderr)
+        self.assertIn(b'1 messages in 1 folders converted', p.stderr)
+        self.assertNotEqual(r.lindex(key, 0)[:1], b'{')
+        msgs = self.pull(c)
+        self.assertEqual(msgs[0]['data'], 'hello world')
+        self.assertEqual(msgs[0]['sender'], 'legacy')
+        self.assertEqual(msgs[0]['date'], '2024-01-01T00:00:00+00:00')
+        r.close()
+
+    def test_send_offset(self):
+        c1 = self.ws()
+        c2 = self.ws()
+        self.send(c1, 'hi')
+        self.send(c1, 'there')
+        self.recv(c2)
+        r = json.loads(c2.recv())
+        self.assertEqual(r['offset'], 1)
+
+    def test_slow_consumer(self):
+        """a connection which does not read is disconnected without holding up the others
+        """
+        # validating utf-8 in python is so slow that the folder (8 seconds in test) would expire meanwhile
+        c1 = self.ws(skip_utf8_validation=True)
+        c2 = self.ws(skip_utf8_validation=True)
+        c3 = self.ws(skip_utf8_validation=True) # never reads
+        text = 'x' * 100000
+        for i in range(100):
+            self.send(c1, text)
+            self.assertEqual(self.recv(c2), text)
+        frames = 0
+        c3.settimeout(5)
+        while True:
+            opcode, data = c3.recv_data()
+            if opcode == websocket.ABNF.OPCODE_CLOSE:
+                break
+            frames += 1
+        self.assertLess(frames, 100)
+        self.assertEqual(struct.unpack('!H', data[:2])[0], 4001)
+        self.checkLog('too slow')
+        r = self.r('get', '/stats')
+        self.assertGreater(r.json()['fanout']['disconnected'], 0)
+
     def test_3_connections(self):
         """open 3 tabs in 1 browser
         """
@@ -300,6 +530,27 @@ class TestFileUpload(BaseTestCase):
                 'size': '500.0KB'
             })
 
+    def test_upload_duplicate(self):
+        """the same content uploaded again refers to the first copy
+        """
+        c = self.ws()
+        content = os.urandom(1000)
+        for name in ('a.bin', 'b.bin'):
+            r = self.s.post('/files', files=[('myfile[]', (name, content))])
+            self.assertEqual(r.status_code, 200)
+        a, b = self.recv(c, file=True), self.recv(c, file=True)
+        self.assertEqual(a['file_id'], b['file_id'])
+        self.checkLog('b.bin is a duplicate of file {}'.format(a['file_id']))
+        self.assertEqual(len(glob('../upload/*/{}/*'.format(self.identity_hash()))), 1)
+        r = redis.Redis()
+        self.assertEqual(r.hget('folder:' + self.identity_hash(), 'current_size'), b'1000')
+        r.close()
+        r = self.s.get('/files', params={'id': b['file_id'], 'name': b['data']})
+        self.assertEqual(r.content, content)
+        # a different content is a new file
+        self.s.post('/files', files=[('myfile[]', ('c.bin', content[1:]))])
+        self.assertNotEqual(self.recv(c, file=True)['file_id'], a['file_id'])
+
     def test_download(self):
         c = self.ws()
         file_content = 'I am in a file'
@@ -316,11 +567,244 @@ class TestFileUpload(BaseTestCase):
         self.assertEqual(int(r.headers['content-length']), content_length)
         self.assertEqual(r.content.decode(), file_content)
 
+    def test_download_cached(self):
+        """a small file uploaded is downloaded from memory
+        """
+        c = self.ws()
+        file_content = b'I am in a file' * 100
+        r = self.s.post('/files', files=[('myfile[]', ('small.txt', file_content))])
+        self.assertEqual(r.status_code, 200)
+        m = self.recv(c, file=True)
+        before = self.r('get', '/stats').json()['files']
+        # not read from the disk any more
+        path, = glob('../upload/*/{}/*'.format(self.identity_hash()))
+        os.remove(path)
+        params = {'id':m['file_id'], 'name': m['data']}
+        r = self.s.get('/files', params=params)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, file_content)
+        r = self.s.get('/files', params=params, headers={'Range': 'bytes=10-19', 'If-Range': r.headers['ETag']})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.content, file_content[10:20])
+        after = self.r('get', '/stats').json()['files']
+        self.assertEqual(after['hits'], before['hits'] + 2)
+
+    def test_upload_small_files(self):
+        """small files are packed into the segments of the folder
+        """
+        self.addCleanup(self.remove_files)
+        c = self.ws()
+        contents = [os.urandom(10*1000) for i in range(8)]
+        contents.append(b'a compressible file\n' * 500)
+        contents.append(contents[0]) # a duplicate
+        file_ids = []
+        for i, content in enumerate(contents):
+            r = self.s.post('/files', files=[('myfile[]', ('{}.bin'.format(i), content))])
+            self.assertEqual(r.status_code, 200)
+            file_ids.append(self.recv(c, file=True)['file_id'])
+        self.assertEqual(file_ids[-1], file_ids[0])
+        paths = glob('../upload/*/{}/*'.format(self.identity_hash()))
+        self.assertEqual(sorted(os.path.basename(p) for p in paths), ['segment-0', 'segment-1'])
+        for file_id, content in zip(file_ids, contents):
+            r = self.s.get('/files', params={'id':file_id, 'name': 'a.bin'})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.content, content)
+        r = self.s.get('/files', params={'id':file_ids[8], 'name': 'a.txt'}, headers={'Range': 'bytes=100-199'})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.content, contents[8][100:200])
+
+    def test_download_while_uploading(self):
+        """a file is downloaded by another device as it's uploaded
+        """
+        c = self.ws()
+        file_content = os.urandom(800*1000)
+        sock, rest = self.start_upload('large.bin', file_content)
+        r = json.loads(c.recv())
+        self.assertEqual(r['action'], 'uploading')
+        m = r['msgs'][0]
+        r = self.s.get('/files', params={'id':m['file_id'], 'name': m['data']}, stream=True)
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn('content-length', r.headers)
+        received = r.raw.read(1000)
+        sock.sendall(rest)
+        received += r.raw.read()
+        self.assertEqual(received, file_content)
+        self.assertIn(b'200 OK', sock.recv(1024))
+        sock.close()
+        # it's over, the file follows
+        frame = json.loads(c.recv())
+        self.assertEqual(frame['action'], 'uploading')
+        self.assertEqual(frame['state'], 'committed')
+        self.assertEqual(self.recv(c, file=True)['file_id'], m['file_id'])
+
+    def test_download_aborted_upload(self):
+        """the download of a file whose upload is aborted is cut short
+        """
+        c = self.ws()
+        file_content = ''.join('line {} of a log\n'.format(i) for i in range(40000)).encode()
+        sock, rest = self.start_upload('app.log', file_content)
+        m = json.loads(c.recv())['msgs'][0]
+        r = self.s.get('/files', params={'id':m['file_id'], 'name': m['data']}, stream=True)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.raw.read(100), file_content[:100])
+        sock.close()
+        frame = json.loads(c.recv())
+        self.assertEqual(frame['action'], 'uploading')
+        self.assertEqual(frame['state'], 'aborted')
+        with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+            r.content
+        sleep(0.1)
+        # the upload interrupted is logged with a traceback by aiohttp
+        self.checkLog('stop downloading file app.log which is aborted', 'Connection lost')
+
+    def test_download_large(self):
+        """a file spanning many chunks is decrypted correctly
+        """
+        c = self.ws()
+        file_content = os.urandom(900*1000)
+        files = [
+            ('myfile[]', ('large.bin', file_content)),
+        ]
+        r = self.s.post('/files', files=files)
+        self.assertEqual(r.status_code, 200)
+        m = self.recv(c, file=True)
+        r = self.s.get('/files', params={'id':m['file_id'], 'name': m['data']})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(int(r.headers['content-length']), len(file_content))
+        self.assertEqual(r.content, file_content)
+
+    def test_upload_compressed(self):
+        """a compressible file is compressed on disk and decompressed when downloaded
+        """
+        c = self.ws()
+        file_content = ''.join('line {} of a log\n'.format(i) for i in range(40000)).encode()
+        r = self.s.post('/files', files=[('myfile[]', ('app.log', file_content))])
+        self.assertEqual(r.status_code, 200)
+        m = self.recv(c, file=True)
+        path, = glob('../upload/*/{}/*'.format(self.identity_hash()))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(8), b'SNAPZLIB')
+        self.assertLess(os.path.getsize(path), len(file_content) / 4)
+        params = {'id':m['file_id'], 'name': m['data']}
+        r = self.s.get('/files', params=params)
+        self.assertEqual(int(r.headers['content-length']), len(file_content))
+        self.assertEqual(r.content, file_content)
+        r = self.s.get('/files', params=params, headers={'Range': 'bytes=300000-400000'})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.content, file_content[300000:400001])
+        r = self.s.get('/files', params=params, headers={'Range': 'bytes=-10'})
+        self.assertEqual(r.content, file_content[-10:])
+
+    def test_download_range(self):
+        c = self.ws()
+        file_content = os.urandom(900*1000)
+        files = [
+            ('myfile[]', ('large.bin', file_content)),
+        ]
+        r = self.s.post('/files', files=files)
+        self.assertEqual(r.status_code, 200)
+        m = self.recv(c, file=True)
+        params = {'id':m['file_id'], 'name': m['data']}
+        # resume from the middle of a ChaCha20 block
+        r = self.s.get('/files', params=params, headers={'Range': 'bytes=100001-'})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.headers['Content-Range'], 'bytes 100001-899999/900000')
+        self.assertEqual(r.content, file_content[100001:])
+        etag = r.headers['ETag']
+        r = self.s.get('/files', params=params, headers={'Range': 'bytes=-10', 'If-Range': etag})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.content, file_content[-10:])
+        # the file has changed
+        r = self.s.get('/files', params=params, headers={'Range': 'bytes=-10', 'If-Range': '"0-0"'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, file_content)
+        r = self.s.get('/files', params=params, headers={'Range': 'bytes=0-9,500000-500099'})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(int(r.headers['content-length']), len(r.content))
+        boundary = r.headers['Content-Type'].split('boundary=')[1]
+        parts = r.content.split(b'--' + boundary.encode())
+        self.assertEqual(len(parts), 4) # preamble, 2 parts and the epilogue
+        self.assertIn(b'Content-Range: bytes 0-9/900000', parts[1])
+        self.assertTrue(parts[1].endswith(b'\r\n\r\n' + file_content[:10] + b'\r\n'))
+        self.assertIn(b'Content-Range: bytes 500000-500099/900000', parts[2])
+        self.assertTrue(parts[2].endswith(b'\r\n\r\n' + file_content[500000:500100] + b'\r\n'))
+        r = self.s.get('/files', params=params, headers={'Range': 'bytes=900000-'})
+        self.assertEqual(r.status_code, 416)
+        self.assertEqual(r.headers['Content-Range'], 'bytes */900000')
+
     def test_download_404(self):
         r = self.s.get('/files', params={'id':999, 'name': 'does not exist.txt'})
         self.assertEqual(r.status_code, 404)
         # NGINX will return 404
 
+    def test_download_zip(self):
+        """the files of a folder are streamed in a ZIP archive
+        """
+        self.addCleanup(self.remove_files)
+        c = self.ws()
+        contents = [os.urandom(1000), b'a compressible file\n' * 5000, os.urandom(100*1000)]
+        file_ids = []
+        for content in contents:
+            r = self.s.post('/files', files=[('myfile[]', ('a.bin', content))])
+            self.assertEqual(r.status_code, 200)
+            file_ids.append(self.recv(c, file=True)['file_id'])
+        # not recorded, e.g. uploaded before, so it's computed
+        db = redis.Redis()
+        crc_key = '{}:crc32'.format(file_ids[2])
+        db.hdel('refs:' + self.identity_hash(), crc_key)
+        r = self.s.get('/files/zip', headers={'Range': 'bytes=-100'})
+        self.assertEqual(r.status_code, 206)
+        tail = r.content
+        r = self.s.get('/files/zip', params={'name': 'all.zip'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers['Content-Type'], 'application/zip')
+        self.assertIn('filename="all.zip"', r.headers['Content-Disposition'])
+        self.assertEqual(int(r.headers['content-length']), len(r.content))
+        self.assertEqual(r.content[-100:], tail)
+        with zipfile.ZipFile(io.BytesIO(r.content)) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(z.namelist(), ['a.bin', 'a (1).bin', 'a (2).bin'])
+            self.assertEqual([z.read(n) for n in z.namelist()], contents)
+        whole = r.content
+        r = self.s.get('/files/zip', headers={'Range': 'bytes=500-1499,50000-50099'})
+        self.assertEqual(r.status_code, 206)
+        parts = r.content.split(b'--' + r.headers['Content-Type'].split('boundary=')[1].encode())
+        self.assertTrue(parts[1].endswith(b'\r\n\r\n' + whole[500:1500] + b'\r\n'))
+        self.assertTrue(parts[2].endswith(b'\r\n\r\n' + whole[50000:50100] + b'\r\n'))
+        r = self.s.get('/files/zip', params={'ids': '{},{}'.format(file_ids[0], file_ids[2])})
+        with zipfile.ZipFile(io.BytesIO(r.content)) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual([z.read(n) for n in z.namelist()], [contents[0], contents[2]])
+        r = self.s.get('/files/zip', params={'ids': '999'})
+        self.assertEqual(r.status_code, 404)
+        # and recorded
+        self.assertIsNotNone(db.hget('refs:' + self.identity_hash(), crc_key))
+        db.close()
+
+    def test_upload_abort(self):
+        """an interrupted upload leaves no file behind
+        """
+        boundary = 'snapfileboundary'
+        part = ('--{}\r\n'
+            'Content-Disposition: form-data; name="myfile[]"; filename="big.bin"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n').format(boundary).encode()
+        head = ('POST /files HTTP/1.1\r\n'
+            'Host: {}\r\n'
+            'Cookie: {}\r\n'
+            'Content-Type: multipart/form-data; boundary={}\r\n'
+            'Content-Length: {}\r\n\r\n').format(HOST, self.cookie, boundary, len(part) + 900*1000).encode()
+        s = socket.create_connection(HOST.split(':'))
+        s.sendall(head + part + b'0'*300*1000)
+        sleep(0.5)
+        s.close()
+        sleep(0.5)
+        self.checkLog('interrupt uploading big.bin')
+        self.assertEqual(glob('../upload/*/{}/*'.format(self.identity_hash())), [])
+        # the storage reserved is released
+        r = redis.Redis()
+        self.assertEqual(r.hget('folder:' + self.identity_hash(), 'reserved'), b'0')
+        r.close()
+
     def test_upload_out_of_space(self):
         files = [
             ('myfile[]', ('large.txt', '0'*1024*1024*2)),
@@ -329,31 +813,431 @@ class TestFileUpload(BaseTestCase):
         self.assertEqual(r.status_code, 431)
 
 
+class TestResumableUpload(BaseTestCase):
+    def create(self, size):
+        r = self.s.post('/uploads', data={'size': size})
+        self.assertEqual(r.status_code, 201)
+        return r.json()
+
+    def put(self, upload, index, content):
+        offset = index * upload['chunk_size']
+        chunk = content[offset:offset+upload['chunk_size']]
+        return self.s.put('/uploads/{}/{}'.format(upload['id'], index), data=chunk)
+
+    def test_upload_out_of_order(self):
+        c = self.ws()
+        content = os.urandom(600*1000)
+        upload = self.create(len(content))
+        self.assertEqual(upload['chunk_size'], 256*1024)
+        self.assertEqual(upload['received'], [])
+        self.assertEqual(self.put(upload, 2, content).status_code, 204)
+        self.assertEqual(self.put(upload, 0, content).status_code, 204)
+        r = self.s.get('/uploads/{}'.format(upload['id']))
+        self.assertEqual(r.json()['received'], [0, 2])
+        r = self.s.post('/uploads/{}'.format(upload['id']), data={'name': 'resumed.bin'})
+        self.assertEqual(r.status_code, 409)
+        # a retried chunk simply overwrites the previous attempt
+        self.assertEqual(self.put(upload, 1, content).status_code, 204)
+        self.assertEqual(self.put(upload, 1, content).status_code, 204)
+        r = self.s.post('/uploads/{}'.format(upload['id']), data={'name': 'resumed.bin'})
+        self.assertEqual(r.status_code, 200)
+        m = self.recv(c, file=True)
+        self.assertDictContainsSubset(m, {'data': 'resumed.bin', 'size': '600.0KB'})
+        r = self.s.get('/files', params={'id':m['file_id'], 'name': m['data']})
+        self.assertEqual(r.content, content)
+        r = self.s.get('/uploads/{}'.format(upload['id']))
+        self.assertEqual(r.status_code, 404)
+
+    def upload(self, name, content):
+        upload = self.create(len(content))
+        for i in range((len(content) + upload['chunk_size'] - 1) // upload['chunk_size']):
+            self.assertEqual(self.put(upload, i, content).status_code, 204)
+        r = self.s.post('/uploads/{}'.format(upload['id']), data={'name': name})
+        self.assertEqual(r.status_code, 200)
+
+    def test_upload_duplicate(self):
+        """a file uploaded in chunks is deduplicated and its CRC-32 recorded like any other
+        """
+        c = self.ws()
+        content = os.urandom(300*1000)
+        self.upload('a.bin', content)
+        file_id = self.recv(c, file=True)['file_id']
+        db = redis.Redis()
+        crc32 = db.hget('refs:' + self.identity_hash(), '{}:crc32'.format(file_id))
+        db.close()
+        self.assertEqual(int(crc32), zlib.crc32(content))
+        r = self.s.post('/files', files=[('myfile[]', ('b.bin', content))])
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.recv(c, file=True)['file_id'], file_id)
+        self.upload('c.bin', content)
+        self.assertEqual(self.recv(c, file=True)['file_id'], file_id)
+        self.assertEqual(len(glob('../upload/*/{}/*'.format(self.identity_hash()))), 1)
+
+    def test_upload_small_file(self):
+        """a small file uploaded in chunks is packed into a segment and kept in memory
+        """
+        self.addCleanup(self.remove_files)
+        c = self.ws()
+        content = os.urandom(10*1000)
+        before = self.r('get', '/stats').json()['files']
+        self.upload('small.bin', content)
+        m = self.recv(c, file=True)
+        paths = glob('../upload/*/{}/*'.format(self.identity_hash()))
+        self.assertEqual([os.path.basename(p) for p in paths], ['segment-0'])
+        r = self.s.get('/files', params={'id':m['file_id'], 'name': m['data']})
+        self.assertEqual(r.content, content)
+        after = self.r('get', '/stats').json()['files']
+        self.assertEqual(after['files'], before['files'] + 1)
+        self.assertEqual(after['hits'], before['hits'] + 1)
+
+    def test_download_while_uploading(self):
+        """a large file uploaded in chunks is downloaded by another device as the chunks arrive
+        """
+        c = self.ws()
+        content = os.urandom(600*1000)
+        r = self.s.post('/uploads', data={'size': len(content), 'name': 'large.bin'})
+        self.assertEqual(r.status_code, 201)
+        upload = r.json()
+        frame = json.loads(c.recv())
+        self.assertEqual(frame['action'], 'uploading')
+        self.assertEqual(frame['state'], 'writing')
+        m = frame['msgs'][0]
+        self.assertDictContainsSubset(m, {'data': 'large.bin', 'file_id': upload['id']})
+        self.assertEqual(self.put(upload, 0, content).status_code, 204)
+        r = self.s.get('/files', params={'id':m['file_id'], 'name': m['data']}, stream=True)
+        self.assertEqual(r.status_code, 200)
+        received = r.raw.read(1000)
+        # the download follows the chunks received without a gap
+        self.assertEqual(self.put(upload, 2, content).status_code, 204)
+        self.assertEqual(self.put(upload, 1, content).status_code, 204)
+        self.assertEqual(self.s.post('/uploads/{}'.format(upload['id']), data={'name': 'large.bin'}).status_code, 200)
+        received += r.raw.read()
+        self.assertEqual(received, content)
+        frame = json.loads(c.recv())
+        self.assertEqual(frame['action'], 'uploading')
+        self.assertEqual(frame['state'], 'committed')
+        self.assertEqual(self.recv(c, file=True)['file_id'], m['file_id'])
+
+    def test_upload_wrong_chunk(self):
+        upload = self.create(1000)
+        r = self.s.put('/uploads/{}/0'.format(upload['id']), data=b'0'*999)
+        self.assertEqual(r.status_code, 400)
+        r = self.s.put('/uploads/{}/1'.format(upload['id']), data=b'0'*1000)
+        self.assertEqual(r.status_code, 400)
+
+    def test_cancel(self):
+        upload = self.create(1000)
+        r = self.s.delete('/uploads/{}'.format(upload['id']))
+        self.assertEqual(r.status_code, 204)
+        r = self.s.get('/uploads/{}'.format(upload['id']))
+        self.assertEqual(r.status_code, 404)
+        self.assertEqual(glob('../upload/*/{}/*'.format(self.identity_hash())), [])
+
+    def test_upload_out_of_space(self):
+        r = self.s.post('/uploads', data={'size': 2*1000*1000})
+        self.assertEqual(r.status_code, 431)
+
+    def test_reserve(self):
+        """the storage is reserved once an upload starts so uploads can not exceed the limit together
+        """
+        upload = self.create(600*1000)
+        r = self.s.post('/uploads', data={'size': 600*1000})
+        self.assertEqual(r.status_code, 431)
+        r = self.s.delete('/uploads/{}'.format(upload['id']))
+        self.assertEqual(r.status_code, 204)
+        self.create(600*1000)
+
+    def test_disk_full(self):
+        r = self.s.post('/uploads', data={'size': 10**18})
+        self.assertEqual(r.status_code, 507)
+
+
+class TestWorkers(BaseTestCase):
+    """the server runs 2 worker processes sharing the port
+    a new connection may land on either of them
+    """
+    args = '--workers 2'
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # a worker reports its metrics once it's started
+        for i in range(50):
+            r = requests.request('get', 'http://' + HOST + '/metrics')
+            if all('worker="worker-{}@'.format(w) in r.text for w in range(2)):
+                break
+            sleep(0.1)
+        else:
+            raise AssertionError('the workers are not ready')
+
+    def test_signup_race(self):
+        """of the signups with the same passcode at the same time, only one creates the folder,
+        whichever worker they land on
+        """
+        passcode = 'race{}'.format(self.i)
+        with ThreadPoolExecutor(2) as executor:
+            responses = list(executor.map(lambda i: self.r('post', '/signup', data={'identity': passcode}), range(2)))
+        self.assertEqual(sorted(r.status_code for r in responses), [201, 409])
+        self.i = passcode
+        self.cookie = next(r for r in responses if r.status_code == 201).headers['Set-Cookie']
+        self.send(self.ws(), 'hello world')
+        # the key of the device which created it is the key of the folder
+        r = self.r('post', '/login', data={'identity': passcode})
+        self.cookie = r.headers['Set-Cookie']
+        self.assertEqual(self.pull(self.ws())[0]['data'], 'hello world')
+
+    def test_auth(self):
+        for i in range(8):
+            r = self.r('get', '/auth', headers={'Cookie': self.cookie})
+            self.assertEqual(r.status_code, 200)
+
+    def test_broadcast(self):
+        connections = [self.ws() for i in range(8)]
+        self.send(connections[0], 'hi')
+        for c in connections[1:]:
+            self.assertEqual(self.recv(c), 'hi')
+
+    def test_login(self):
+        """every worker derives the same key from the passcode
+        """
+        c = self.ws()
+        self.send(c, 'hello world')
+        for i in range(4):
+            r = self.r('post', '/login', data={'identity': self.i})
+            self.assertEqual(r.status_code, 200)
+            self.cookie = r.headers['Set-Cookie']
+            msgs = self.pull(self.ws())
+            self.assertEqual(msgs[0]['data'], 'hello world')
+
+    def test_folder_recreated(self):
+        """neither worker accepts the session of a deleted folder once it's created again
+        """
+        old = self.cookie
+        db = redis.Redis()
+        # deleted as it expires
+        db.delete('folder:' + self.identity_hash(), 'messages:' + self.identity_hash())
+        db.publish('expired:' + self.identity_hash(), '')
+        db.close()
+        r = self.r('post', '/signup', data={'identity': self.i})
+        self.assertEqual(r.status_code, 201)
+        new = r.headers['Set-Cookie']
+        for i in range(8):
+            self.assertEqual(self.r('get', '/auth', headers={'Cookie': old}).status_code, 401)
+            self.assertEqual(self.r('get', '/auth', headers={'Cookie': new}).status_code, 200)
+
+    def test_download_while_uploading(self):
+        """the downloads landing on either worker follow the upload
+        """
+        c = self.ws()
+        file_content = os.urandom(800*1000)
+        sock, rest = self.start_upload('large.bin', file_content)
+        m = json.loads(c.recv())['msgs'][0]
+        downloads = []
+        for i in range(4):
+            r = requests.get('http://' + HOST + '/files', params={'id':m['file_id'], 'name': m['data']},
+                             headers={'Cookie': self.cookie}, stream=True)
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.raw.read(1000), file_content[:1000])
+            downloads.append(r)
+        sock.sendall(rest)
+        for r in downloads:
+            self.assertEqual(r.raw.read(), file_content[1000:])
+            r.close()
+        self.assertIn(b'200 OK', sock.recv(1024))
+        sock.close()
+
+    def test_current_size(self):
+        """the size is counted in redis rather than by each worker
+        """
+        for i in range(8):
+            files = [('myfile[]', ('small.txt', 'I am in file {}'.format(i)))]
+            r = self.r('post', '/files', files=files, headers={'Cookie': self.cookie})
+            self.assertEqual(r.status_code, 200)
+        r = redis.Redis()
+        self.assertEqual(r.hget('folder:' + self.identity_hash(), 'current_size'), b'112')
+        r.close()
+
+    def test_metrics(self):
+        """any worker reports the metrics of all workers
+        """
+        r = self.r('get', '/metrics')
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('snapfile_folders_cached{worker="worker-0@', r.text)
+        self.assertIn('snapfile_folders_cached{worker="worker-1@', r.text)
+
+
+class TestMetrics(BaseTestCase):
+    def metrics(self):
+        r = self.r('get', '/metrics')
+        self.assertEqual(r.status_code, 200)
+        self.assertTrue(r.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        return r.text
+
+    def test_metrics(self):
+        c = self.ws()
+        self.send(c, 'hello world')
+        files = [('myfile[]', ('small.txt', 'I am in a file'))]
+        self.s.post('/files', files=files)
+        text = self.metrics()
+        w = self.worker()
+        self.assertIn('# TYPE snapfile_upload_bytes_total counter', text)
+        self.assertIn('snapfile_upload_bytes_total{worker="%s"} 14' % w, text)
+        self.assertIn('snapfile_websocket_connections{worker="%s"} 1' % w, text)
+        self.assertIn('snapfile_request_duration_seconds_count{route="/signup",method="POST",status="201",worker="%s"} 1' % w, text)
+        self.assertIn('snapfile_broadcast_duration_seconds_count{worker="%s"} 2' % w, text)
+        self.assertIn('snapfile_redis_rtt_seconds_count{worker="%s"}' % w, text)
+
+
+class TestPlainFiles(BaseTestCase):
+    """files which are not encrypted are served by sendfile
+    """
+    env = 'SNAPFILE_ENCRYPTION=0'
+
+    def test_download(self):
+        c = self.ws()
+        file_content = os.urandom(100*1000)
+        r = self.s.post('/files', files=[('myfile[]', ('a.bin', file_content))])
+        self.assertEqual(r.status_code, 200)
+        m = self.recv(c, file=True)
+        params = {'id':m['file_id'], 'name': m['data']}
+        r = self.s.get('/files', params=params)
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn('X-Accel-Redirect', r.headers)
+        self.assertEqual(int(r.headers['content-length']), len(file_content))
+        self.assertEqual(r.content, file_content)
+        etag = r.headers['ETag']
+        r = self.s.get('/files', params=params, headers={'Range': 'bytes=0-4'})
+        self.assertEqual(r.status_code, 206)
+        self.assertEqual(r.headers['Content-Range'], 'bytes 0-4/{}'.format(len(file_content)))
+        self.assertEqual(r.content, file_content[:5])
+        r = self.s.get('/files', params=params, headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.content, b'')
+
+
+class TestAccelRedirect(BaseTestCase):
+    """files which are not encrypted are served by NGINX if ACCEL_REDIRECT is set
+    """
+    env = 'SNAPFILE_ENCRYPTION=0 SNAPFILE_ACCEL_REDIRECT=1'
+
+    def test_download(self):
+        c = self.ws()
+        r = self.s.post('/files', files=[('myfile[]', ('a.bin', os.urandom(1000)))])
+        self.assertEqual(r.status_code, 200)
+        m = self.recv(c, file=True)
+        r = self.s.get('/files', params={'id':m['file_id'], 'name': m['data']})
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('/download/', r.headers['X-Accel-Redirect'])
+        self.assertTrue(r.headers['X-Accel-Redirect'].endswith('/{}'.format(m['file_id'])))
+        self.assertEqual(r.content, b'')
+
+
+class TestVolumes(BaseTestCase):
+    env = 'SNAPFILE_VOLUMES=./upload2'
+
+    def test_upload(self):
+        """folders are spread over the volumes and their files are on their own volume
+        """
+        r = redis.Redis()
+        # recorded as an absolute path
+        volume = os.path.abspath('../upload2').encode()
+        # both volumes are on the same disk, so each is as likely
+        for i in range(20):
+            if r.hget('folder:' + self.identity_hash(), 'volume') == volume:
+                break
+            self.signup()
+        self.assertEqual(r.hget('folder:' + self.identity_hash(), 'volume'), volume)
+        r.close()
+        c = self.ws()
+        content = os.urandom(1000)
+        self.s.post('/files', files=[('myfile[]', ('a.bin', content))])
+        m = self.recv(c, file=True)
+        self.assertEqual(len(glob('../upload2/*/{}/*'.format(self.identity_hash()))), 1)
+        r = self.s.get('/files', params={'id': m['file_id'], 'name': m['data']})
+        self.assertEqual(r.content, content)
+
+    def test_moved(self):
+        """a file is written to the volume recorded in redis even if the worker is not told of the move
+        """
+        r = redis.Redis()
+        key = 'folder:' + self.identity_hash()
+        source = r.hget(key, 'volume').decode()
+        target, = {os.path.abspath('../upload'), os.path.abspath('../upload2')} - {source}
+        path = os.path.join(target, r.hget(key, 'path').decode())
+        os.makedirs(path)
+        self.addCleanup(shutil.rmtree, path)
+        # moved by another worker whose message on MOVED_CHANNEL is lost
+        r.hset(key, 'volume', target)
+        r.close()
+        c = self.ws()
+        content = os.urandom(100*1000)
+        self.s.post('/files', files=[('myfile[]', ('a.bin', content))])
+        m = self.recv(c, file=True)
+        self.assertEqual(len(os.listdir(path)), 1)
+        r = self.s.get('/files', params={'id': m['file_id'], 'name': m['data']})
+        self.assertEqual(r.content, content)
+
+    def test_moving(self):
+        """uploads are refused while the folder is being moved to another volume
+        """
+        r = redis.Redis()
+        r.hset('folder:' + self.identity_hash(), 'moving', int(time()) + 60)
+        files = [('myfile[]', ('a.txt', 'I am in a file'))]
+        self.assertEqual(self.s.post('/files', files=files).status_code, 503)
+        # a lock left by a worker which is gone expires
+        r.hset('folder:' + self.identity_hash(), 'moving', int(time()) - 1)
+        self.assertEqual(self.s.post('/files', files=files).status_code, 200)
+        r.close()
+
+
 class TestExpire(BaseTestCase):
     def test_login(self):
         c1 = self.ws()
         c2 = self.ws()
+        self.s.post('/files', files=[('myfile[]', ('small.txt', 'I am in a file'))])
+        for c in (c1, c2):
+            self.recv(c, file=True)
+        self.assertEqual(len(glob('../upload/*/{}/*'.format(self.identity_hash()))), 1)
         sleep(6.5)
-        self.checkLog('1 folders found and 0 folders deleted')
-        # expired after 8 seconds
+        self.checkLog('folders deleted', present=False)
+        # expired after 8 seconds and deleted within a second by the reaper
         sleep(2)
+        # the files are deleted in the background
+        self.checkLog('Folder {} expired'.format(self.identity_hash()), '1 folders deleted',
+                      '.trash/{}-'.format(self.identity_hash()), 'deleted: 1 files')
+        self.assertEqual(glob('../upload/*/{}'.format(self.identity_hash())), [])
+        self.assertEqual(glob('../upload/.trash/*'), [])
+        r = redis.Redis()
+        self.assertEqual(r.zcard('deletions'), 0)
+        r.close()
         r = self.s.get('/files')
         self.assertEqual(r.status_code, 401)
         r = self.r('post', '/login', data={'identity': self.i})
         self.assertEqual(r.status_code, 401)
-        # ws should be closed
-        c1.send('hi')
-        opcode, frame = c1.recv_data()
-        self.assertEqual(opcode, websocket.ABNF.OPCODE_CLOSE)
-        self.assertIn(b'Expired', frame)
-        sleep(4)
-        # folder should be deleted now
-        self.checkLog('1 folders deleted')
-        opcode, frame = c2.recv_data()
-        self.assertEqual(opcode, websocket.ABNF.OPCODE_CLOSE)
-        # c2 is idle and gets closed by the reaper (a background task), so on
-        # current aiohttp the close *reason* isn't delivered (the client sees a
-        # bare 1000). c1's 'Expired' works because it's closed synchronously in
-        # its own handler. The client doesn't use the reason, so only assert the
-        # socket was closed and leave the original reason check below for ref:
-        # self.assertIn(b'Deleted', frame)
+        # both ws should be closed by the reaper
+        # on current aiohttp the close *reason* of a socket closed by a
+        # background task isn't delivered (the client sees a bare 1000), and the
+        # client doesn't use the reason, so only assert the socket was closed
+        for c in (c1, c2):
+            opcode, frame = c.recv_data()
+            self.assertEqual(opcode, websocket.ABNF.OPCODE_CLOSE)
+
+    def test_resume_deletion(self):
+        """a deletion interrupted by a restart is resumed from its tombstone
+        """
+        path = '../upload/.trash/interrupted/1'
+        os.makedirs(path)
+        for i in range(3):
+            with open(os.path.join(path, str(i)), 'wb') as f:
+                f.write(b'0'*1000)
+        r = redis.Redis()
+        r.zadd('deletions', {'./upload/.trash/interrupted': 0})
+        sleep(1.5) # REAP_INTERVAL
+        self.checkLog('./upload/.trash/interrupted deleted: 3 files, 3.0KB')
+        self.assertFalse(os.path.exists('../upload/.trash/interrupted'))
+        self.assertEqual(r.zcard('deletions'), 0)
+        r.close()
+        text = self.r('get', '/metrics').text
+        w = self.worker()
+        self.assertIn('snapfile_deleted_files_total{worker="%s"}' % w, text)
+        self.assertIn('snapfile_deletion_backlog{worker="%s"} 0' % w, text)